@@ -0,0 +1,342 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import logging
+from typing import Optional, Sequence
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+import numpy as np
+from tessdbapi.model import ReadingInfo, ReadingInfo4c
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+
+# ---------
+# Constants
+# ---------
+
+INITIAL_CAPACITY = 1024  # photometer slots, doubled as needed
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.FILTER.value)
+
+# -------
+# Classes
+# -------
+
+
+class ArrayFilter:
+    """
+    Sampler + LookAheadFilter for all photometers at once.
+    Each photometer gets a slot id indexing struct-of-arrays ring buffers holding the
+    filter window (magnitudes, sequence numbers and the readings themselves) and the
+    sampler and filter state. All the samples of a batch are filtered with array
+    operations, in rounds with at most one sample per photometer, so that the result
+    is the same as calling Sampler.push_pop() and LookAheadFilter.push_pop() in order.
+    Saturation is checked on mag4 for TESS4C photometers and on mag1 otherwise,
+    as LookAheadFilter does.
+    """
+
+    def __init__(self, depth: int, capacity: int = INITIAL_CAPACITY) -> None:
+        if (depth % 2) != 1:
+            raise ValueError(
+                f"{self.__class__.__name__}: depth should be an odd number, not {depth}"
+            )
+        self.depth = depth
+        self.middle = depth // 2
+        self.slots: dict[str, int] = dict()
+        self.names: list[str] = list()
+        self._capacity = 0
+        self._mag = np.zeros((0, depth), dtype=np.float64)
+        self._seq = np.zeros((0, depth), dtype=np.int64)
+        self._items = np.empty((0, depth), dtype=object)
+        self._count = np.zeros(0, dtype=np.int64)  # samples in the window
+        self._head = np.zeros(0, dtype=np.int64)  # ring position for the next sample
+        self._buffered = np.zeros(0, dtype=bool)
+        self._flushing = np.zeros(0, dtype=bool)
+        self._flushed = np.zeros(0, dtype=bool)  # As in LookAheadFilter.flushing_names
+        self._divisor = np.zeros(0, dtype=np.int64)
+        self._next_divisor = np.zeros(0, dtype=np.int64)
+        self._phase = np.zeros(0, dtype=np.int64)  # next sampler cycle value
+        self._traced = np.zeros(0, dtype=bool)  # debug log decisions
+        self.num_discarded = 0  # samples allowed by the sampler but flagged in discard
+        self._grow(capacity)
+
+    def _grow(self, capacity: int) -> None:
+        for attr in (
+            "_mag",
+            "_seq",
+            "_items",
+            "_count",
+            "_head",
+            "_buffered",
+            "_flushing",
+            "_flushed",
+            "_divisor",
+            "_next_divisor",
+            "_phase",
+            "_traced",
+        ):
+            old = getattr(self, attr)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            if old.dtype == object:
+                new.fill(None)
+            new[: len(old)] = old
+            setattr(self, attr, new)
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str, divisor: int, flushing: bool, buffered: bool) -> int:
+        """Allocates and configures a new photometer slot"""
+        slot = len(self.names)
+        if slot == self._capacity:
+            self._grow(2 * self._capacity)
+        self.slots[name] = slot
+        self.names.append(name)
+        self._divisor[slot] = divisor
+        self._next_divisor[slot] = divisor
+        self._buffered[slot] = buffered
+        self._flushing[slot] = flushing
+        # some filters may start in flushing state
+        self._flushed[slot] = flushing
+        return slot
+
+    def set_divisor(self, slot: int, divisor: int) -> None:
+        """Takes effect on the next sample allowed by the current divisor, as in Sampler"""
+        self._next_divisor[slot] = divisor
+
+    def set_buffered(self, slot: int, value: bool) -> None:
+        self._buffered[slot] = value
+
+    def set_traced(self, slot: int, value: bool) -> None:
+        self._traced[slot] = value
+
+    def flush(self) -> None:
+        self._flushing[: len(self.names)] = True
+
+    def pending(self) -> set[str]:
+        """Photometers whose filters have not yet been flushed"""
+        return {self.names[i] for i in np.flatnonzero(~self._flushed[: len(self.names)])}
+
+    def dump(self, slot: int) -> tuple[int, int, list[ReadingInfo]]:
+        """Sampler divisor & phase and filter window, youngest reading first"""
+        W = self.depth
+        head = int(self._head[slot])
+        window = [self._items[slot, (head - 1 - k) % W] for k in range(int(self._count[slot]))]
+        return int(self._divisor[slot]), int(self._phase[slot]), window
+
+    def load(self, slot: int, divisor: int, phase: int, window: list[ReadingInfo]) -> None:
+        """Restores what dump() returned. Only the youngest readings fitting the depth are kept"""
+        W = self.depth
+        window = window[:W]
+        self._divisor[slot] = divisor
+        self._phase[slot] = phase % divisor
+        self._items[slot].fill(None)
+        head = len(window) % W
+        for k, item in enumerate(window):
+            pos = (head - 1 - k) % W
+            self._items[slot, pos] = item
+            self._mag[slot, pos] = item.mag4 if isinstance(item, ReadingInfo4c) else item.mag1
+            self._seq[slot, pos] = item.sequence_number
+        self._head[slot] = head
+        self._count[slot] = len(window)
+
+    def push(
+        self,
+        samples: Sequence[ReadingInfo],
+        slots: Sequence[int],
+        bypass: Optional[Sequence[bool]] = None,
+        discard: Optional[Sequence[bool]] = None,
+    ) -> tuple[list[ReadingInfo], list[ReadingInfo]]:
+        """
+        Filters a batch of samples given their photometer slots.
+        Samples flagged in bypass only go through the sampler, releasing the filter window
+        as flushing filters do, but without counting the filter as flushed.
+        Samples flagged in discard only go through the sampler and are dropped afterwards.
+        Returns the chosen readings and the extra readings released by flushing filters.
+        """
+        n = len(samples)
+        if n == 0:
+            return list(), list()
+        slots = np.fromiter(slots, dtype=np.int64, count=n)
+        if bypass is None:
+            bypass = np.zeros(n, dtype=bool)
+        else:
+            bypass = np.fromiter(bypass, dtype=bool, count=n)
+        if discard is None:
+            discard = np.zeros(n, dtype=bool)
+        else:
+            discard = np.fromiter(discard, dtype=bool, count=n)
+        mags = np.fromiter(
+            (s.mag4 if isinstance(s, ReadingInfo4c) else s.mag1 for s in samples),
+            dtype=np.float64,
+            count=n,
+        )
+        seqs = np.fromiter((s.sequence_number for s in samples), dtype=np.int64, count=n)
+        items = np.fromiter(samples, dtype=object, count=n)
+        # Occurrence rank of each sample within its photometer
+        order = np.argsort(slots, kind="stable")
+        ordered = slots[order]
+        first = np.ones(n, dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        starts = np.maximum.accumulate(np.where(first, np.arange(n), 0))
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n) - starts
+        chosen = list()
+        extra = list()
+        for r in range(int(rank.max()) + 1):
+            index = np.flatnonzero(rank == r)
+            self._round(index, slots[index], mags, seqs, items, bypass, discard, chosen, extra)
+        return self._collect(chosen), self._collect(extra)
+
+    def _collect(self, parts: list[tuple]) -> list[ReadingInfo]:
+        """Puts the round results back in sample order"""
+        if not parts:
+            return list()
+        index = np.concatenate([part[0] for part in parts])
+        items = np.concatenate([part[1] for part in parts])
+        return items[np.argsort(index, kind="stable")].tolist()
+
+    def _round(
+        self,
+        index: np.ndarray,
+        slots: np.ndarray,
+        mags: np.ndarray,
+        seqs: np.ndarray,
+        items: np.ndarray,
+        bypass: np.ndarray,
+        discard: np.ndarray,
+        chosen: list,
+        extra: list,
+    ) -> None:
+        # Sampler stage
+        phase = self._phase[slots]
+        allowed = phase == 0
+        self._phase[slots] = (phase + 1) % self._divisor[slots]
+        changed = allowed & (self._divisor[slots] != self._next_divisor[slots])
+        if changed.any():
+            c = slots[changed]
+            self._divisor[c] = self._next_divisor[c]
+            self._phase[c] = 1 % self._divisor[c]  # skip 0 on this new cycle
+        if self._traced[slots].any():
+            self._trace(slots[~allowed], items[index[~allowed]], "Sampler: dropping seq# = %d")
+        index = index[allowed]
+        slots = slots[allowed]
+        discarded = discard[index]
+        if discarded.any():
+            self.num_discarded += int(discarded.sum())
+            index = index[~discarded]
+            slots = slots[~discarded]
+        unbuffered = ~self._buffered[slots] | self._flushing[slots]
+        released = bypass[index] & ~unbuffered
+        unbuffered |= released
+        if unbuffered.any():
+            self._unbuffered(
+                index[unbuffered], slots[unbuffered], released[unbuffered], items, chosen, extra
+            )
+            index = index[~unbuffered]
+            slots = slots[~unbuffered]
+        if len(slots):
+            self._buffered_round(index, slots, mags, seqs, items, chosen)
+
+    def _unbuffered(
+        self,
+        index: np.ndarray,
+        slots: np.ndarray,
+        released: np.ndarray,
+        items: np.ndarray,
+        chosen: list,
+        extra: list,
+    ) -> None:
+        W = self.depth
+        for i, slot, bypassed in zip(index.tolist(), slots.tolist(), released.tolist()):
+            N = int(self._count[slot])
+            if N > 0:
+                M = min(N, self.middle)
+                head = int(self._head[slot])
+                # saves what's needed to be saved, youngest first
+                window = [(head - 1 - k) % W for k in range(M)]
+                saved = self._items[slot, window]
+                extra.append((np.full(M, i), saved))
+                self._items[slot].fill(None)
+                self._count[slot] = 0  # queue closed for ever, unless bypassed
+                if not bypassed:
+                    self._flushed[slot] = True
+                log.debug(
+                    "%s: %s flushing %d extra readings",
+                    self.__class__.__name__,
+                    self.names[slot],
+                    M,
+                )
+        chosen.append((index, items[index]))
+        if self._traced[slots].any():
+            self._trace(slots, items[index], "ArrayFilter: chosen reading seq# = %d")
+
+    def _buffered_round(
+        self,
+        index: np.ndarray,
+        slots: np.ndarray,
+        mags: np.ndarray,
+        seqs: np.ndarray,
+        items: np.ndarray,
+        chosen: list,
+    ) -> None:
+        W = self.depth
+        head = self._head[slots]
+        self._mag[slots, head] = mags[index]
+        self._seq[slots, head] = seqs[index]
+        self._items[slots, head] = items[index]
+        head = (head + 1) % W
+        self._head[slots] = head
+        count = np.minimum(self._count[slots] + 1, W)
+        self._count[slots] = count
+        # Window positions, youngest sample first
+        window = (head[:, None] - 1 - np.arange(W)) % W
+        rows = slots[:, None]
+        valid = np.arange(W) < count[:, None]
+        mag = np.where(valid, self._mag[rows, window], 0.0)
+        # Same summation order as sum() in LookAheadFilter.is_saturated()
+        total = np.zeros(len(slots), dtype=np.float64)
+        for k in range(W):
+            total += mag[:, k]
+        saturated = total == 0
+        seq = self._seq[rows, window]
+        # Monotonic if all second differences in sequence numbers are 0
+        monotonic = ((seq[:, 2:] - 2 * seq[:, 1:-1] + seq[:, :-2]) == 0).all(axis=1)
+        full = count == W
+        almost = (count > self.middle) & ~full
+        dropped = np.where(full, saturated & monotonic, saturated)
+        accepted = (almost | full) & ~dropped
+        middle = self._items[slots, window[:, self.middle]]
+        chosen.append((index[accepted], middle[accepted]))
+        if self._traced[slots].any():
+            self._trace(slots[accepted], middle[accepted], "ArrayFilter: chosen reading seq# = %d")
+            rejected = (almost | full) & dropped
+            self._trace(
+                slots[rejected],
+                middle[rejected],
+                "ArrayFilter: dropping saturated reading seq# = %d",
+            )
+
+    def _trace(self, slots: np.ndarray, items: np.ndarray, message: str) -> None:
+        for slot, item in zip(slots.tolist(), items.tolist()):
+            if self._traced[slot]:
+                logging.getLogger(self.names[slot]).debug(message, item.sequence_number)
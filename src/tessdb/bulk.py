@@ -0,0 +1,457 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Union
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from sqlalchemy import exc, func, select, tuple_
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.sql.expression import Insert
+from sqlalchemy.sql.schema import Table
+from tessdbdao.asyncio import TessReadings, Tess4cReadings
+from tessdbapi.model import (
+    ReadingInfo,
+    ReadingInfo4c,
+    ReferencesInfo,
+    IMPOSSIBLE_SIGNAL_STRENGTH,
+    IMPOSSIBLE_TEMPERATURE,
+)
+from tessdbapi.asyncio.photometer.reading import stats as read_stats
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+
+# ---------
+# Constants
+# ---------
+
+TESS_COLUMNS = (
+    "date_id",
+    "time_id",
+    "tess_id",
+    "location_id",
+    "observer_id",
+    "units_id",
+    "sequence_number",
+    "frequency",
+    "magnitude",
+    "box_temperature",
+    "sky_temperature",
+    "azimuth",
+    "altitude",
+    "longitude",
+    "latitude",
+    "elevation",
+    "signal_strength",
+    "hash",
+)
+
+TESS4C_COLUMNS = (
+    "date_id",
+    "time_id",
+    "tess_id",
+    "location_id",
+    "observer_id",
+    "units_id",
+    "sequence_number",
+    "freq1",
+    "mag1",
+    "freq2",
+    "mag2",
+    "freq3",
+    "mag3",
+    "freq4",
+    "mag4",
+    "box_temperature",
+    "sky_temperature",
+    "azimuth",
+    "altitude",
+    "longitude",
+    "latitude",
+    "elevation",
+    "signal_strength",
+    "hash",
+)
+
+# Errors worth retrying: the database is unreachable, locked, restarting ...
+TRANSIENT_ERRORS = (
+    exc.OperationalError,
+    exc.InterfaceError,
+    sqlite3.OperationalError,
+    ConnectionError,
+    TimeoutError,
+)
+
+TABLES = (
+    (TessReadings.__tablename__, TESS_COLUMNS),
+    (Tess4cReadings.__tablename__, TESS4C_COLUMNS),
+)
+
+# Databases whose inserts can skip the rows already in the table
+IGNORE_DIALECTS = ("sqlite", "postgresql", "mysql", "mariadb")
+
+# -------
+# Classes
+# -------
+
+
+class OrmBackend:
+    """
+    Portable ORM inserts, retried one by one after an integrity error.
+    Idempotent inserts skip the readings already written instead.
+    """
+
+    name = "orm"
+
+    def __init__(self, idempotent: bool = False) -> None:
+        self.idempotent = idempotent
+
+    async def _insert_ignore(
+        self, session: AsyncSession, items: Sequence[tuple[ReadingInfo, ReferencesInfo]]
+    ) -> int:
+        inserted = 0
+        async with session.begin():
+            conn = await session.connection()
+            dialect = conn.dialect
+            for (table, columns), rows in zip(TABLES, sorted_rows(items)):
+                if not rows:
+                    continue
+                stmt = insert_ignore(TessReadings.metadata.tables[table], dialect.name)
+                params = [dict(zip(columns, row)) for row in rows]
+                if dialect.insert_executemany_returning:
+                    # Only the inserted rows are returned
+                    stmt = stmt.returning(stmt.table.c.tess_id)
+                    inserted += len((await conn.execute(stmt, params)).all())
+                elif dialect.name in ("mysql", "mariadb"):
+                    # The rows already there are counted as affected too (CLIENT_FOUND_ROWS)
+                    keys = {row[:3] for row in rows}
+                    inserted += len(keys) - await existing(conn, stmt.table, keys)
+                    await conn.execute(stmt, params)
+                else:
+                    inserted += (await conn.execute(stmt, params)).rowcount
+        return inserted
+
+    async def write(
+        self, session: AsyncSession, items: Sequence[tuple[ReadingInfo, ReferencesInfo]]
+    ) -> int:
+        if self.idempotent:
+            inserted = await self._insert_ignore(session, items)
+            skipped(len(items) - inserted, len(items))
+            return inserted
+        try:
+            async with session.begin():
+                session.add_all([new_dbobject(reading, ref) for reading, ref in items])
+        except exc.IntegrityError as e:
+            # Other errors are raised, to be retried, instead of discarding the readings
+            log.error(str(e).split("\n")[0])
+            return await self._looped_write(session, items)
+        return len(items)
+
+    async def _looped_write(
+        self, session: AsyncSession, items: Sequence[tuple[ReadingInfo, ReferencesInfo]]
+    ) -> int:
+        """One by one commit of the readings. Returns the number of inserted readings"""
+        log.info("Looping %d readings one by one.", len(items))
+        inserted = 0
+        for reading, ref in items:
+            try:
+                async with session.begin():
+                    session.add(new_dbobject(reading, ref))
+            except exc.IntegrityError:
+                read_stats.rej_duplicated += 1
+                log.warning("Discarding reading by SQL Integrity error: %s", dict(reading))
+            else:
+                inserted += 1
+        log.info("Rejected [%d/%d] database writes in loop", len(items) - inserted, len(items))
+        return inserted
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteBackend:
+    """
+    Inserts from a dedicated thread with its own connection to the database file in WAL mode,
+    so that the event loop never waits for the file lock. Rows are inserted in primary key order
+    with executemany() and retried one by one after an integrity error.
+    Idempotent inserts skip the readings already written instead.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, idempotent: bool = False) -> None:
+        self.path = path
+        self.idempotent = idempotent
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tessdb-sqlite")
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            # Autocommit mode, transactions are explicit. Waits for the lock held
+            # by the other connections (i.e. registrations) up to the timeout
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._conn = conn
+        return self._conn
+
+    def _write(self, tables: list[tuple[str, str, list[tuple]]]) -> tuple[int, list[tuple]]:
+        """Runs in the writer thread. Returns the number of inserted rows and the rejected rows"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            inserted = 0
+            for _, sql, rows in tables:
+                inserted += conn.executemany(sql, rows).rowcount
+            conn.execute("COMMIT")
+            return inserted, list()
+        except sqlite3.IntegrityError as e:
+            log.error(str(e))
+        finally:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+        inserted = 0
+        rejected = list()
+        for _, sql, rows in tables:
+            log.info("Looping %d readings one by one.", len(rows))
+            for row in rows:
+                try:
+                    inserted += conn.execute(sql, row).rowcount
+                except sqlite3.IntegrityError:
+                    rejected.append(row)
+        return inserted, rejected
+
+    async def write(
+        self, session: AsyncSession, items: Sequence[tuple[ReadingInfo, ReferencesInfo]]
+    ) -> int:
+        # ON CONFLICT only skips the primary key conflicts, not the foreign key ones
+        conflict = " ON CONFLICT DO NOTHING" if self.idempotent else ""
+        tables = [
+            (
+                table,
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))}){conflict}",
+                rows,
+            )
+            for (table, columns), rows in zip(TABLES, sorted_rows(items))
+            if rows
+        ]
+        loop = asyncio.get_running_loop()
+        inserted, rejected = await loop.run_in_executor(self._executor, self._write, tables)
+        for row in rejected:
+            read_stats.rej_duplicated += 1
+            log.warning("Discarding reading by SQL Integrity error: %s", row)
+        if rejected:
+            log.info("Rejected [%d/%d] database writes in loop", len(rejected), len(items))
+        skipped(len(items) - inserted - len(rejected), len(items))
+        return inserted
+
+    def _close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def close(self) -> None:
+        # Pending writes are done before closing the connection
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=False)
+
+
+class CopyBackend:
+    """
+    PostgreSQL binary COPY of the rows into a temporary staging table, merged
+    into the readings table with a single statement skipping duplicated readings.
+    Needs the asyncpg driver (postgresql+asyncpg:// database URL).
+    """
+
+    name = "copy"
+    idempotent = True
+
+    async def write(
+        self, session: AsyncSession, items: Sequence[tuple[ReadingInfo, ReferencesInfo]]
+    ) -> int:
+        inserted = 0
+        async with session.begin():
+            conn = await session.connection()
+            raw = (await conn.get_raw_connection()).driver_connection
+            for (table, columns), rows in zip(TABLES, sorted_rows(items)):
+                if not rows:
+                    continue
+                stage = f"{table}_stage"
+                names = ", ".join(columns)
+                # Statements go through SQLAlchemy, which starts the transaction the COPY
+                # runs in. Otherwise the staged rows are deleted as soon as they are copied.
+                await conn.exec_driver_sql(
+                    f"CREATE TEMPORARY TABLE IF NOT EXISTS {stage} "
+                    f"(LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+                )
+                await raw.copy_records_to_table(stage, records=rows, columns=columns)
+                result = await conn.exec_driver_sql(
+                    f"INSERT INTO {table} ({names}) SELECT {names} FROM {stage} "
+                    "ON CONFLICT DO NOTHING"
+                )
+                inserted += result.rowcount
+        skipped(len(items) - inserted, len(items))
+        return inserted
+
+    def close(self) -> None:
+        pass
+
+
+ReadingsBackend = Union[OrmBackend, SqliteBackend, CopyBackend]
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.DBASE.value)
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def skipped(duplicated: int, total: int) -> None:
+    """Counts the readings already in the database, skipped by an idempotent insert"""
+    if duplicated:
+        read_stats.rej_duplicated += duplicated
+        log.info("Rejected [%d/%d] duplicated database writes", duplicated, total)
+
+
+def insert_ignore(table: Table, dialect: str) -> Insert:
+    """INSERT statement skipping the rows whose primary key is already in the table"""
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    # MySQL & MariaDB. Unlike INSERT IGNORE, the other errors are not turned into warnings
+    key = table.primary_key.columns[0]
+    return mysql.insert(table).on_duplicate_key_update({key.name: key})
+
+
+async def existing(conn: AsyncConnection, table: Table, keys: set[tuple]) -> int:
+    """Number of these primary keys already in the table"""
+    pk = tuple_(*table.primary_key.columns)
+    query = select(func.count()).select_from(table).where(pk.in_(list(keys)))
+    return (await conn.execute(query)).scalar_one()
+
+
+def tess_row(reading: ReadingInfo, ref: ReferencesInfo) -> tuple:
+    return (
+        ref.date_id,
+        ref.time_id,
+        ref.tess_id,
+        ref.location_id,
+        ref.observer_id,
+        ref.units_id,
+        reading.sequence_number,
+        reading.freq1,
+        reading.mag1,
+        reading.box_temperature,
+        reading.sky_temperature,
+        reading.azimuth,
+        reading.altitude,
+        reading.longitude,
+        reading.latitude,
+        reading.elevation,
+        reading.signal_strength,
+        reading.hash,
+    )
+
+
+def tess4c_row(reading: ReadingInfo4c, ref: ReferencesInfo) -> tuple:
+    # Early TESS4C models did not provide temperatures nor signal strength
+    return (
+        ref.date_id,
+        ref.time_id,
+        ref.tess_id,
+        ref.location_id,
+        ref.observer_id,
+        ref.units_id,
+        reading.sequence_number,
+        reading.freq1,
+        reading.mag1,
+        reading.freq2,
+        reading.mag2,
+        reading.freq3,
+        reading.mag3,
+        reading.freq4,
+        reading.mag4,
+        reading.box_temperature if reading.box_temperature is not None else IMPOSSIBLE_TEMPERATURE,
+        reading.sky_temperature if reading.sky_temperature is not None else IMPOSSIBLE_TEMPERATURE,
+        reading.azimuth,
+        reading.altitude,
+        reading.longitude,
+        reading.latitude,
+        reading.elevation,
+        reading.signal_strength
+        if reading.signal_strength is not None
+        else IMPOSSIBLE_SIGNAL_STRENGTH,
+        reading.hash,
+    )
+
+
+def new_dbobject(reading: ReadingInfo, ref: ReferencesInfo) -> Union[TessReadings, Tess4cReadings]:
+    """
+    ORM object with the same column values as the rows of the native backends.
+    Not tessdbapi new_dbobject(), which writes freq1 into the TESS4C mag1 column.
+    """
+    if isinstance(reading, ReadingInfo4c):
+        return Tess4cReadings(**dict(zip(TESS4C_COLUMNS, tess4c_row(reading, ref))))
+    return TessReadings(**dict(zip(TESS_COLUMNS, tess_row(reading, ref))))
+
+
+def sorted_rows(
+    items: Sequence[tuple[ReadingInfo, ReferencesInfo]],
+) -> tuple[list[tuple], list[tuple]]:
+    """TESS-W and TESS4C readings table rows, in (date_id, time_id, tess_id) primary key order"""
+    rows, rows4c = list(), list()
+    for reading, ref in items:
+        if isinstance(reading, ReadingInfo4c):
+            rows4c.append(tess4c_row(reading, ref))
+        else:
+            rows.append(tess_row(reading, ref))
+    rows.sort(key=lambda row: row[:3])
+    rows4c.sort(key=lambda row: row[:3])
+    return rows, rows4c
+
+
+def backend(name: str, url: str, idempotent: bool = False) -> ReadingsBackend:
+    """
+    The bulk insert backend for a database URL: "orm" for the portable ORM inserts
+    or "native" for the best one available for the database. Idempotent backends
+    skip the readings already written (same photometer and timestamp).
+    """
+    if name not in ("orm", "native"):
+        raise ValueError(f"Unknown bulk insert backend: {name}")
+    url = make_url(url)
+    dialect = url.get_backend_name()
+    if idempotent and dialect not in IGNORE_DIALECTS:
+        log.warning("No idempotent inserts for %s, duplicated readings fail", url.drivername)
+        idempotent = False
+    if name == "orm":
+        return OrmBackend(idempotent)
+    if dialect == "sqlite" and url.database and url.database != ":memory:":
+        return SqliteBackend(url.database, idempotent)
+    if dialect == "postgresql" and url.get_driver_name() == "asyncpg":
+        return CopyBackend()
+    log.warning("No native bulk insert backend for %s, using the ORM one", url.drivername)
+    return OrmBackend(idempotent)
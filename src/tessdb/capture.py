@@ -0,0 +1,117 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import glob
+import struct
+import logging
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, NamedTuple
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+import aiomqtt
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+
+# ---------
+# Constants
+# ---------
+
+MAGIC = b"TESSCAP1"
+# Record header: receive time (ns since epoch), flags, topic length, payload length
+RECORD = struct.Struct("<qBHI")
+RETAIN_FLAG = 0x01
+CAPTURE_GLOB = "capture-*.bin"
+
+# -------
+# Classes
+# -------
+
+
+class Captured(NamedTuple):
+    tstamp: float  # receive time, seconds since epoch
+    topic: str
+    payload: bytes
+    retain: bool
+
+
+class CaptureWriter:
+    """Writes received MQTT messages to size rotated capture files, keeping the newest ones"""
+
+    def __init__(self, directory: str, max_size: int, max_files: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+        self.max_files = max_files
+        self._file = None
+        self._size = 0
+        self._rotate()
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        now = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        path = os.path.join(self.directory, f"capture-{now}.bin")
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+        log.info("Capturing MQTT messages to %s", path)
+        if self.max_files > 0:
+            paths = sorted(glob.glob(os.path.join(self.directory, CAPTURE_GLOB)))
+            for old in paths[: -self.max_files]:
+                os.unlink(old)
+
+    def write(self, messages: Iterable[aiomqtt.Message], received: Iterable[int]) -> None:
+        """Writes the messages with their receive times (ns since epoch)"""
+        for message, ns in zip(messages, received):
+            topic = message.topic.value.encode("utf-8")
+            flags = RETAIN_FLAG if message.retain else 0
+            self._file.write(RECORD.pack(ns, flags, len(topic), len(message.payload)))
+            self._file.write(topic)
+            self._file.write(message.payload)
+            self._size += RECORD.size + len(topic) + len(message.payload)
+        if self._size >= self.max_size:
+            self._rotate()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.MQTT.value)
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def read_capture(paths: Iterable[str]) -> Iterator[Captured]:
+    """Captured messages from capture files, in the given file order"""
+    for path in paths:
+        with open(path, "rb") as fd:
+            if fd.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a capture file")
+            while len(header := fd.read(RECORD.size)) == RECORD.size:
+                ns, flags, topic_len, payload_len = RECORD.unpack(header)
+                topic = fd.read(topic_len).decode("utf-8")
+                payload = fd.read(payload_len)
+                if len(payload) < payload_len:
+                    break  # truncated by a crash while capturing
+                yield Captured(ns / 1e9, topic, payload, bool(flags & RETAIN_FLAG))
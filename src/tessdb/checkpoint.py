@@ -0,0 +1,118 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import time
+import struct
+import logging
+from datetime import datetime, timezone
+from typing import Iterable, NamedTuple
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbapi.model import ReadingInfo
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+from .spool import encode, decode
+
+# ---------
+# Constants
+# ---------
+
+MAGIC = b"TESSFLT1"
+# Snapshot header: save time (s since epoch), number of entries
+HEADER = struct.Struct("<dI")
+# Entry header: name length, sampler divisor, sampler phase, encoded window length
+ENTRY = struct.Struct("<HIII")
+
+# -------
+# Classes
+# -------
+
+
+class FilterSnapshot(NamedTuple):
+    name: str
+    divisor: int  # current sampler divisor
+    phase: int  # next sampler cycle value, 0 = the next reading is allowed
+    window: list[ReadingInfo]  # look ahead filter window, youngest reading first
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.FILTER.value)
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def save(path: str, entries: Iterable[FilterSnapshot]) -> int:
+    """Atomically writes the filters snapshot file. Returns the number of entries"""
+    chunks = list()
+    for entry in entries:
+        name = entry.name.encode("utf-8")
+        window = encode(entry.window)
+        chunks.append(ENTRY.pack(len(name), entry.divisor, entry.phase, len(window)))
+        chunks.append(name)
+        chunks.append(window)
+    count = len(chunks) // 3
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as fd:
+        fd.write(MAGIC)
+        fd.write(HEADER.pack(time.time(), count))
+        fd.write(b"".join(chunks))
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+def load(path: str, max_age: float) -> list[FilterSnapshot]:
+    """
+    Reads a filters snapshot file, discarding entries whose youngest reading
+    (or the snapshot itself, for empty windows) is older than max_age seconds
+    """
+    with open(path, "rb") as fd:
+        data = fd.read()
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a filters snapshot file")
+    saved, count = HEADER.unpack_from(data, len(MAGIC))
+    offset = len(MAGIC) + HEADER.size
+    now = datetime.now(timezone.utc)
+    saved = datetime.fromtimestamp(saved, timezone.utc)
+    result = list()
+    for _ in range(count):
+        name_len, divisor, phase, window_len = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        name = data[offset : offset + name_len].decode("utf-8")
+        offset += name_len
+        window = decode(memoryview(data)[offset : offset + window_len])
+        offset += window_len
+        youngest = window[0].tstamp if window else saved
+        if (now - youngest).total_seconds() > max_age:
+            continue
+        result.append(FilterSnapshot(name, divisor, phase, window))
+    log.info(
+        "Filters snapshot %s saved on %s: %d/%d entries not older than %g s",
+        path,
+        saved.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        len(result),
+        count,
+        max_age,
+    )
+    return result
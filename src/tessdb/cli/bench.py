@@ -0,0 +1,742 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import json
+import itertools
+import time
+import pickle
+import shutil
+import asyncio
+import tempfile
+import random
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from argparse import ArgumentParser, Namespace
+
+# ---------------------
+# third party libraries
+# ---------------------
+
+import aiomqtt
+from pubsub import pub
+from lica.cli import execute
+from sqlalchemy import Column, MetaData, Table, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from tessdbdao.asyncio import TessReadings, Tess4cReadings
+from tessdbapi.filter import LookAheadFilter, Sampler
+from tessdbapi.model import ReferencesInfo
+from tessdbapi.asyncio.photometer.reading import split_datetime
+
+# --------------
+# local imports
+# -------------
+
+from .. import __version__, bulk, cluster, filter as filtering
+from ..filter import ArrayFilter
+from ..constants import MessagePriority, Topic
+from ..spool import SpoolQueue
+from ..router import Route, TopicRouter
+from ..decoder import (
+    PydanticDecoder,
+    CompiledDecoder,
+    make_decoder,
+    init_worker,
+    decode_readings,
+    msgspec,
+)
+
+# ----------------
+# Module constants
+# ----------------
+
+DESCRIPTION = "TESS Database server micro-benchmarks"
+
+TSTAMP_FMT = "%Y-%m-%dT%H:%M:%SZ"
+
+# -----------------------
+# Module global variables
+# -----------------------
+
+log = logging.getLogger(__name__.split(".")[-1])
+
+# -------------------
+# Auxiliary functions
+# -------------------
+
+
+def tessw_payload(name: str, seq: int, tstamp: datetime, mag: float) -> bytes:
+    return json.dumps(
+        {
+            "name": name,
+            "seq": seq,
+            "freq": 10.23,
+            "mag": mag,
+            "tamb": 12.5,
+            "tsky": -8.25,
+            "wdBm": -65,
+            "tstamp": tstamp.strftime(TSTAMP_FMT),
+        }
+    ).encode("utf-8")
+
+
+def tess4c_payload(name: str, seq: int, tstamp: datetime, mag: float) -> bytes:
+    channel = {"freq": 10.23, "mag": mag}
+    return json.dumps(
+        {
+            "name": name,
+            "seq": seq,
+            "F1": channel,
+            "F2": channel,
+            "F3": channel,
+            "F4": channel,
+            "tamb": 12.5,
+            "tsky": -8.25,
+            "wdBm": -65,
+            "tstamp": tstamp.strftime(TSTAMP_FMT),
+        }
+    ).encode("utf-8")
+
+
+def synthetic_payloads(count: int, photometers: int, tess4c: float) -> list[bytes]:
+    """Interleaved readings from a network of photometers, one per minute each"""
+    rnd = random.Random(count)
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    names = [f"stars{i}" for i in range(1, photometers + 1)]
+    makers = {name: tess4c_payload if rnd.random() < tess4c else tessw_payload for name in names}
+    result = list()
+    for i in range(count):
+        name = names[i % photometers]
+        seq = i // photometers
+        tstamp = start + timedelta(minutes=seq)
+        mag = 0.0 if rnd.random() < 0.25 else round(rnd.uniform(15, 22), 2)
+        result.append(makers[name](name, seq, tstamp, mag))
+    return result
+
+
+def timed(func, items) -> float:
+    t0 = time.perf_counter()
+    for item in items:
+        func(item)
+    return time.perf_counter() - t0
+
+
+def cluster_worker(
+    index: int,
+    workers: int,
+    decoder: str,
+    expected: int,
+    inboxes: list[multiprocessing.Queue],
+    done: multiprocessing.Queue,
+) -> None:
+    """Cluster worker stand-in: hands off readings it does not own, decodes and filters the rest"""
+    cluster.state.workers = workers
+    cluster.state.index = index
+    dec = make_decoder(decoder)
+    inbox = inboxes[index]
+    processed = 0
+    handed = 0
+    t0 = time.perf_counter()
+    while processed < expected:
+        chunk, handoff = inbox.get()
+        readings, extra = list(), list()
+        others = dict()
+        for payload in chunk:
+            owner = index if handoff else cluster.owner(dec.header(payload)[0].lower())
+            if owner != index:
+                others.setdefault(owner, list()).append(payload)
+                continue
+            filtering.do_filter(dec.reading(payload), readings, extra)
+            processed += 1
+        for owner, payloads in others.items():
+            inboxes[owner].put((payloads, True))
+            handed += len(payloads)
+    done.put((index, processed, handed, time.perf_counter() - t0))
+
+
+async def loop_lag(interval: float, lags: list[float]) -> None:
+    """Event loop responsiveness probe, as seen by any other task such as the HTTP admin"""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t0 - interval)
+
+
+async def decode_pipeline(
+    chunks: list[list[bytes]], decoder: str, workers: int
+) -> tuple[float, list[float]]:
+    """Decodes all chunks in the event loop (workers = 0) or in a process pool"""
+    lags = list()
+    if workers == 0:
+        dec = make_decoder(decoder)
+        probe = asyncio.create_task(loop_lag(0.001, lags))
+        t0 = time.perf_counter()
+        for chunk in chunks:
+            for payload in chunk:
+                dec.reading(payload)
+            await asyncio.sleep(0)
+    else:
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue(maxsize=2 * workers)
+
+        async def collector() -> None:
+            for _ in chunks:
+                await (await pending.get())
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(decoder,),
+        ) as pool:
+            # Warm up the worker processes before timing
+            await asyncio.gather(
+                *(loop.run_in_executor(pool, decode_readings, chunks[0]) for _ in range(workers))
+            )
+            probe = asyncio.create_task(loop_lag(0.001, lags))
+            t0 = time.perf_counter()
+            task = asyncio.create_task(collector())
+            for chunk in chunks:
+                await pending.put(loop.run_in_executor(pool, decode_readings, chunk))
+            await task
+    elapsed = time.perf_counter() - t0
+    probe.cancel()
+    return elapsed, lags
+
+
+# ----------------
+# Bench subcommands
+# ----------------
+
+
+def bench_decoder(args: Namespace) -> None:
+    payloads = synthetic_payloads(args.count, args.photometers, args.tess4c)
+    decoders = [PydanticDecoder()]
+    if msgspec is not None:
+        decoders.append(CompiledDecoder())
+    else:
+        log.warning("msgspec not installed, benchmarking the pydantic decoder only")
+    reference = [dict(decoders[0].reading(p)) for p in payloads[: args.check]]
+    for decoder in decoders[1:]:
+        mismatches = sum(
+            1 for p, ref in zip(payloads, reference) if dict(decoder.reading(p)) != ref
+        )
+        log.info("%s decoder: %d/%d mismatches", decoder.name, mismatches, len(reference))
+    for decoder in decoders:
+        elapsed = min(timed(decoder.reading, payloads) for _ in range(args.repeat))
+        log.info(
+            "%-8s decoder: %d payloads in %.3f s => %.0f msg/s, %.2f us/msg",
+            decoder.name,
+            len(payloads),
+            elapsed,
+            len(payloads) / elapsed,
+            1e6 * elapsed / len(payloads),
+        )
+
+
+def bench_cluster(args: Namespace) -> None:
+    payloads = synthetic_payloads(args.count, args.photometers, args.tess4c)
+    chunks = [payloads[i : i + args.chunk] for i in range(0, len(payloads), args.chunk)]
+    dec = make_decoder(args.decoder)
+    for workers in args.workers:
+        cluster.state.workers = workers
+        expected = [0] * workers
+        for payload in payloads:
+            expected[cluster.owner(dec.header(payload)[0].lower())] += 1
+        inboxes = [multiprocessing.Queue() for _ in range(workers)]
+        done = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=cluster_worker,
+                args=(i, workers, args.decoder, expected[i], inboxes, done),
+            )
+            for i in range(workers)
+        ]
+        for proc in procs:
+            proc.start()
+        t0 = time.perf_counter()
+        # The broker shared subscription stand-in: round robin among workers
+        for i, chunk in enumerate(chunks):
+            inboxes[i % workers].put((chunk, False))
+        results = sorted(done.get() for _ in procs)
+        elapsed = time.perf_counter() - t0
+        for proc in procs:
+            proc.join()
+        for index, processed, handed, _ in results:
+            log.info("worker #%d: %d processed, %d handed off", index, processed, handed)
+        log.info(
+            "%d workers: %d payloads in %.3f s => %.0f msg/s",
+            workers,
+            len(payloads),
+            elapsed,
+            len(payloads) / elapsed,
+        )
+
+
+def bench_pool(args: Namespace) -> None:
+    payloads = synthetic_payloads(args.count, args.photometers, args.tess4c)
+    chunks = [payloads[i : i + args.chunk] for i in range(0, len(payloads), args.chunk)]
+    for workers in args.workers:
+        elapsed, lags = asyncio.run(decode_pipeline(chunks, args.decoder, workers))
+        lags.sort()
+        log.info(
+            "%d workers: %d payloads in %.3f s => %.0f msg/s, loop lag p50=%.1f ms max=%.1f ms",
+            workers,
+            len(payloads),
+            elapsed,
+            len(payloads) / elapsed,
+            1e3 * lags[len(lags) // 2] if lags else 0.0,
+            1e3 * lags[-1] if lags else 0.0,
+        )
+
+
+def bench_spool(args: Namespace) -> None:
+    dec = make_decoder(args.decoder)
+    readings = [dec.reading(p) for p in synthetic_payloads(args.count, args.photometers, 0.1)]
+    chunks = [readings[i : i + args.chunk] for i in range(0, len(readings), args.chunk)]
+    log.info("pickled readings: %.1f bytes/reading", len(pickle.dumps(readings)) / len(readings))
+    directory = tempfile.mkdtemp(prefix="tessdb-spool-", dir=args.directory)
+
+    async def run() -> tuple[float, float]:
+        queue = SpoolQueue(directory, args.segment_size * 1024 * 1024)
+        t0 = time.perf_counter()
+        for chunk in chunks:
+            queue.put_nowait((MessagePriority.MQTT_READINGS, chunk))
+        t1 = time.perf_counter()
+        log.info(
+            "spooled readings: %.1f bytes/reading",
+            queue.nbytes / len(readings),
+        )
+        for _ in chunks:
+            await queue.get()
+            queue.ack(queue.record[1])
+        t2 = time.perf_counter()
+        queue.close()
+        return t1 - t0, t2 - t1
+
+    try:
+        write, read = asyncio.run(run())
+    finally:
+        shutil.rmtree(directory)
+    for what, elapsed in (("append", write), ("read & ack", read)):
+        log.info(
+            "spool %-10s: %d readings in %.3f s => %.0f readings/s",
+            what,
+            len(readings),
+            elapsed,
+            len(readings) / elapsed,
+        )
+
+
+def bench_router(args: Namespace) -> None:
+    register = "STARS4ALL/register"
+    filters = [(register, Route.REGISTER), (args.topic, Route.READING)]
+    router = TopicRouter(filters, default=Route.READING)
+    topics = [
+        aiomqtt.Topic(
+            register if i % 1000 == 0 else f"STARS4ALL/stars{i % args.photometers}/reading"
+        )
+        for i in range(args.count)
+    ]
+
+    def matches(topic: aiomqtt.Topic) -> Route:
+        return Route.REGISTER if topic.matches(register) else Route.READING
+
+    def routes(topic: aiomqtt.Topic) -> Route:
+        return router.route(topic.value)
+
+    mismatches = sum(1 for topic in topics if matches(topic) != routes(topic))
+    log.info("router: %d/%d mismatches", mismatches, len(topics))
+    for name, func in (("Topic.matches", matches), ("TopicRouter", routes)):
+        elapsed = min(timed(func, topics) for _ in range(args.repeat))
+        log.info(
+            "%-13s: %d topics in %.3f s => %.2f us/topic",
+            name,
+            len(topics),
+            elapsed,
+            1e6 * elapsed / len(topics),
+        )
+
+
+def filter_ticks(args: Namespace) -> list[list]:
+    """
+    Readings of a photometer network, one per photometer and minute, with a saturated
+    daylight period, sequence number gaps and a few duplicated deliveries
+    """
+    rnd = random.Random(args.photometers)
+    dec = make_decoder("msgspec" if msgspec is not None else "pydantic")
+    start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    names = [f"stars{i}" for i in range(1, args.photometers + 1)]
+    makers = {
+        name: tess4c_payload if rnd.random() < args.tess4c else tessw_payload for name in names
+    }
+    seqs = {name: 0 for name in names}
+    ticks = list()
+    for minute in range(args.ticks):
+        tstamp = start + timedelta(minutes=minute)
+        daylight = (minute // 20) % 2 == 1
+        tick = list()
+        for name in names:
+            seqs[name] += 2 if rnd.random() < 0.02 else 1
+            mag = 0.0 if daylight and rnd.random() < 0.95 else round(rnd.uniform(15, 22), 2)
+            reading = dec.reading(makers[name](name, seqs[name], tstamp, mag))
+            tick.append(reading)
+            if rnd.random() < 0.01:
+                tick.append(reading)
+        ticks.append(tick)
+    return ticks
+
+
+def lookahead_filter(ticks: list[list], args: Namespace, divisors: dict[str, int]) -> list:
+    LookAheadFilter.reset()
+    Sampler.instances = dict()
+    result = list()
+    for i, tick in enumerate(ticks):
+        if i == args.flush_at:
+            for fifo in LookAheadFilter.instances.values():
+                fifo.flush()
+        readings = list()
+        extra = list()
+        for sample in tick:
+            decimator = Sampler.instance(sample.name)
+            if not decimator.configured:
+                decimator.configure(divisors.get(sample.name, 1))
+            fifo = LookAheadFilter.instance(sample.name)
+            if not fifo.configured:
+                fifo.configure(args.depth, flushing=False, buffered=True)
+            sample = decimator.push_pop(sample)
+            if sample is None:
+                continue
+            sample, extra_samples = fifo.push_pop(sample)
+            extra.extend(extra_samples)
+            if sample is not None:
+                readings.append(sample)
+        result.append((readings, extra))
+    return result
+
+
+def array_filter(ticks: list[list], args: Namespace, divisors: dict[str, int]) -> list:
+    store = ArrayFilter(args.depth)
+    result = list()
+    for i, tick in enumerate(ticks):
+        if i == args.flush_at:
+            store.flush()
+        slots = list()
+        for sample in tick:
+            slot = store.slots.get(sample.name)
+            if slot is None:
+                slot = store.add(sample.name, divisors.get(sample.name, 1), False, True)
+            slots.append(slot)
+        result.append(store.push(tick, slots))
+    return result
+
+
+def bench_filter(args: Namespace) -> None:
+    if ArrayFilter is None:
+        log.error("numpy not installed (pip install tessdb-server[array])")
+        return
+    ticks = filter_ticks(args)
+    readings = sum(len(tick) for tick in ticks)
+    divisors = {f"stars{i}": 2 + i % 5 for i in range(1, args.photometers + 1, 50)}
+    outputs = dict()
+    for name, func in (("lookahead", lookahead_filter), ("array", array_filter)):
+        elapsed = list()
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            outputs[name] = func(ticks, args, divisors)
+            elapsed.append(time.perf_counter() - t0)
+        elapsed = min(elapsed)
+        log.info(
+            "%-9s: %d readings from %d photometers in %.3f s => %.0f readings/s",
+            name,
+            readings,
+            args.photometers,
+            elapsed,
+            readings / elapsed,
+        )
+    expected = [
+        ([id(r) for r in readings], [id(r) for r in extra])
+        for readings, extra in outputs["lookahead"]
+    ]
+    actual = [
+        ([id(r) for r in readings], [id(r) for r in extra]) for readings, extra in outputs["array"]
+    ]
+    mismatches = sum(1 for e, a in zip(expected, actual) if e != a)
+    chosen = sum(len(r) + len(e) for r, e in outputs["lookahead"])
+    log.info(
+        "filter: %d/%d readings kept, %d/%d ticks mismatch",
+        chosen,
+        readings,
+        mismatches,
+        len(ticks),
+    )
+
+
+def bench_writer(args: Namespace) -> None:
+    # Imported here as it needs the DATABASE_URL environment variable.
+    # Use a scratch database, as synthetic photometers and readings are written to it.
+    from .. import dbase
+
+    dec = make_decoder(args.decoder)
+    names = [f"stars{i}" for i in range(1, args.photometers + 1)]
+    photometers = [
+        dec.register(
+            json.dumps(
+                {
+                    "name": name,
+                    "mac": f"AA:BB:CC:{i // 65536:02X}:{i // 256 % 256:02X}:{i % 256:02X}",
+                    "calib": 20.5,
+                    "firmware": "1.0",
+                }
+            ).encode("utf-8")
+        )
+        for i, name in enumerate(names, start=1)
+    ]
+    ticks = args.count // args.photometers
+    options = {
+        "log_level": "warn",
+        "buffer_size": args.buffer_size,
+        "auth_filter": False,
+        "references_ttl": 3600,
+        "max_batch_latency": 0.1,
+        "adaptive_batch": False,
+        "min_buffer_size": args.buffer_size,
+        "max_buffer_size": args.buffer_size,
+        "commit_latency_target": 1.0,
+        "buffer_increase": 0,
+        "buffer_decrease": 1.0,
+    }
+    # Readings timestamps must come after the registration and differ between runs
+    start = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(minutes=1)
+
+    async def run(lanes: int, offset: int) -> float:
+        readings = [
+            dec.reading(tessw_payload(name, seq, start + timedelta(minutes=offset + seq), 19.5))
+            for seq in range(ticks)
+            for name in names
+        ]
+        written = 0
+        done = asyncio.Event()
+
+        def on_database_commit(items: list) -> None:
+            nonlocal written
+            written += len(items)
+            if written >= len(readings):
+                done.set()
+
+        pub.subscribe(on_database_commit, Topic.DATABASE_COMMIT)
+        queue = asyncio.Queue()
+        for info in photometers:
+            queue.put_nowait((MessagePriority.REGISTER, info))
+        for i in range(0, len(readings), args.chunk):
+            queue.put_nowait((MessagePriority.MQTT_READINGS, readings[i : i + args.chunk]))
+        t0 = time.perf_counter()
+        task = asyncio.create_task(dbase.writer(dict(options, lanes=lanes), queue))
+        try:
+            await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        finally:
+            elapsed = time.perf_counter() - t0
+            task.cancel()
+            pub.unsubscribe(on_database_commit, Topic.DATABASE_COMMIT)
+        return elapsed
+
+    for i, lanes in enumerate(args.lanes):
+        elapsed = asyncio.run(run(lanes, i * ticks))
+        log.info(
+            "%d lanes: %d readings from %d photometers in %.3f s => %.0f readings/s",
+            lanes,
+            ticks * len(names),
+            len(names),
+            elapsed,
+            ticks * len(names) / elapsed,
+        )
+
+
+def standin_tables() -> MetaData:
+    """The readings tables without foreign keys, so that no dimension rows are needed"""
+    metadata = MetaData()
+    for model in (TessReadings, Tess4cReadings):
+        Table(
+            model.__tablename__,
+            metadata,
+            *(
+                Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+                for c in model.__table__.columns
+            ),
+        )
+    return metadata
+
+
+async def bulk_run(
+    url: str, name: str, batches: list[list], idempotent: bool
+) -> tuple[str, float, int]:
+    """Writes all batches to fresh stand-in tables. Returns the backend, elapsed time and rows"""
+    metadata = standin_tables()
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.drop_all)
+        await conn.run_sync(metadata.create_all)
+    backend = bulk.backend(name, url, idempotent)
+    try:
+        async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+            t0 = time.perf_counter()
+            for batch in batches:
+                await backend.write(session, batch)
+            elapsed = time.perf_counter() - t0
+    finally:
+        backend.close()
+    async with engine.begin() as conn:
+        rows = 0
+        for table in metadata.tables:
+            rows += (await conn.execute(text(f"SELECT count(*) FROM {table}"))).scalar()
+    await engine.dispose()
+    return backend.name, elapsed, rows
+
+
+def bench_bulk(args: Namespace) -> None:
+    dec = make_decoder(args.decoder)
+    readings = [
+        dec.reading(p) for p in synthetic_payloads(args.count, args.photometers, args.tess4c)
+    ]
+    items = list()
+    for reading in readings:
+        date_id, time_id = split_datetime(reading.tstamp)
+        ref = ReferencesInfo(
+            date_id=date_id,
+            time_id=time_id,
+            tess_id=int(reading.name[5:]),
+            location_id=-1,
+            observer_id=-1,
+            units_id=1,
+        )
+        items.append((reading, ref))
+    unique = len(items)
+    if args.duplicated > 0:
+        # Redelivered readings, anywhere in the stream
+        items.extend(random.sample(items, int(unique * args.duplicated)))
+        random.shuffle(items)
+    batches = [items[i : i + args.buffer_size] for i in range(0, len(items), args.buffer_size)]
+    directory = tempfile.mkdtemp(prefix="tessdb-bulk-", dir=args.directory)
+    urls = [f"sqlite+aiosqlite:///{directory}/bulk.db"]
+    if args.postgres:
+        urls.append(args.postgres)
+    try:
+        for url in urls:
+            for name, idempotent in itertools.product(("orm", "native"), (False, True)):
+                backend, elapsed, rows = asyncio.run(bulk_run(url, name, batches, idempotent))
+                log.info(
+                    "%-10s %-6s backend%s: %d/%d rows in %.3f s => %.0f rows/s",
+                    url.split(":")[0],
+                    backend,
+                    " (idempotent)" if idempotent else "",
+                    rows,
+                    unique,
+                    elapsed,
+                    len(items) / elapsed,
+                )
+    finally:
+        shutil.rmtree(directory)
+
+
+# -------------
+# Main function
+# -------------
+
+
+def cli_main(args: Namespace) -> None:
+    args.func(args)
+
+
+def add_args(parser: ArgumentParser) -> None:
+    subparser = parser.add_subparsers(dest="command", required=True)
+    p = subparser.add_parser("decoder", help="MQTT payload decoders benchmark")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of payloads")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("--tess4c", type=float, default=0.1, help="TESS4C photometers fraction")
+    p.add_argument("-r", "--repeat", type=int, default=3, help="Best of N runs")
+    p.add_argument("--check", type=int, default=1000, help="Payloads cross-checked")
+    p.set_defaults(func=bench_decoder)
+    p = subparser.add_parser("cluster", help="Cluster mode throughput with photometer handoff")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of payloads")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("--tess4c", type=float, default=0.1, help="TESS4C photometers fraction")
+    p.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4], help="Workers")
+    p.add_argument("-c", "--chunk", type=int, default=100, help="Broker delivery chunk size")
+    p.add_argument("-d", "--decoder", choices=("pydantic", "msgspec"), default="msgspec")
+    p.set_defaults(func=bench_cluster)
+    p = subparser.add_parser("pool", help="Process pool readings decoding and event loop lag")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of payloads")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("--tess4c", type=float, default=0.1, help="TESS4C photometers fraction")
+    p.add_argument("-w", "--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="Workers")
+    p.add_argument("-c", "--chunk", type=int, default=100, help="Readings decoded per batch")
+    p.add_argument("-d", "--decoder", choices=("pydantic", "msgspec"), default="msgspec")
+    p.set_defaults(func=bench_pool)
+    p = subparser.add_parser("spool", help="Durable database spool throughput")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of readings")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("-c", "--chunk", type=int, default=100, help="Readings per spooled batch")
+    p.add_argument("-s", "--segment-size", type=int, default=64, help="Segment size in MiB")
+    p.add_argument("--directory", default=None, help="Parent directory for the test spool")
+    p.add_argument("-d", "--decoder", choices=("pydantic", "msgspec"), default="msgspec")
+    p.set_defaults(func=bench_spool)
+    p = subparser.add_parser("router", help="MQTT topic routing")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of messages")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("-t", "--topic", default="STARS4ALL/+/reading", help="Readings topic filter")
+    p.add_argument("-r", "--repeat", type=int, default=3, help="Best of N runs")
+    p.set_defaults(func=bench_router)
+    p = subparser.add_parser("filter", help="Lookahead vs array photometer filter engines")
+    p.add_argument("-p", "--photometers", type=int, default=5000, help="Number of photometers")
+    p.add_argument("-t", "--ticks", type=int, default=60, help="Readings per photometer")
+    p.add_argument("--tess4c", type=float, default=0.1, help="TESS4C photometers fraction")
+    p.add_argument("--depth", type=int, default=7, help="Filter depth")
+    p.add_argument("--flush-at", type=int, default=50, help="Tick where filters get flushed")
+    p.add_argument("-r", "--repeat", type=int, default=3, help="Best of N runs")
+    p.set_defaults(func=bench_filter)
+    p = subparser.add_parser("writer", help="Database writer lanes throughput (scratch database!)")
+    p.add_argument("-n", "--count", type=int, default=20000, help="Number of readings")
+    p.add_argument("-p", "--photometers", type=int, default=100, help="Number of photometers")
+    p.add_argument("-l", "--lanes", type=int, nargs="+", default=[1, 2, 4], help="Writer lanes")
+    p.add_argument("-b", "--buffer-size", type=int, default=100, help="Write buffer size")
+    p.add_argument("-c", "--chunk", type=int, default=100, help="Readings per queued batch")
+    p.add_argument("-t", "--timeout", type=float, default=600, help="Run timeout in seconds")
+    p.add_argument("-d", "--decoder", choices=("pydantic", "msgspec"), default="msgspec")
+    p.set_defaults(func=bench_writer)
+    p = subparser.add_parser("bulk", help="Bulk insert backends on stand-in readings tables")
+    p.add_argument("-n", "--count", type=int, default=100000, help="Number of readings")
+    p.add_argument("-p", "--photometers", type=int, default=500, help="Number of photometers")
+    p.add_argument("--tess4c", type=float, default=0.1, help="TESS4C photometers fraction")
+    p.add_argument("-b", "--buffer-size", type=int, default=500, help="Write buffer size")
+    p.add_argument("--duplicated", type=float, default=0.0, help="Readings fraction written twice")
+    p.add_argument("--directory", default=None, help="Parent directory for the SQLite database")
+    p.add_argument(
+        "--postgres",
+        default=None,
+        help="Scratch PostgreSQL database URL (postgresql+asyncpg://...), if any",
+    )
+    p.add_argument("-d", "--decoder", choices=("pydantic", "msgspec"), default="msgspec")
+    p.set_defaults(func=bench_bulk)
+
+
+def main():
+    """The main entry point specified by pyproject.toml"""
+    execute(
+        main_func=cli_main,
+        add_args_func=add_args,
+        name=__name__,
+        version=__version__,
+        description=DESCRIPTION,
+    )
+
+
+if __name__ == "__main__":
+    main()
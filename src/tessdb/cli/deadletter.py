@@ -0,0 +1,160 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import logging
+from argparse import ArgumentParser, Namespace
+
+# ---------------------
+# third party libraries
+# ---------------------
+
+from pubsub import pub
+from lica.asyncio.cli import execute
+from lica.validators import vfile
+from tessdbapi.asyncio.photometer.reading import stats as read_stats
+
+# --------------
+# local imports
+# -------------
+
+from .. import __version__, bulk, dbase, deadletter, server
+from ..constants import Topic
+
+# ----------------
+# Module constants
+# ----------------
+
+DESCRIPTION = "List or write again the readings in a TESS database server dead letter file"
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(__name__.split(".")[-1])
+committed = 0
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def on_database_commit(items: list) -> None:
+    global committed
+    committed += len(items)
+
+
+async def replay_file(session: dbase.Session, path: str) -> int:
+    """Writes the readings of a dead letter file being replayed and removes it"""
+    total = 0
+    for letter in deadletter.read(path):
+        batch = dbase.WriteBuffer()
+        for reading in letter.readings:
+            batch.append(reading)
+        total += len(batch)
+        await dbase.flush_readings(session, batch, dbase.state.auth_filter, timed=False)
+    os.remove(path)
+    return total
+
+
+async def replay(path: str, options: dict) -> int:
+    """Writes the dead lettered readings again. Returns the number of readings"""
+    # Readings failing again are dead lettered to a new file, if configured so
+    replaying = f"{path}.replaying"
+    dbase.state.update(options)
+    dbase.state.backend = bulk.backend(
+        dbase.state.bulk_insert, dbase.state.url, dbase.state.idempotent_writes
+    )
+    total = 0
+    try:
+        async with dbase.Session() as session:
+            if os.path.exists(replaying):
+                # Left by an interrupted replay, its readings are older
+                log.warning("Writing first the readings of an interrupted replay in %s", replaying)
+                total += await replay_file(session, replaying)
+            if os.path.exists(path):
+                os.replace(path, replaying)
+                log.info("%s renamed to %s", path, replaying)
+                total += await replay_file(session, replaying)
+    finally:
+        dbase.state.backend.close()
+        await dbase.engine.dispose()
+    return total
+
+
+# -------------
+# Main function
+# -------------
+
+
+async def cli_main(args: Namespace) -> None:
+    if args.list:
+        total = 0
+        for letter in deadletter.read(args.file):
+            total += len(letter.readings)
+            log.info(
+                "%s: %d readings by %s",
+                letter.tstamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                len(letter.readings),
+                letter.reason,
+            )
+        log.info("%d dead lettered readings in %s", total, args.file)
+        return
+    if args.config is None:
+        log.error("A configuration file is needed to write the readings")
+        return
+    options = server.load_config(args.config)["dbase"]
+    pub.subscribe(on_database_commit, Topic.DATABASE_COMMIT)
+    total = await replay(args.file, options)
+    log.info(
+        "Written %d/%d dead lettered readings, %d dead lettered again",
+        committed,
+        total,
+        dbase.retry_stats.num_dead_lettered,
+    )
+    read_stats.show()
+
+
+def add_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=vfile,
+        default=None,
+        metavar="<config file>",
+        help="detailed .toml configuration file, needed to write the readings",
+    )
+    parser.add_argument(
+        "file",
+        type=vfile,
+        metavar="<dead letter file>",
+        help="dead letter file, usually the [dbase] dead_letter_path",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="only list the dead lettered batches",
+    )
+
+
+def main():
+    """The main entry point specified by pyproject.toml"""
+    execute(
+        main_func=cli_main,
+        add_args_func=add_args,
+        name=__name__,
+        version=__version__,
+        description=DESCRIPTION,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import time
+import asyncio
+import logging
+import resource
+from contextlib import suppress
+from dataclasses import dataclass, field
+from argparse import ArgumentParser, Namespace
+
+# ---------------------
+# third party libraries
+# ---------------------
+
+import aiomqtt
+from pubsub import pub
+from lica.asyncio.cli import execute
+from lica.validators import vfile
+
+# --------------
+# local imports
+# -------------
+
+from .. import __version__, mqtt, server
+from ..capture import Captured, read_capture
+from ..constants import Topic
+from ..decoder import make_decoder
+
+# ----------------
+# Module constants
+# ----------------
+
+DESCRIPTION = "Replay captured MQTT traffic through the TESS database server pipeline"
+
+MAX_BUFFERED = 1000  # messages reported as buffered by the fake client
+
+# -------
+# Classes
+# -------
+
+
+@dataclass(slots=True)
+class State:
+    records: list[Captured] = field(default_factory=list)
+    speed: float = 1.0  # 0 = as fast as possible
+    injected: dict[tuple[str, int], float] = field(default_factory=dict)
+    latencies: list[float] = field(default_factory=list)
+    first: float = 0.0
+    last: float = 0.0
+    done: asyncio.Event = None
+
+
+class ReplayClient:
+    """Stands for aiomqtt.Client, delivering the captured messages at their original pace"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.messages = self
+        self._index = 0
+        self._ready = 0  # records before this one are already due
+        self._start = 0.0
+        self._decoder = make_decoder("msgspec")
+
+    async def __aenter__(self) -> "ReplayClient":
+        return self
+
+    async def __aexit__(self, *args) -> bool:
+        return False
+
+    async def subscribe(self, topic: str, qos: int = 0) -> None:
+        pass
+
+    async def publish(self, topic: str, payload: bytes, qos: int = 0) -> None:
+        pass
+
+    def __aiter__(self) -> "ReplayClient":
+        return self
+
+    def _due(self, record: Captured) -> float:
+        if state.speed == 0:
+            return self._start
+        return self._start + (record.tstamp - state.records[0].tstamp) / state.speed
+
+    def __len__(self) -> int:
+        """Messages already due, as if buffered by the client (up to MAX_BUFFERED)"""
+        if self._index == 0:
+            return 0  # Not started yet
+        now = time.perf_counter()
+        end = min(len(state.records), self._index + MAX_BUFFERED)
+        # Due records stay due, so each record is checked once until due
+        self._ready = max(self._ready, self._index)
+        while self._ready < end and self._due(state.records[self._ready]) <= now:
+            self._ready += 1
+        return self._ready - self._index
+
+    async def __anext__(self) -> aiomqtt.Message:
+        if self._index == 0:
+            self._start = state.first = time.perf_counter()
+        if self._index >= len(state.records):
+            state.done.set()
+            await asyncio.Event().wait()  # No more messages, ever
+        record = state.records[self._index]
+        delay = self._due(record) - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif self._index % 100 == 0:
+            await asyncio.sleep(0)  # let the other tasks run at maximum speed
+        self._index += 1
+        state.last = time.perf_counter()
+        with suppress(Exception):
+            name, seq, _ = self._decoder.header(record.payload)
+            if seq is not None:
+                state.injected[(name.lower(), seq)] = state.last
+        return aiomqtt.Message(record.topic, record.payload, 2, record.retain, self._index, None)
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(__name__.split(".")[-1])
+state = State()
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def on_database_commit(items: list) -> None:
+    now = time.perf_counter()
+    for item in items:
+        t0 = state.injected.pop((item.name, item.sequence_number), None)
+        if t0 is not None:
+            state.latencies.append(now - t0)
+
+
+def percentile(values: list[float], p: float) -> float:
+    return values[min(len(values) - 1, int(p * len(values)))] if values else 0.0
+
+
+def report() -> None:
+    elapsed = max(state.last - state.first, 1e-9)
+    latencies = sorted(state.latencies)
+    log.info(
+        "Replayed %d messages in %.3f s => %.0f msg/s",
+        len(state.records),
+        elapsed,
+        len(state.records) / elapsed,
+    )
+    log.info(
+        "Committed %d readings. End to end latency p50=%.1f ms p90=%.1f ms p99=%.1f ms max=%.1f ms",
+        len(latencies),
+        1e3 * percentile(latencies, 0.50),
+        1e3 * percentile(latencies, 0.90),
+        1e3 * percentile(latencies, 0.99),
+        1e3 * (latencies[-1] if latencies else 0.0),
+    )
+    log.info("Peak RSS: %.1f MiB", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+# -------------
+# Main function
+# -------------
+
+
+async def cli_main(args: Namespace) -> None:
+    options = server.load_config(args.config)
+    if options.get("cluster", {}).get("workers", 1) > 1:
+        log.error("Replay needs a configuration with [cluster] workers = 1")
+        return
+    state.records = list(read_capture(args.capture))
+    state.speed = args.speed
+    state.done = asyncio.Event()
+    log.info("Loaded %d captured messages", len(state.records))
+    mqtt.client_class = ReplayClient
+    pub.subscribe(on_database_commit, Topic.DATABASE_COMMIT)
+    task = asyncio.create_task(
+        server.cli_main(Namespace(config=args.config, verbose=args.verbose, worker=None))
+    )
+    await state.done.wait()
+    # Wait for the filter and database writer to settle down
+    while True:
+        committed = len(state.latencies)
+        await asyncio.sleep(args.idle)
+        if len(state.latencies) == committed:
+            break
+    task.cancel()
+    with suppress(asyncio.CancelledError):
+        await task
+    report()
+
+
+def add_args(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "-c",
+        "--config",
+        type=vfile,
+        required=True,
+        metavar="<config file>",
+        help="detailed .toml configuration file",
+    )
+    parser.add_argument(
+        "capture",
+        type=vfile,
+        nargs="+",
+        metavar="<capture file>",
+        help="capture files, replayed in the given order",
+    )
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1.0,
+        metavar="<N>",
+        help="replay speed factor, 0 = as fast as possible (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--idle",
+        type=float,
+        default=3.0,
+        metavar="<s>",
+        help="seconds without commits to consider the pipeline drained (default: %(default)s)",
+    )
+
+
+def main():
+    """The main entry point specified by pyproject.toml"""
+    execute(
+        main_func=cli_main,
+        add_args_func=add_args,
+        name=__name__,
+        version=__version__,
+        description=DESCRIPTION,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import sys
+import zlib
+import signal
+import asyncio
+import logging
+from typing import Any, Optional
+from dataclasses import dataclass
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+
+# ---------
+# Constants
+# ---------
+
+RESTART_DELAY = 5  # seconds before restarting a dead worker
+FORWARDED_SIGNALS = (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2)
+
+# -------
+# Classes
+# -------
+
+
+@dataclass(slots=True)
+class State:
+    workers: int = 1
+    index: int = 0
+    group: str = "tessdb"
+    handoff_prefix: str = "tessdb/handoff"
+
+    def update(self, options: dict[str, Any], index: Optional[int]) -> None:
+        """Updates the state. Not reloadable"""
+        self.workers = options.get("workers", 1)
+        self.group = options.get("group", "tessdb")
+        self.handoff_prefix = options.get("handoff_prefix", "tessdb/handoff")
+        self.index = index if index is not None else 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 1
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.SERVER.value)
+state = State()
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def owner(name: str) -> int:
+    """Stable photometer to worker assignment. Keeps every photometer filter in one worker"""
+    return zlib.crc32(name.encode("utf-8")) % state.workers
+
+
+def is_owned(name: str) -> bool:
+    return owner(name) == state.index
+
+
+def partition(name: str, partitions: int) -> int:
+    """
+    Stable photometer to filter partition assignment within a worker.
+    Skips the hash part used by owner(), so partitions stay balanced in cluster mode.
+    """
+    return (zlib.crc32(name.encode("utf-8")) // state.workers) % partitions
+
+
+def shared(topic: str) -> str:
+    """MQTT v5 shared subscription topic, load balanced by the broker among the workers"""
+    return f"$share/{state.group}/{topic}"
+
+
+def handoff_topic(index: int) -> str:
+    """Private topic where other workers republish the readings owned by worker #index"""
+    return f"{state.handoff_prefix}/{index}/reading"
+
+
+# --------------------------
+# The cluster supervisor task
+# --------------------------
+
+
+async def worker(index: int, argv: list[str], procs: dict[int, asyncio.subprocess.Process]) -> None:
+    """Runs and restarts a worker process"""
+    while True:
+        proc = await asyncio.create_subprocess_exec(sys.executable, *argv, "--worker", str(index))
+        procs[index] = proc
+        log.info("Started worker #%d (pid %d)", index, proc.pid)
+        try:
+            code = await proc.wait()
+        except asyncio.CancelledError:
+            if proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
+            raise
+        log.error("Worker #%d exited with code %d. Restarting in %d s", index, code, RESTART_DELAY)
+        await asyncio.sleep(RESTART_DELAY)
+
+
+async def supervisor(workers: int) -> None:
+    """
+    Launches the worker processes with the same command line plus their worker index
+    and forwards them the pause, resume and reload signals.
+    """
+    procs = dict()
+    loop = asyncio.get_running_loop()
+
+    def forward(signum: int) -> None:
+        log.info("Forwarding signal %s to %d workers", signal.Signals(signum).name, len(procs))
+        for proc in procs.values():
+            if proc.returncode is None:
+                proc.send_signal(signum)
+
+    for signum in FORWARDED_SIGNALS:
+        loop.add_signal_handler(signum, forward, signum)
+    log.info("Starting cluster supervisor with %d workers", workers)
+    async with asyncio.TaskGroup() as tg:
+        for i in range(workers):
+            tg.create_task(worker(i, sys.argv, procs))
@@ -0,0 +1,221 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import zlib
+import struct
+import logging
+from array import array
+from datetime import datetime, timezone
+from typing import Iterator, Union
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbdao import TimestampSource
+from tessdbapi.model import ReadingInfo, ReadingInfo1c, ReadingInfo4c
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+from .spool import EPOCH, ONE_US, FLOATS_1C, FLOATS_4C
+
+# ---------
+# Constants
+# ---------
+
+MAGIC = b"TESSCOL1"
+# Chunk header: rows, compressed payload length, payload crc32
+CHUNK = struct.Struct("<III")
+# Column header: column length
+COLUMN = struct.Struct("<I")
+
+# Float columns, the TESS4C ones cover the TESS-W ones
+FLOATS = FLOATS_4C
+NULL = -1  # dictionary index of a missing hash
+
+# -------
+# Classes
+# -------
+
+
+class ColumnarWriter:
+    """
+    Append only file of readings chunks. Each chunk holds up to chunk_rows readings,
+    stored column by column (dictionary encoded names & hashes, fixed width numbers
+    with presence masks) and zlib compressed, so it takes a fraction of the disk space
+    and is loaded back in a single read & decode.
+    """
+
+    def __init__(self, path: str, chunk_rows: int) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.rows = 0  # rows written to the file
+        self.nbytes = len(MAGIC)
+        self._pending: list[ReadingInfo] = list()
+        self._fd = open(path, "wb")
+        self._fd.write(MAGIC)
+
+    def write(self, readings: list[ReadingInfo]) -> None:
+        self._pending.extend(readings)
+        while len(self._pending) >= self.chunk_rows:
+            self._write_chunk(self._pending[: self.chunk_rows])
+            del self._pending[: self.chunk_rows]
+
+    def _write_chunk(self, readings: list[ReadingInfo]) -> None:
+        payload = zlib.compress(encode(readings), 1)
+        self._fd.write(CHUNK.pack(len(readings), len(payload), zlib.crc32(payload)))
+        self._fd.write(payload)
+        self.rows += len(readings)
+        self.nbytes += CHUNK.size + len(payload)
+
+    def close(self) -> None:
+        """Writes the last, partial chunk"""
+        if self._pending:
+            self._write_chunk(self._pending)
+            self._pending = list()
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+        self._fd.close()
+
+    def __len__(self) -> int:
+        """Readings written, including those waiting for a full chunk"""
+        return self.rows + len(self._pending)
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.DBASE.value)
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def _utc(tstamp: datetime) -> datetime:
+    return tstamp if tstamp.tzinfo else tstamp.replace(tzinfo=timezone.utc)
+
+
+def _dictionary(values: list) -> tuple[bytes, array]:
+    """Dictionary encoding of a string column, None values as NULL"""
+    words: dict[str, int] = dict()
+    index = array("i", (NULL if v is None else words.setdefault(v, len(words)) for v in values))
+    return "\n".join(words).encode("utf-8"), index
+
+
+def encode(readings: list[ReadingInfo]) -> bytes:
+    """Packs readings column by column"""
+    names, name_index = _dictionary([r.name for r in readings])
+    hashes, hash_index = _dictionary([r.hash for r in readings])
+    columns = [
+        array("B", (4 if isinstance(r, ReadingInfo4c) else 1 for r in readings)).tobytes(),
+        array("B", (r.tstamp_src == TimestampSource.PUBLISHER for r in readings)).tobytes(),
+        array("q", ((_utc(r.tstamp) - EPOCH) // ONE_US for r in readings)).tobytes(),
+        array("q", (r.sequence_number for r in readings)).tobytes(),
+        names,
+        name_index.tobytes(),
+        hashes,
+        hash_index.tobytes(),
+        array("B", (r.signal_strength is not None for r in readings)).tobytes(),
+        array("i", (r.signal_strength or 0 for r in readings)).tobytes(),
+    ]
+    for field in FLOATS:
+        values = [getattr(r, field, None) for r in readings]
+        columns.append(array("B", (v is not None for v in values)).tobytes())
+        columns.append(array("d", (0.0 if v is None else v for v in values)).tobytes())
+    return b"".join(COLUMN.pack(len(column)) + column for column in columns)
+
+
+def decode(payload: bytes, rows: int) -> list[Union[ReadingInfo1c, ReadingInfo4c]]:
+    """Unpacks the readings packed by encode()"""
+    columns = list()
+    offset = 0
+    while offset < len(payload):
+        (length,) = COLUMN.unpack_from(payload, offset)
+        offset += COLUMN.size
+        columns.append(payload[offset : offset + length])
+        offset += length
+    channels = array("B", columns[0])
+    publisher = array("B", columns[1])
+    tstamps = array("q", columns[2])
+    seqs = array("q", columns[3])
+    names = columns[4].decode("utf-8").split("\n")
+    name_index = array("i", columns[5])
+    hashes = columns[6].decode("utf-8").split("\n")
+    hash_index = array("i", columns[7])
+    has_signal = array("B", columns[8])
+    signals = array("i", columns[9])
+    floats = [
+        (field, array("B", columns[10 + 2 * k]), array("d", columns[11 + 2 * k]))
+        for k, field in enumerate(FLOATS)
+    ]
+    result = list()
+    for i in range(rows):
+        four = channels[i] == 4
+        fields = FLOATS_4C if four else FLOATS_1C
+        # Missing fields are None, not the model defaults
+        kwargs = dict.fromkeys(fields)
+        kwargs.update(
+            (field, values[i])
+            for field, present, values in floats
+            if present[i] and field in fields
+        )
+        kwargs["name"] = names[name_index[i]]
+        kwargs["hash"] = hashes[hash_index[i]] if hash_index[i] != NULL else None
+        kwargs["signal_strength"] = signals[i] if has_signal[i] else None
+        kwargs["tstamp"] = EPOCH + tstamps[i] * ONE_US
+        kwargs["tstamp_src"] = (
+            TimestampSource.PUBLISHER if publisher[i] else TimestampSource.SUBSCRIBER
+        )
+        kwargs["sequence_number"] = seqs[i]
+        cls = ReadingInfo4c if four else ReadingInfo1c
+        result.append(cls(**kwargs))
+    return result
+
+
+def read_chunks(path: str) -> Iterator[list[ReadingInfo]]:
+    """Readings chunks of a columnar file, in order. A torn chunk at the end is skipped"""
+    with open(path, "rb") as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a columnar readings file")
+        while True:
+            header = fd.read(CHUNK.size)
+            if not header:
+                return
+            if len(header) < CHUNK.size:
+                log.warning("%s: truncated chunk header", path)
+                return
+            rows, length, crc = CHUNK.unpack(header)
+            payload = fd.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                log.warning("%s: truncated or corrupt chunk", path)
+                return
+            yield decode(zlib.decompress(payload), rows)
+
+
+def count(path: str) -> int:
+    """Readings in a columnar file, reading only the chunk headers"""
+    rows = 0
+    with open(path, "rb") as fd:
+        if fd.read(len(MAGIC)) != MAGIC:
+            return 0
+        while len(header := fd.read(CHUNK.size)) == CHUNK.size:
+            n, length, _ = CHUNK.unpack(header)
+            fd.seek(length, os.SEEK_CUR)
+            rows += n
+    return rows
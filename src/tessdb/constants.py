@@ -22,6 +22,23 @@ class Topic(StrEnum):
     SERVER_FLUSH = "server.flush"
     PHOT_LOG_LEVEL = "server.plog_level"
     DATABASE_FLUSH = "database.flush"
+    DATABASE_COMMIT = "database.commit"
+    DATABASE_INVALIDATE = "database.invalidate"
+    FILTER_CHECKPOINT = "filter.checkpoint"
+
+
+class OverflowPolicy(StrEnum):
+    """What a bounded queue does with readings above its high watermark"""
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    FAIR = "fair"  # drop readings of the photometers with more than a fair share queued
+    SPILL = "spill"  # spill readings to disk until the queue drains below its low watermark
+
+
+class FilterEngine(StrEnum):
+    """Implementation of the per photometer sampler and look ahead filter"""
+    LOOKAHEAD = "lookahead"  # tessdbapi Sampler & LookAheadFilter objects
+    ARRAY = "array"  # all photometers in numpy arrays, filtered in batches
 
 
 DEFAULT_FILTER = "UV/IR-740"
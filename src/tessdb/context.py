@@ -0,0 +1,135 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import logging
+from array import array
+from typing import Iterable, Optional
+from dataclasses import dataclass, field
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+# --------------
+# local imports
+# -------------
+
+from .lookahead import TrackedFilter
+
+# ------------------
+# Additional Classes
+# ------------------
+
+
+@dataclass(slots=True)
+class SequenceWindow:
+    """
+    Sequence numbers recently seen from a photometer, as a bitset relative to the highest one,
+    plus the readings hash (when present) per slot, so a reused sequence number after a
+    photometer restart is not taken as a duplicate. Sequence numbers outside the window
+    restart it. Memory is bounded by the window size.
+    """
+
+    size: int
+    top: Optional[int] = None
+    bits: int = 0
+    hashes: Optional[array] = None  # 0 = no hash, otherwise 1 + packed hash chars
+
+    def _fingerprint(self, hsh: Optional[str]) -> int:
+        value = 0 if hsh is None else 1 + int.from_bytes(hsh.encode("utf-8")[:3], "little")
+        if self.hashes is None and value:
+            self.hashes = array("I", bytes(4 * self.size))
+        return value
+
+    def seen(self, seq: int, hsh: Optional[str]) -> bool:
+        """Records the sequence number. Returns True if it is a duplicate within the window"""
+        fingerprint = self._fingerprint(hsh)
+        slot = seq % self.size
+        delta = seq - self.top if self.top is not None else self.size
+        if delta >= self.size or delta <= -self.size:
+            # First reading, long gap or sequence number reset
+            self.top = seq
+            self.bits = 1
+        elif delta > 0:
+            self.top = seq
+            self.bits = ((self.bits << delta) | 1) & ((1 << self.size) - 1)
+        elif self.bits & (1 << -delta):
+            if self.hashes is None or self.hashes[slot] == fingerprint:
+                return True
+        else:
+            self.bits |= 1 << -delta
+        if self.hashes is not None:
+            self.hashes[slot] = fingerprint
+        return False
+
+
+@dataclass(slots=True)
+class PhotometerContext:
+    """Per photometer objects and decisions needed in the MQTT -> filter hot path"""
+
+    name: str
+    log: logging.Logger
+    discarded_by: Optional[str] = None  # None, "whitelist" or "blacklist"
+    tracked: Optional[TrackedFilter] = None  # lazily configured by the filter task
+    window: Optional[SequenceWindow] = None  # lazily created by the MQTT task
+    num_readings: int = 0
+    num_filtered: int = 0
+
+
+@dataclass(slots=True)
+class State:
+    white_list: set[str] = field(default_factory=set)
+    black_list: set[str] = field(default_factory=set)
+
+    def update(self, white_list: Iterable[str], black_list: Iterable[str]) -> None:
+        """Updates the mutable state"""
+        self.white_list = set(white_list)
+        self.black_list = set(black_list)
+
+
+# ----------------
+# Global variables
+# ----------------
+
+state = State()
+contexts: dict[str, PhotometerContext] = dict()
+
+# -----------------
+# Auxiliar functions
+# ------------------
+
+
+def configure(white_list: Iterable[str], black_list: Iterable[str]) -> None:
+    """Sets the white & black lists. Cached decisions are no longer valid"""
+    state.update(white_list, black_list)
+    invalidate()
+
+
+def invalidate() -> None:
+    contexts.clear()
+
+
+def _discarded_by(name: str) -> Optional[str]:
+    if state.white_list and name not in state.white_list:
+        return "whitelist"
+    if state.black_list and name in state.black_list:
+        return "blacklist"
+    return None
+
+
+def get(name: str) -> PhotometerContext:
+    """Returns the cached photometer context, creating it on first use"""
+    ctx = contexts.get(name)
+    if ctx is None:
+        ctx = PhotometerContext(
+            name=name, log=logging.getLogger(name), discarded_by=_discarded_by(name)
+        )
+        contexts[name] = ctx
+    return ctx
@@ -9,12 +9,19 @@
 # Standard Python imports
 # -----------------------
 
+import os
+import glob
+import time
+import random
 import asyncio
 import logging
 import itertools
+from bisect import bisect_left
+from collections import deque
+from contextlib import AsyncExitStack, suppress
 
-from typing import Any, Sequence
-from dataclasses import dataclass
+from typing import Any, Iterator, Optional, Sequence, Union
+from dataclasses import dataclass, field
 
 # ---------------------------
 # Third party library imports
@@ -23,28 +30,35 @@ from dataclasses import dataclass
 import decouple
 from pubsub import pub
 
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine, async_sessionmaker
 from lica.sqlalchemy.asyncio.dbase import create_engine_sessionclass
-from tessdbdao import ReadingSource
-from tessdbapi.model import ReadingInfo
+from tessdbdao import ReadingSource, ValidState
+from tessdbdao.asyncio import Location, NameMapping, Tess
+from tessdbapi.model import PhotometerInfo, ReadingInfo, ReferencesInfo
 from tessdbapi.asyncio.photometer.register import photometer_register, stats as reg_stats
-from tessdbapi.asyncio.photometer.reading import (
-    resolve_references,
-    photometer_resolved_batch_write,
-    stats as read_stats,
-)
+from tessdbapi.asyncio.photometer.reading import stats as read_stats
 
 # --------------
 # local imports
 # -------------
 
-from . import logger
+from . import bulk, cluster, columnar, deadletter, logger, references
 from .constants import MessagePriority, Topic
+from .queues import LaneQueue
+from .spool import SpoolQueue, Position
 
 # ---------
 # Constants
 # ---------
 
 PAUSE_CYCLE = 60  # counts in 1 count/seconds
+LANE_QUEUE_SIZE = 8  # readings batches queued per writer lane
+
+# Write buffer histograms bucket upper bounds
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)  # readings
+AGE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 600)  # seconds
 
 # -------
 # Classes
@@ -60,6 +74,20 @@ class State:
     counter: itertools.cycle = itertools.cycle(range(PAUSE_CYCLE))
     buffer_size: int = 1
     auth_filter: bool = False
+    references_ttl: float = 0.0
+    max_batch_latency: float = 0.0
+    adaptive_batch: bool = False
+    lanes: int = 1
+    bulk_insert: str = "orm"
+    idempotent_writes: bool = False
+    backend: Optional[bulk.ReadingsBackend] = None
+    write_retries: int = 0
+    retry_backoff: float = 1.0
+    max_backoff: float = 60.0
+    dead_letter_path: str = ""
+    pause_spill_dir: str = ""
+    catchup_batch_size: int = 5000
+    disposed: bool = False  # connections closed while paused
 
     def update(self, options: dict[str, Any]) -> None:
         """Updates the mutable state"""
@@ -67,9 +95,25 @@ class State:
         log.setLevel(self.log_level)
         self.buffer_size = options["buffer_size"]
         self.auth_filter = options["auth_filter"]
+        # Options added after the first release default to their former behaviour
+        self.references_ttl = options.get("references_ttl", 0)
+        self.max_batch_latency = options.get("max_batch_latency", 0)
+        self.adaptive_batch = options.get("adaptive_batch", False)
+        self.lanes = options.get("lanes", 1)
+        self.bulk_insert = options.get("bulk_insert", "orm")
+        self.idempotent_writes = options.get("idempotent_writes", False)
+        self.write_retries = options.get("write_retries", 0)
+        self.retry_backoff = options.get("retry_backoff", 1.0)
+        self.max_backoff = options.get("max_backoff", 60.0)
+        self.dead_letter_path = options.get("dead_letter_path", "")
+        self.pause_spill_dir = options.get("pause_spill_dir", "")
+        self.catchup_batch_size = options.get("catchup_batch_size", 5000)
+        references.cache.ttl = self.references_ttl
+        controller.configure(options)
 
     def pause(self) -> None:
         self.paused = True
+        self.disposed = False
         self.counter = itertools.cycle(range(60))
 
     def resume(self) -> None:
@@ -77,11 +121,240 @@ class State:
         self.resumed = True
 
 
+@dataclass(slots=True)
+class WriteBuffer:
+    """Readings waiting to be resolved and written at once"""
+
+    readings: list[ReadingInfo] = field(default_factory=list)
+    since: float = 0.0  # time.monotonic() when the oldest reading arrived
+
+    def __len__(self) -> int:
+        return len(self.readings)
+
+    def append(self, item: ReadingInfo) -> None:
+        if not self.readings:
+            self.since = time.monotonic()
+        self.readings.append(item)
+
+    def clear(self) -> None:
+        self.readings = list()
+
+
+@dataclass(slots=True)
+class PendingRecord:
+    """Spool record whose readings were split among writer lanes"""
+
+    end: Position
+    parts: int  # lanes still to commit their part of the record
+
+
+@dataclass(slots=True)
+class Lane:
+    index: int
+    queue: asyncio.Queue
+    batch: WriteBuffer = field(default_factory=WriteBuffer)
+    records: list[PendingRecord] = field(default_factory=list)  # fully buffered, not committed
+
+
+@dataclass(slots=True)
+class BatchController:
+    """
+    Write buffer size by additive increase / multiplicative decrease (AIMD) of commit latency.
+    The size grows after each full buffer committed under the target latency and it is cut
+    when a commit takes longer or fails, always within [min_size, max_size].
+    """
+
+    size: int = 0  # 0 = not yet configured
+    min_size: int = 1
+    max_size: int = 1
+    target: float = 1.0  # seconds
+    increase: int = 1
+    decrease: float = 0.5
+    last_latency: float = 0.0
+    num_increased: int = 0
+    num_decreased: int = 0
+    num_failed: int = 0
+
+    def configure(self, options: dict[str, Any]) -> None:
+        self.min_size = options.get("min_buffer_size", 10)
+        self.max_size = options.get("max_buffer_size", 2000)
+        self.target = options.get("commit_latency_target", 1.0)
+        self.increase = options.get("buffer_increase", 50)
+        self.decrease = options.get("buffer_decrease", 0.5)
+        size = self.size or options["buffer_size"]
+        self.size = min(max(size, self.min_size), self.max_size)
+
+    def update(self, latency: float, ok: bool, full: bool) -> None:
+        self.last_latency = latency
+        size = self.size
+        if not ok or latency > self.target:
+            self.size = max(self.min_size, int(self.size * self.decrease))
+            self.num_decreased += 1
+            if not ok:
+                self.num_failed += 1
+        elif full:
+            # Partial buffers written by max_batch_latency do not need a larger size
+            self.size = min(self.max_size, self.size + self.increase)
+            self.num_increased += 1
+        if self.size != size:
+            log.debug(
+                "Write buffer size %d -> %d (commit latency %.3f s%s)",
+                size,
+                self.size,
+                latency,
+                "" if ok else ", failed",
+            )
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_increased = 0
+        self.num_decreased = 0
+        self.num_failed = 0
+
+    def show(self) -> None:
+        log.info(
+            "DBASE Write Buffer Controller [Size, Last Latency, Increased, Decreased, Failed] = %s",
+            [
+                self.size,
+                round(self.last_latency, 3),
+                self.num_increased,
+                self.num_decreased,
+                self.num_failed,
+            ],
+        )
+
+
+@dataclass(slots=True)
+class BatchStats:
+    num_size_flushes: int = 0
+    num_time_flushes: int = 0
+    num_inserted: int = 0  # readings
+    num_skipped: int = 0  # readings already in the database
+    # Last bucket counts the values above the last bucket bound
+    size_histogram: list[int] = field(default_factory=lambda: [0] * (len(SIZE_BUCKETS) + 1))
+    age_histogram: list[int] = field(default_factory=lambda: [0] * (len(AGE_BUCKETS) + 1))
+
+    def add(self, size: int, age: float, timed: bool) -> None:
+        if timed:
+            self.num_time_flushes += 1
+        else:
+            self.num_size_flushes += 1
+        self.size_histogram[bisect_left(SIZE_BUCKETS, size)] += 1
+        self.age_histogram[bisect_left(AGE_BUCKETS, age)] += 1
+
+    def written(self, inserted: int, total: int) -> None:
+        self.num_inserted += inserted
+        self.num_skipped += total - inserted
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_size_flushes = 0
+        self.num_time_flushes = 0
+        self.num_inserted = 0
+        self.num_skipped = 0
+        self.size_histogram = [0] * (len(SIZE_BUCKETS) + 1)
+        self.age_histogram = [0] * (len(AGE_BUCKETS) + 1)
+
+    def show(self) -> None:
+        log.info(
+            "DBASE Write Buffer Stats [Size Flushes, Time Flushes, Inserted, Skipped] = %s",
+            [self.num_size_flushes, self.num_time_flushes, self.num_inserted, self.num_skipped],
+        )
+        log.info("DBASE Write Buffer Sizes: %s", _histogram(SIZE_BUCKETS, self.size_histogram))
+        log.info("DBASE Write Buffer Ages: %s", _histogram(AGE_BUCKETS, self.age_histogram))
+
+
+@dataclass(slots=True)
+class RetryStats:
+    num_retries: int = 0
+    num_bisected: int = 0
+    num_dead_lettered: int = 0  # readings
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_retries = 0
+        self.num_bisected = 0
+        self.num_dead_lettered = 0
+
+    def show(self) -> None:
+        log.info(
+            "DBASE Write Retry Stats [Retries, Bisected, Dead lettered] = %s",
+            [self.num_retries, self.num_bisected, self.num_dead_lettered],
+        )
+
+
+@dataclass(slots=True)
+class PauseStats:
+    """Readings spilled to disk while paused and their catch-up progress after resuming"""
+
+    spilled: int = 0
+    spilled_bytes: int = 0
+    replayed: int = 0
+    pending: int = 0  # spilled readings still to write
+    rate: float = 0.0  # replayed readings per second
+    eta: float = 0.0  # seconds to write the pending readings
+
+    def reset(self) -> None:
+        """Progress is kept until the next pause"""
+        if not state.paused and not self.pending:
+            self.spilled = 0
+            self.spilled_bytes = 0
+            self.replayed = 0
+            self.rate = 0.0
+            self.eta = 0.0
+
+    def show(self) -> None:
+        if self.spilled or self.pending:
+            log.info(
+                "DBASE Pause Spill Stats [Spilled, Bytes, Replayed, Pending, Rate, ETA] = %s",
+                [
+                    self.spilled,
+                    self.spilled_bytes,
+                    self.replayed,
+                    self.pending,
+                    round(self.rate, 1),
+                    round(self.eta),
+                ],
+            )
+
+
+@dataclass(slots=True)
+class Spill:
+    """Spill files waiting to be written after resuming, oldest first"""
+
+    files: deque[str] = field(default_factory=deque)
+    registrations: list[PhotometerInfo] = field(default_factory=list)
+    chunks: Optional[Iterator[list[ReadingInfo]]] = None  # of the oldest file
+    chunk: Optional[list[ReadingInfo]] = None  # being written
+    tail: Optional[columnar.ColumnarWriter] = None  # live readings received while catching up
+    since: float = 0.0  # time.monotonic() when the catch-up started
+    replayed: int = 0  # since the catch-up started
+
+    def __bool__(self) -> bool:
+        return bool(self.files or self.registrations or self.chunk or self.tail)
+
+
+def _histogram(buckets: Sequence[float], counts: Sequence[int]) -> dict[str, int]:
+    labels = [f"<={bound}" for bound in buckets] + [f">{buckets[-1]}"]
+    return {label: count for label, count in zip(labels, counts) if count}
+
+
 def on_server_stats() -> None:
     reg_stats.show()
     reg_stats.reset()
     read_stats.show()
     read_stats.reset()
+    references.stats.show()
+    references.stats.reset()
+    batch_stats.show()
+    batch_stats.reset()
+    retry_stats.show()
+    retry_stats.reset()
+    pause_stats.show()
+    pause_stats.reset()
+    if state.adaptive_batch:
+        controller.show()
+        controller.reset()
 
 
 pub.subscribe(on_server_stats, Topic.SERVER_STATS)
@@ -92,6 +365,11 @@ pub.subscribe(on_server_stats, Topic.SERVER_STATS)
 
 log = logging.getLogger(logger.LogSpace.DBASE.value)
 state = State()
+batch_stats = BatchStats()
+retry_stats = RetryStats()
+pause_stats = PauseStats()
+spill = Spill()
+controller = BatchController()
 engine, Session = create_engine_sessionclass(env_var="DATABASE_URL", tag="tessdb")
 
 
@@ -122,58 +400,570 @@ def on_server_reload(options: dict[str, Any]) -> None:
 
 def on_database_flush() -> None:
     state.buffer_size = 1
+    state.adaptive_batch = False
 
 
 pub.subscribe(on_database_flush, Topic.DATABASE_FLUSH)
 
 
+def on_database_invalidate(name: Optional[str] = None) -> None:
+    log.info("Invalidating references cache for %s", name or "all photometers")
+    references.cache.invalidate(name)
+
+
+pub.subscribe(on_database_invalidate, Topic.DATABASE_INVALIDATE)
+
+
+async def register(session: Session, item: PhotometerInfo) -> None:
+    """Registers a photometer, invalidating its cached references if anything changed"""
+    before = (reg_stats.num_renamed, reg_stats.num_extinct, reg_stats.num_rebooted)
+    async with session.begin():
+        await photometer_register(session, item)
+    renamed, extinct, rebooted = (
+        reg_stats.num_renamed,
+        reg_stats.num_extinct,
+        reg_stats.num_rebooted,
+    )
+    if (renamed, extinct) != before[:2]:
+        # Other names may have been (dis)associated as well
+        references.cache.invalidate()
+    elif rebooted == before[2]:
+        references.cache.invalidate(item.name)
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(state.max_backoff, state.retry_backoff * 2**attempt))
+
+
+async def retrying(session: Session, func, *args) -> Any:
+    """Awaits func(*args), retrying transient database errors up to state.write_retries times"""
+    for attempt in itertools.count():
+        try:
+            return await func(*args)
+        except bulk.TRANSIENT_ERRORS as e:
+            with suppress(Exception):
+                await session.rollback()
+            if attempt >= state.write_retries:
+                raise
+            delay = backoff(attempt)
+            retry_stats.num_retries += 1
+            log.warning(
+                "Database error, retry %d/%d in %.1f s: %s",
+                attempt + 1,
+                state.write_retries,
+                delay,
+                str(e).split("\n")[0],
+            )
+            await asyncio.sleep(delay)
+
+
+def dead_letter(readings: Sequence[ReadingInfo], error: Exception) -> None:
+    """Keeps the readings that could not be written in the dead letter file, if any"""
+    reason = f"{error.__class__.__name__}: {str(error).splitlines()[0] if str(error) else ''}"
+    retry_stats.num_dead_lettered += len(readings)
+    if state.dead_letter_path:
+        log.error("Dead lettering %d readings by %s", len(readings), reason)
+        deadletter.append(state.dead_letter_path, readings, reason)
+    else:
+        for reading in readings:
+            log.error("Discarding reading by %s: %s", reason, dict(reading))
+
+
+async def bisect_write(
+    session: Session, items: Sequence[tuple[ReadingInfo, ReferencesInfo]], error: Exception
+) -> None:
+    """
+    Writes the halves of a batch that failed by a non transient error, and so on,
+    so that only the readings causing the error are dead lettered.
+    """
+    if len(items) == 1:
+        dead_letter([items[0][0]], error)
+        return
+    retry_stats.num_bisected += 1
+    middle = len(items) // 2
+    for half in (items[:middle], items[middle:]):
+        try:
+            inserted = await retrying(session, state.backend.write, session, half)
+        except bulk.TRANSIENT_ERRORS as e:
+            dead_letter([item for item, _ in half], e)
+        except Exception as e:
+            with suppress(Exception):
+                await session.rollback()
+            await bisect_write(session, half, e)
+        else:
+            batch_stats.written(inserted, len(half))
+            pub.sendMessage(Topic.DATABASE_COMMIT, items=[item for item, _ in half])
+
+
+async def flush_readings(
+    session: Session, batch: WriteBuffer, auth_filter: bool, timed: bool
+) -> None:
+    """
+    Resolves the whole write buffer at once and writes it. Transient database errors
+    are retried with backoff. Readings that could not be written are dead lettered.
+    """
+    batch_stats.add(len(batch), time.monotonic() - batch.since, timed)
+    readings = batch.readings
+    batch.clear()
+    try:
+        resolved, rejected = await retrying(
+            session, references.cache.resolve, session, readings, auth_filter, ReadingSource.DIRECT
+        )
+    except Exception as e:
+        log.exception(e)
+        dead_letter(readings, e)
+        return
+    if rejected:
+        log.info(
+            "Rejected %d/%d readings in write buffer: %s",
+            rejected.total(),
+            len(readings),
+            dict(rejected),
+        )
+    if resolved:
+        log.warning("Flushing queue with %d photometers", len(resolved))
+        # Readings written one by one after a failed commit are counted as duplicated
+        duplicated = read_stats.rej_duplicated
+        start = time.monotonic()
+        try:
+            inserted = await retrying(session, state.backend.write, session, resolved)
+        except Exception as e:
+            if state.adaptive_batch:
+                controller.update(time.monotonic() - start, ok=False, full=not timed)
+            if isinstance(e, bulk.TRANSIENT_ERRORS):
+                dead_letter([item for item, _ in resolved], e)
+            else:
+                log.error("Bisecting write buffer by %s", str(e).split("\n")[0])
+                with suppress(Exception):
+                    await session.rollback()
+                await bisect_write(session, resolved, e)
+            return
+        batch_stats.written(inserted, len(resolved))
+        if state.adaptive_batch:
+            # Duplicated readings skipped by idempotent inserts cost nothing
+            ok = state.backend.idempotent or read_stats.rej_duplicated <= duplicated
+            controller.update(time.monotonic() - start, ok=ok, full=not timed)
+        pub.sendMessage(Topic.DATABASE_COMMIT, items=[item for item, _ in resolved])
+
+
 async def write_readings(
     session: Session,
     item: ReadingInfo,
     auth_filter: bool,
     buffer_size: int,
-    batch: Sequence[ReadingInfo],
-) -> Sequence[ReadingInfo]:
-    async with session.begin():
-        ref = await resolve_references(
-            session=session,
-            reading=item,
-            auth_filter=auth_filter,
-            latest=True,
-            source=ReadingSource.DIRECT,
-        )
-    if ref:
-        batch.append((item, ref))
+    batch: WriteBuffer,
+) -> bool:
+    """Buffers a reading, writing the buffer when full. Returns True if written"""
+    batch.append(item)
     if len(batch) >= buffer_size:
-        log.warning("Flushing queue with %d photometers", len(batch))
-        await photometer_resolved_batch_write(
-            session=session,
-            items=batch,
-            source=ReadingSource.DIRECT,
+        await flush_readings(session, batch, auth_filter, timed=False)
+        return True
+    return False
+
+
+def buffer_size() -> int:
+    return controller.size if state.adaptive_batch else state.buffer_size
+
+
+def batch_timeout(batch: WriteBuffer) -> Optional[float]:
+    """Time left until the oldest buffered reading reaches max_batch_latency, None = no limit"""
+    if not batch or state.max_batch_latency <= 0:
+        return None
+    return max(0.0, batch.since + state.max_batch_latency - time.monotonic())
+
+
+async def photometer_locations() -> dict[str, tuple[float, float]]:
+    """(longitude, latitude) of the current photometers with a known location"""
+    query = (
+        select(NameMapping.name, Location.longitude, Location.latitude)
+        .select_from(Tess)
+        .join(Location, Location.location_id == Tess.location_id)
+        .join(NameMapping, NameMapping.mac_address == Tess.mac_address)
+        .where(
+            Tess.valid_state == ValidState.CURRENT,
+            NameMapping.valid_state == ValidState.CURRENT,
+            Location.longitude.is_not(None),
+            Location.latitude.is_not(None),
         )
-        batch = list()  # empties the buffer
-    return batch
+    )
+    async with Session() as session:
+        result = await session.execute(query)
+        return {name: (longitude, latitude) for name, longitude, latitude in result}
+
+
+def acknowledge(queue: SpoolQueue, last: bool) -> None:
+    """
+    Nothing is pending in the write buffer, so the spool can forget the committed readings:
+    the whole current record if its last reading was written or the previous records otherwise.
+    """
+    start, end = queue.record
+    queue.ack(end if last else start)
+
+
+def committed(
+    queue: SpoolQueue, pending: deque[PendingRecord], records: list[PendingRecord]
+) -> None:
+    """
+    A lane committed its part of these spool records. The spool can forget the
+    oldest records once all the lanes they were split among committed their part.
+    """
+    for record in records:
+        record.parts -= 1
+    records.clear()
+    while pending and pending[0].parts == 0:
+        queue.ack(pending.popleft().end)
+
+
+def spilling(queue: Union[LaneQueue, SpoolQueue]) -> bool:
+    """Readings queued while paused are spilled to disk, unless already spooled"""
+    return bool(state.pause_spill_dir) and not isinstance(queue, SpoolQueue)
+
+
+def spill_files() -> None:
+    """Picks up the spill files left by a previous run of this worker"""
+    pattern = os.path.join(state.pause_spill_dir, f"paused-{cluster.state.index}-*.col")
+    for path in sorted(glob.glob(pattern)):
+        if path not in spill.files:
+            rows = columnar.count(path)
+            log.warning("Found %d spilled readings to write in %s", rows, path)
+            spill.files.append(path)
+            pause_stats.pending += rows
+
+
+def spill_path() -> str:
+    return os.path.join(state.pause_spill_dir, f"paused-{cluster.state.index}-{time.time_ns()}.col")
+
+
+async def spill_paused(queue: LaneQueue) -> None:
+    """
+    Streams the readings dequeued while paused to a columnar file, so that the queue
+    never fills up. Registrations are kept in memory. Returns when resumed.
+    """
+    if spill.tail is not None:
+        # Paused again while catching up
+        next_spill_file()
+    path = spill_path()
+    spilled = columnar.ColumnarWriter(path, state.catchup_batch_size)
+    log.warning("Database writer paused. Spilling readings to %s", path)
+    logged = time.monotonic()
+    try:
+        while state.paused:
+            if time.monotonic() - logged >= PAUSE_CYCLE:
+                logged = time.monotonic()
+                log.warning(
+                    "Database writer paused. Queue size: [%d/%d]. Spilled %d readings (%d bytes)",
+                    queue.qsize(),
+                    queue.maxsize,
+                    len(spilled),
+                    spilled.nbytes,
+                )
+            try:
+                priority, items = await asyncio.wait_for(queue.get(), timeout=1)
+            except TimeoutError:
+                continue
+            if priority == MessagePriority.REGISTER:
+                spill.registrations.append(items)
+            else:
+                spilled.write(items)
+                pause_stats.spilled += len(items)
+                pause_stats.pending += len(items)
+    finally:
+        spilled.close()
+        pause_stats.spilled_bytes += spilled.nbytes
+        if len(spilled):
+            spill.files.append(path)
+        else:
+            os.remove(path)
+
+
+def spill_live(queue: LaneQueue) -> None:
+    """
+    Live readings queued while catching up are spilled after the pending ones,
+    so that all readings are written in their arrival order and the queue never fills up
+    """
+    while not queue.empty():
+        priority, items = queue.get_nowait()
+        if priority == MessagePriority.REGISTER:
+            spill.registrations.append(items)
+            continue
+        if spill.tail is None:
+            spill.tail = columnar.ColumnarWriter(spill_path(), state.catchup_batch_size)
+        spill.tail.write(items)
+        pause_stats.spilled += len(items)
+        pause_stats.pending += len(items)
 
 
-async def writer(options: dict[str, Any], queue: asyncio.PriorityQueue) -> None:
+def next_spill_file() -> None:
+    """The live readings spilled so far are written next"""
+    spill.tail.close()
+    pause_stats.spilled_bytes += spill.tail.nbytes
+    spill.files.append(spill.tail.path)
+    spill.tail = None
+
+
+async def catch_up(session: Session, queue: Union[LaneQueue, SpoolQueue]) -> None:
+    """
+    Writes the registrations received while paused and then the next chunk of
+    spilled readings, as a single write buffer of up to catchup_batch_size readings.
+    Live readings wait until all the spilled ones are written.
+    """
+    if spilling(queue):
+        spill_live(queue)
+    while spill.registrations:
+        await retrying(session, register, session, spill.registrations[0])
+        spill.registrations.pop(0)
+    if spill.chunk is None:
+        if not spill.files:
+            if spill.tail is None:
+                return
+            next_spill_file()
+        if spill.chunks is None:
+            spill.chunks = columnar.read_chunks(spill.files[0])
+            if not spill.since:
+                spill.since = time.monotonic()
+                spill.replayed = 0
+        try:
+            spill.chunk = next(spill.chunks, None)
+        except ValueError as e:
+            log.error("Skipping spill file: %s", e)
+            spill.chunk = None
+            spill.files[0] = ""
+        if spill.chunk is None:
+            spill.chunks = None
+            path = spill.files.popleft()
+            if path:
+                os.remove(path)
+            if not spill:
+                log.warning(
+                    "Caught up %d spilled readings in %.0f s",
+                    spill.replayed,
+                    time.monotonic() - spill.since,
+                )
+                spill.since = 0.0
+                pause_stats.pending = 0
+            return
+    batch = WriteBuffer(readings=spill.chunk, since=time.monotonic())
+    await flush_readings(session, batch, state.auth_filter, timed=False)
+    n = len(spill.chunk)
+    spill.chunk = None
+    spill.replayed += n
+    pause_stats.replayed += n
+    pause_stats.pending = max(0, pause_stats.pending - n)
+    pause_stats.rate = spill.replayed / max(time.monotonic() - spill.since, 1e-6)
+    pause_stats.eta = pause_stats.pending / pause_stats.rate
+    log.info(
+        "Catching up spilled readings [%d/%d] at %.0f readings/s, ETA %.0f s",
+        pause_stats.replayed,
+        pause_stats.replayed + pause_stats.pending,
+        pause_stats.rate,
+        pause_stats.eta,
+    )
+
+
+def resumed(queue: Union[LaneQueue, SpoolQueue]) -> None:
+    state.resumed = False
+    log.warning(
+        "Database writer resumed. Queue size: [%d/%d]. %d spilled readings to write",
+        queue.qsize(),
+        queue.maxsize,
+        pause_stats.pending,
+    )
+
+
+async def lane_writer(
+    lane: Lane,
+    session: Session,
+    queue: Union[LaneQueue, SpoolQueue],
+    pending: deque[PendingRecord],
+) -> None:
+    """Writes the readings dispatched to a lane, in their arrival order"""
+    log.info("Starting database writer lane #%d", lane.index)
+    spooled = isinstance(queue, SpoolQueue)
+    while True:
+        while state.paused:
+            await asyncio.sleep(1)
+        try:
+            priority, items, record = await asyncio.wait_for(
+                lane.queue.get(), timeout=batch_timeout(lane.batch)
+            )
+        except TimeoutError:
+            await flush_readings(session, lane.batch, state.auth_filter, timed=True)
+            if spooled:
+                committed(queue, pending, lane.records)
+            continue
+        try:
+            if priority is None:
+                # Drain request, see drain_lanes()
+                if lane.batch:
+                    await flush_readings(session, lane.batch, state.auth_filter, timed=True)
+                if spooled:
+                    committed(queue, pending, lane.records)
+                continue
+            for item in items:
+                if priority == MessagePriority.FILTER_READINGS:
+                    logging.getLogger(item.name).debug("Flushing unsaved filtered readings")
+                written = await write_readings(
+                    session, item, state.auth_filter, buffer_size(), lane.batch
+                )
+                if spooled and written:
+                    committed(queue, pending, lane.records)
+            if record is not None:
+                lane.records.append(record)
+                if not lane.batch:
+                    committed(queue, pending, lane.records)
+        finally:
+            lane.queue.task_done()
+
+
+async def drain_lanes(lanes: list[Lane]) -> None:
+    """Writes the readings queued and buffered in every lane"""
+    for lane in lanes:
+        await lane.queue.put((None, list(), None))
+    for lane in lanes:
+        await lane.queue.join()
+
+
+async def dispatcher(
+    queue: Union[LaneQueue, SpoolQueue],
+    lanes: list[Lane],
+    session: Session,
+    pending: deque[PendingRecord],
+    lanes_engine,
+) -> None:
+    """
+    Registers photometers as soon as they are dequeued and splits readings among
+    the lanes by photometer, so that each photometer readings keep their order.
+    A lane buffers the next readings while the previous ones are being committed.
+    """
+    spooled = isinstance(queue, SpoolQueue)
+    while True:
+        if state.resumed:
+            resumed(queue)
+        if state.paused:
+            if not state.disposed:
+                state.disposed = True
+                await lanes_engine.dispose()
+            if spilling(queue):
+                await spill_paused(queue)
+                continue
+            await asyncio.sleep(1)
+            i = next(state.counter)
+            if i == 0:
+                log.warning(
+                    "Database writer paused. Queue size: [%d/%d]",
+                    queue.qsize(),
+                    queue.maxsize,
+                )
+            continue
+        if spill:
+            # Readings dispatched before pausing go first, then the spilled ones,
+            # which are older than the live ones
+            await drain_lanes(lanes)
+            await catch_up(session, queue)
+            continue
+        priority, items = await queue.get()
+        if priority == MessagePriority.REGISTER:
+            await retrying(session, register, session, items)
+            continue
+        if priority not in (MessagePriority.FILTER_READINGS, MessagePriority.MQTT_READINGS):
+            log.error("NOT YET IMPLEMENTED")
+            continue
+        parts = dict()
+        for item in items:
+            parts.setdefault(cluster.partition(item.name, len(lanes)), list()).append(item)
+        record = None
+        if spooled and parts:
+            record = PendingRecord(end=queue.record[1], parts=len(parts))
+            pending.append(record)
+        for index, part in parts.items():
+            await lanes[index].queue.put((priority, part, record))
+
+
+def new_lanes() -> list[Lane]:
+    return [Lane(index=i, queue=asyncio.Queue(maxsize=LANE_QUEUE_SIZE)) for i in range(state.lanes)]
+
+
+def create_lanes_engine_sessionclass(url: str, pool_size: int) -> tuple[AsyncEngine, Any]:
+    """As lica create_engine_sessionclass(), with a fixed size connection pool"""
+    # 'check_same_thread' is only needed in SQLite ....
+    connect_args = dict()
+    if make_url(url).get_backend_name() == "sqlite":
+        connect_args["check_same_thread"] = False
+    engine = create_async_engine(
+        url,
+        logging_name="tessdb",
+        pool_size=pool_size,
+        max_overflow=0,
+        connect_args=connect_args,
+    )
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    return engine, Session
+
+
+async def lanes_writer(queue: Union[LaneQueue, SpoolQueue], lanes: list[Lane]) -> None:
+    """Database writer with state.lanes lanes, each with its own session and connection"""
+    lanes_engine, LaneSession = create_lanes_engine_sessionclass(state.url, state.lanes + 1)
+    pending = deque()
+    try:
+        async with AsyncExitStack() as stack:
+            sessions = [
+                await stack.enter_async_context(LaneSession()) for _ in range(state.lanes + 1)
+            ]
+            if state.references_ttl > 0:
+                await references.cache.warm(sessions[0])
+            async with asyncio.TaskGroup() as tg:
+                for lane, session in zip(lanes, sessions[1:]):
+                    tg.create_task(lane_writer(lane, session, queue, pending))
+                tg.create_task(dispatcher(queue, lanes, sessions[0], pending, lanes_engine))
+    finally:
+        await lanes_engine.dispose()
+
+
+async def writer(options: dict[str, Any], queue: Union[LaneQueue, SpoolQueue]) -> None:
     global paused
     global state
+    spooled = isinstance(queue, SpoolQueue)
+    # Readings buffered but not written survive restarts unless spooled
+    batch = WriteBuffer()
+    lanes = None
+    restarts = 0
     while True:  # Infinite task loop
+        started = time.monotonic()
         state.update(options)
         log.setLevel(state.log_level)
         log.info("Starting database writer service on %s", state.url)
-        batch = list()
+        state.backend = bulk.backend(state.bulk_insert, state.url, state.idempotent_writes)
+        log.info(
+            "Using the %s bulk insert backend%s",
+            state.backend.name,
+            " with idempotent writes" if state.backend.idempotent else "",
+        )
+        if state.pause_spill_dir:
+            spill_files()
+        if spooled:
+            # Readings not yet committed by a previous run are written again
+            queue.rewind()
+            batch.clear()
+            lanes = None
         try:
+            if state.lanes > 1:
+                lanes = lanes or new_lanes()
+                await lanes_writer(queue, lanes)  # Only returns by an exception
             async with Session() as session:
+                if state.references_ttl > 0:
+                    await references.cache.warm(session)
                 while True:
                     if state.resumed:
-                        state.resumed = False
-                        log.warning(
-                            "Database writer resumed. Queue size: [%d/%d]",
-                            queue.qsize(),
-                            queue.maxsize,
-                        )
+                        resumed(queue)
                     if state.paused:
+                        if not state.disposed:
+                            # Connections are closed once, when the pause starts
+                            state.disposed = True
+                            await engine.dispose()
+                        if spilling(queue):
+                            await spill_paused(queue)
+                            continue
                         await asyncio.sleep(1)
                         i = next(state.counter)
                         if i == 0:
@@ -182,25 +972,53 @@ async def writer(options: dict[str, Any], queue: asyncio.PriorityQueue) -> None:
                                 queue.qsize(),
                                 queue.maxsize,
                             )
-                        await engine.dispose()
                         continue
-                    priority, item = await queue.get()
+                    if spill:
+                        if batch:
+                            # Readings buffered before pausing go first
+                            await flush_readings(session, batch, state.auth_filter, timed=True)
+                            if spooled:
+                                acknowledge(queue, True)
+                        # Spilled readings are older than the live ones
+                        await catch_up(session, queue)
+                        continue
+                    try:
+                        priority, items = await asyncio.wait_for(
+                            queue.get(), timeout=batch_timeout(batch)
+                        )
+                    except TimeoutError:
+                        await flush_readings(session, batch, state.auth_filter, timed=True)
+                        if spooled:
+                            acknowledge(queue, True)
+                        continue
                     if priority == MessagePriority.REGISTER:
-                        async with session.begin():
-                            await photometer_register(session, item)
+                        await retrying(session, register, session, items)
                     elif priority == MessagePriority.FILTER_READINGS:
-                        plog = logging.getLogger(item.name)
-                        plog.debug("Flushing unsaved filtered readings")
-                        batch = await write_readings(
-                            session, item, state.auth_filter, state.buffer_size, batch
-                        )
+                        for i, item in enumerate(items, start=1):
+                            plog = logging.getLogger(item.name)
+                            plog.debug("Flushing unsaved filtered readings")
+                            await write_readings(
+                                session, item, state.auth_filter, buffer_size(), batch
+                            )
+                            if spooled and not batch:
+                                acknowledge(queue, i == len(items))
                     elif priority == MessagePriority.MQTT_READINGS:
-                        batch = await write_readings(
-                            session, item, state.auth_filter, state.buffer_size, batch
-                        )
+                        for i, item in enumerate(items, start=1):
+                            await write_readings(
+                                session, item, state.auth_filter, buffer_size(), batch
+                            )
+                            if spooled and not batch:
+                                acknowledge(queue, i == len(items))
                     else:
                         log.error("NOT YET IMPLEMENTED")
         except Exception as e:
             log.exception(e)
+        finally:
+            state.backend.close()
+            if spill.tail is not None:
+                next_spill_file()
         log.warn("Exited inner loop by an unhandled exception. Restarting task ...")
         await engine.dispose()
+        # Back off on repeated failures instead of reconnecting at once
+        restarts = restarts + 1 if time.monotonic() - started < state.max_backoff else 0
+        await asyncio.sleep(backoff(restarts))
@@ -0,0 +1,96 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import time
+import zlib
+import struct
+import logging
+from datetime import datetime, timezone
+from typing import Iterator, NamedTuple, Sequence
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbapi.model import ReadingInfo
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+from .spool import encode, decode
+
+# ---------
+# Constants
+# ---------
+
+# Record header: dead lettering time (s since epoch), reason length,
+# encoded readings length, encoded readings crc32
+RECORD = struct.Struct("<dIII")
+
+# -------
+# Classes
+# -------
+
+
+class DeadLetter(NamedTuple):
+    tstamp: datetime  # when it was dead lettered
+    reason: str  # the last database error
+    readings: list[ReadingInfo]
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.DBASE.value)
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def append(path: str, readings: Sequence[ReadingInfo], reason: str) -> None:
+    """Appends readings that could not be written to the database to the dead letter file"""
+    reason = reason.encode("utf-8")
+    payload = encode(list(readings))
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "ab") as fd:
+        fd.write(RECORD.pack(time.time(), len(reason), len(payload), zlib.crc32(payload)))
+        fd.write(reason)
+        fd.write(payload)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def read(path: str) -> Iterator[DeadLetter]:
+    """Dead letter file records, in order. A torn record at the end is skipped"""
+    with open(path, "rb") as fd:
+        data = memoryview(fd.read())
+    offset = 0
+    while offset < len(data):
+        if offset + RECORD.size > len(data):
+            log.warning("%s: truncated record at offset %d", path, offset)
+            return
+        tstamp, reason_len, payload_len, crc = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size + reason_len
+        end = start + payload_len
+        if end > len(data) or zlib.crc32(data[start:end]) != crc:
+            log.warning("%s: truncated or corrupt record at offset %d", path, offset)
+            return
+        reason = bytes(data[offset + RECORD.size : start]).decode("utf-8")
+        yield DeadLetter(
+            datetime.fromtimestamp(tstamp, timezone.utc), reason, decode(data[start:end])
+        )
+        offset = end
@@ -0,0 +1,459 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, Optional, Union
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbdao import PhotometerModel, TimestampSource, RegisterState
+from tessdbapi.model import (
+    PhotometerInfo,
+    ReadingInfo1c,
+    ReadingInfo4c,
+    is_datetime,
+)
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+from .constants import DEFAULT_FILTER
+
+# ---------
+# CONSTANTS
+# ---------
+
+TESS4C_FILTER_KEYS = ("F1", "F2", "F3", "F4")
+TESS4C_MARKER = b'"F4"'
+
+# Malformed JSON or, for the compiled decoder, schema mismatches as well
+DECODE_ERRORS = (
+    (json.JSONDecodeError,) if msgspec is None else (json.JSONDecodeError, msgspec.DecodeError)
+)
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.MQTT.value)
+
+# ===========================================
+# Reference decoder: JSON dicts + pydantic
+# ===========================================
+
+
+def is_tess4c_payload(row: dict[str, Any]) -> bool:
+    return "F4" in row
+
+
+def _remap_tess4c_reading(row: dict[str, Any]) -> None:
+    """Flatten the JSON structure for further processing"""
+    for i, filt in enumerate(TESS4C_FILTER_KEYS, 1):
+        for key, value in row[filt].items():
+            row[f"{key}{i}"] = value
+    for filt in TESS4C_FILTER_KEYS:
+        del row[filt]
+
+
+def _remap_tess4c_register(row: dict[str, Any]) -> None:
+    """Flatten the JSON structure for further processing"""
+    for i, filt in enumerate(TESS4C_FILTER_KEYS, 1):
+        for key, value in row[filt].items():
+            row[f"{key}{i}"] = value
+    for filt in TESS4C_FILTER_KEYS:
+        del row[filt]
+    row["model"] = PhotometerModel.TESS4C
+
+
+def _remap_tessw_reading(row: dict[str, Any]):
+    """remaps keywords for the filter/database statges"""
+    row["mag1"] = row["mag"]
+    row["freq1"] = row["freq"]
+    del row["mag"]
+    del row["freq"]
+
+
+def _remap_tessw_register(row: dict[str, Any]):
+    """remaps keywords for the filter/database statges"""
+    row["calib1"] = row["calib"]
+    del row["calib"]
+    row["offsethz1"] = row.get("offsethz", 0.0)
+    if "offsethz" in row:
+        del row["offsethz"]
+    row["model"] = PhotometerModel.TESSW
+
+
+def _timestamp(row: dict[str, Any]) -> tuple[Optional[str], TimestampSource]:
+    if "tstamp" not in row:
+        return None, TimestampSource.SUBSCRIBER
+    return row["tstamp"], TimestampSource.PUBLISHER
+
+
+class PydanticDecoder:
+    """
+    Reference decoder: bytes -> str -> dict, dict remapping and full pydantic validation.
+    Raises json.JSONDecodeError, KeyError or pydantic.ValidationError on bad payloads.
+    """
+
+    name = "pydantic"
+
+    def header(self, payload: bytes) -> tuple[str, Optional[int], Optional[str]]:
+        """Photometer name, sequence number and hash only, without further validation"""
+        return self.peek(payload)[0]
+
+    def peek(self, payload: bytes) -> tuple[tuple[str, Optional[int], Optional[str]], dict]:
+        """
+        header() plus the parsed payload, which reading() and register() take
+        as well, so that the payload is not parsed twice
+        """
+        row = json.loads(payload.decode("utf-8"))
+        return (row["name"], row.get("seq"), row.get("hash")), row
+
+    def _row(self, payload: Union[bytes, dict]) -> dict:
+        return payload if isinstance(payload, dict) else json.loads(payload.decode("utf-8"))
+
+    def reading(self, payload: Union[bytes, dict]) -> Union[ReadingInfo1c, ReadingInfo4c]:
+        row = self._row(payload)
+        now, src = _timestamp(row)
+        if is_tess4c_payload(row):
+            _remap_tess4c_reading(row)
+            return ReadingInfo4c(
+                tstamp=now,
+                tstamp_src=src,
+                name=row["name"],
+                sequence_number=row["seq"],
+                box_temperature=row.get("tamb"),
+                sky_temperature=row.get("tsky"),
+                signal_strength=row["wdBm"],
+                hash=row.get("hash"),
+                freq1=row["freq1"],
+                mag1=row["mag1"],
+                freq2=row["freq2"],
+                mag2=row["mag2"],
+                freq3=row["freq3"],
+                mag3=row["mag3"],
+                freq4=row["freq4"],
+                mag4=row["mag4"],
+            )
+        _remap_tessw_reading(row)
+        return ReadingInfo1c(
+            tstamp=now,
+            tstamp_src=src,
+            name=row["name"],
+            sequence_number=row["seq"],
+            box_temperature=row["tamb"],
+            sky_temperature=row["tsky"],
+            signal_strength=row["wdBm"],
+            hash=row.get("hash"),
+            freq1=row["freq1"],
+            mag1=row["mag1"],
+        )
+
+    def register(self, payload: Union[bytes, dict]) -> PhotometerInfo:
+        row = self._row(payload)
+        # 'now' is usualy None
+        now, src = _timestamp(row)
+        compilation_date = row.get("date")
+        if not compilation_date:
+            row["firmware"] = row.get("firmware")
+        else:
+            row["firmware"] = f"{row.get('firmware')} ({compilation_date})"
+        if is_tess4c_payload(row):
+            _remap_tess4c_register(row)
+            return PhotometerInfo(
+                name=row["name"],
+                mac_address=row["mac"],
+                model=PhotometerModel.TESS4C,
+                authorised=False,
+                registered=RegisterState.AUTO,
+                firmware=row["firmware"],
+                zp1=row["calib1"],
+                filter1=row["band1"],
+                offset1=row.get("offsethz1", 0),
+                zp2=row["calib2"],
+                filter2=row["band2"],
+                offset2=row.get("offsethz2", 0),
+                zp3=row["calib3"],
+                filter3=row["band3"],
+                offset3=row.get("offsethz3", 0),
+                zp4=row["calib4"],
+                filter4=row["band4"],
+                offset4=row.get("offsethz4", 0),
+                tstamp=now,
+                tstamp_src=src,
+            )
+        _remap_tessw_register(row)
+        return PhotometerInfo(
+            name=row["name"],
+            mac_address=row["mac"],
+            model=PhotometerModel.TESSW,
+            authorised=False,
+            registered=RegisterState.AUTO,
+            firmware=row.get("firmware"),
+            zp1=row["calib1"],
+            filter1=row.get("filter1", DEFAULT_FILTER),
+            offset1=row["offsethz1"],
+            tstamp=now,
+            tstamp_src=src,
+        )
+
+
+# ===============================================
+# Compiled decoder: bytes straight into msgspec
+# Structs, field renames declared in the schema
+# ===============================================
+
+if msgspec is not None:
+
+    class Header(msgspec.Struct):
+        name: str
+        seq: Optional[int] = None
+        hash: Optional[str] = None
+
+    class ChannelReading(msgspec.Struct):
+        freq: float
+        mag: float
+
+    class TessWReading(msgspec.Struct):
+        name: str
+        seq: int
+        freq1: float = msgspec.field(name="freq")
+        mag1: float = msgspec.field(name="mag")
+        tamb: float
+        tsky: float
+        wdBm: Optional[int]
+        hash: Optional[str] = None
+        tstamp: Optional[str] = None
+
+    class Tess4cReading(msgspec.Struct):
+        name: str
+        seq: int
+        F1: ChannelReading
+        F2: ChannelReading
+        F3: ChannelReading
+        F4: ChannelReading
+        wdBm: Optional[int]
+        tamb: Optional[float] = None
+        tsky: Optional[float] = None
+        hash: Optional[str] = None
+        tstamp: Optional[str] = None
+
+    class ChannelRegister(msgspec.Struct):
+        calib: Union[float, str]
+        band: str
+        offsethz: float = 0.0
+
+    class TessWRegister(msgspec.Struct):
+        name: str
+        mac: str
+        calib1: Union[float, str] = msgspec.field(name="calib")
+        offset1: float = msgspec.field(name="offsethz", default=0.0)
+        filter1: str = DEFAULT_FILTER
+        firmware: Optional[str] = None
+        date: Optional[str] = None
+        tstamp: Optional[str] = None
+
+    class Tess4cRegister(msgspec.Struct):
+        name: str
+        mac: str
+        F1: ChannelRegister
+        F2: ChannelRegister
+        F3: ChannelRegister
+        F4: ChannelRegister
+        firmware: Optional[str] = None
+        date: Optional[str] = None
+        tstamp: Optional[str] = None
+
+
+def _datetime(value: Optional[str]) -> datetime:
+    """
+    Fast path for the ISO 8601 publisher timestamp formats accepted by tessdbapi's is_datetime(),
+    which tries every strptime() format in turn. Anything else is left to is_datetime().
+    """
+    if value is not None and len(value) in (19, 20, 24, 25) and value[19:20] in "Z+-":
+        try:
+            tstamp = datetime.fromisoformat(value)
+        except ValueError:
+            pass
+        else:
+            if tstamp.tzinfo is None:
+                return tstamp.replace(tzinfo=timezone.utc)
+            return tstamp.astimezone(timezone.utc)
+    return is_datetime(value)
+
+
+def _source(tstamp: Optional[str]) -> TimestampSource:
+    return TimestampSource.SUBSCRIBER if tstamp is None else TimestampSource.PUBLISHER
+
+
+def _firmware(firmware: Optional[str], date: Optional[str]) -> Optional[str]:
+    return f"{firmware} ({date})" if date else firmware
+
+
+class CompiledDecoder:
+    """
+    Decodes the raw payload bytes (no intermediate str or dict) into typed msgspec Structs.
+    Field renames are declared in the Structs schema, TESS4C channels are decoded as nested
+    Structs and the timestamp is parsed with a fast path, so the final pydantic models are
+    built from already typed values, which is the cheap case for pydantic validation.
+    Raises msgspec.DecodeError (or its msgspec.ValidationError subclass) or
+    pydantic.ValidationError on bad payloads.
+    """
+
+    name = "msgspec"
+
+    def __init__(self) -> None:
+        self._tessw_reading = msgspec.json.Decoder(TessWReading, strict=False)
+        self._tess4c_reading = msgspec.json.Decoder(Tess4cReading, strict=False)
+        self._tessw_register = msgspec.json.Decoder(TessWRegister, strict=False)
+        self._tess4c_register = msgspec.json.Decoder(Tess4cRegister, strict=False)
+        self._header = msgspec.json.Decoder(Header, strict=False)
+
+    def header(self, payload: bytes) -> tuple[str, Optional[int], Optional[str]]:
+        """Photometer name, sequence number and hash only. Other fields are skipped"""
+        h = self._header.decode(payload)
+        return h.name, h.seq, h.hash
+
+    def peek(self, payload: bytes) -> tuple[tuple[str, Optional[int], Optional[str]], bytes]:
+        """header() plus the payload, which is decoded straight from bytes"""
+        return self.header(payload), payload
+
+    def reading(self, payload: bytes) -> Union[ReadingInfo1c, ReadingInfo4c]:
+        if TESS4C_MARKER in payload:
+            r = self._tess4c_reading.decode(payload)
+            return ReadingInfo4c(
+                tstamp=_datetime(r.tstamp),
+                tstamp_src=_source(r.tstamp),
+                name=r.name,
+                sequence_number=r.seq,
+                box_temperature=r.tamb,
+                sky_temperature=r.tsky,
+                signal_strength=r.wdBm,
+                hash=r.hash,
+                freq1=r.F1.freq,
+                mag1=r.F1.mag,
+                freq2=r.F2.freq,
+                mag2=r.F2.mag,
+                freq3=r.F3.freq,
+                mag3=r.F3.mag,
+                freq4=r.F4.freq,
+                mag4=r.F4.mag,
+            )
+        r = self._tessw_reading.decode(payload)
+        return ReadingInfo1c(
+            tstamp=_datetime(r.tstamp),
+            tstamp_src=_source(r.tstamp),
+            name=r.name,
+            sequence_number=r.seq,
+            box_temperature=r.tamb,
+            sky_temperature=r.tsky,
+            signal_strength=r.wdBm,
+            hash=r.hash,
+            freq1=r.freq1,
+            mag1=r.mag1,
+        )
+
+    def register(self, payload: bytes) -> PhotometerInfo:
+        if TESS4C_MARKER in payload:
+            r = self._tess4c_register.decode(payload)
+            return PhotometerInfo(
+                name=r.name,
+                mac_address=r.mac,
+                model=PhotometerModel.TESS4C,
+                authorised=False,
+                registered=RegisterState.AUTO,
+                firmware=_firmware(r.firmware, r.date),
+                zp1=r.F1.calib,
+                filter1=r.F1.band,
+                offset1=r.F1.offsethz,
+                zp2=r.F2.calib,
+                filter2=r.F2.band,
+                offset2=r.F2.offsethz,
+                zp3=r.F3.calib,
+                filter3=r.F3.band,
+                offset3=r.F3.offsethz,
+                zp4=r.F4.calib,
+                filter4=r.F4.band,
+                offset4=r.F4.offsethz,
+                tstamp=_datetime(r.tstamp),
+                tstamp_src=_source(r.tstamp),
+            )
+        r = self._tessw_register.decode(payload)
+        return PhotometerInfo(
+            name=r.name,
+            mac_address=r.mac,
+            model=PhotometerModel.TESSW,
+            authorised=False,
+            registered=RegisterState.AUTO,
+            firmware=_firmware(r.firmware, r.date),
+            zp1=r.calib1,
+            filter1=r.filter1,
+            offset1=r.offset1,
+            tstamp=_datetime(r.tstamp),
+            tstamp_src=_source(r.tstamp),
+        )
+
+
+Decoder = Union[PydanticDecoder, CompiledDecoder]
+
+
+def make_decoder(kind: str) -> Decoder:
+    """Decoder factory. Falls back to the pydantic decoder if msgspec is not installed"""
+    if kind == CompiledDecoder.name:
+        if msgspec is not None:
+            return CompiledDecoder()
+        log.warning("msgspec not installed, using the %s decoder instead", PydanticDecoder.name)
+        return PydanticDecoder()
+    if kind == PydanticDecoder.name:
+        return PydanticDecoder()
+    raise ValueError(f"decoder {kind} not in {(CompiledDecoder.name, PydanticDecoder.name)}")
+
+
+# ===========================================
+# Process pool decoding stage
+# ===========================================
+
+# Decoder private to each process pool worker
+_worker_decoder: Optional[Decoder] = None
+
+
+def init_worker(kind: str) -> None:
+    """Process pool initializer"""
+    global _worker_decoder
+    _worker_decoder = make_decoder(kind)
+
+
+def decode_readings(
+    payloads: list[Union[bytes, dict]],
+) -> list[Union[None, ReadingInfo1c, ReadingInfo4c]]:
+    """
+    Decodes and validates a batch of readings payloads in a process pool worker.
+    Models are sent back pickled, which restores them without validating again.
+    Bad payloads are returned as None, so that the caller decodes them again and logs the error.
+    """
+    result = list()
+    for payload in payloads:
+        try:
+            info = _worker_decoder.reading(payload)
+        except Exception:
+            info = None
+        result.append(info)
+    return result
@@ -0,0 +1,118 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+from enum import IntEnum
+from datetime import datetime, timedelta
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+import numpy as np
+from tessdbapi.model import ReadingInfo
+
+# ---------
+# Constants
+# ---------
+
+UNIX_EPOCH_JD = 2440587.5  # Julian Date of 1970-01-01T00:00:00Z
+J2000_JD = 2451545.0  # Julian Date of 2000-01-01T12:00:00Z
+
+# -------
+# Classes
+# -------
+
+
+class SunZone(IntEnum):
+    """Sky brightness as given by the Sun altitude at the photometer location"""
+
+    NIGHT = 0  # Sun below the night altitude during the whole validity interval
+    TWILIGHT = 1  # Sun in between, or unknown location
+    DAY = 2  # Sun above the day altitude during the whole validity interval
+
+
+class Ephemeris:
+    """
+    Sun zone per photometer, computed for all photometers at once from their locations.
+    A zone is valid for readings taken within [now - period, now + 2*period] of the last
+    update(), so that readings arriving late or before the next update are still covered.
+    """
+
+    def __init__(self) -> None:
+        self.zones: dict[str, SunZone] = dict()
+        self.start: datetime = None
+        self.end: datetime = None
+
+    def update(
+        self,
+        locations: dict[str, tuple[float, float]],
+        now: datetime,
+        period: float,
+        night: float,
+        day: float,
+    ) -> None:
+        """Recomputes the zones given each photometer (longitude, latitude) in degrees"""
+        names = list(locations.keys())
+        coords = np.array(list(locations.values()), dtype=np.float64).reshape(-1, 2)
+        step = timedelta(seconds=period)
+        # The Sun altitude has no extrema in between these instants, except near
+        # its culmination, where it changes too slowly to make any difference
+        instants = [now - step, now, now + step, now + 2 * step]
+        altitudes = np.stack([sun_altitude(t, coords[:, 0], coords[:, 1]) for t in instants])
+        zones = np.full(len(names), SunZone.TWILIGHT, dtype=np.int64)
+        zones[altitudes.max(axis=0) < night] = SunZone.NIGHT
+        zones[altitudes.min(axis=0) > day] = SunZone.DAY
+        self.zones = {name: SunZone(zone) for name, zone in zip(names, zones.tolist())}
+        self.start = instants[0]
+        self.end = instants[-1]
+
+    def zone(self, sample: ReadingInfo) -> SunZone:
+        if sample.longitude is not None:
+            return SunZone.TWILIGHT  # Mobile photometers do not stay at their registered location
+        if self.start is None or not (self.start <= sample.tstamp <= self.end):
+            return SunZone.TWILIGHT
+        return self.zones.get(sample.name, SunZone.TWILIGHT)
+
+    def counts(self) -> dict[str, int]:
+        result = {zone.name.lower(): 0 for zone in SunZone}
+        for zone in self.zones.values():
+            result[zone.name.lower()] += 1
+        return result
+
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def sun_altitude(when: datetime, longitude: np.ndarray, latitude: np.ndarray) -> np.ndarray:
+    """
+    Sun altitude in degrees at the given instant and locations (degrees, East positive).
+    Low precision formulae from the Astronomical Almanac, good to 0.01 degrees in this century.
+    Neither refraction nor parallax are taken into account.
+    """
+    n = when.timestamp() / 86400 + UNIX_EPOCH_JD - J2000_JD
+    mean_longitude = (280.460 + 0.9856474 * n) % 360
+    g = np.radians((357.528 + 0.9856003 * n) % 360)  # mean anomaly
+    ecliptic_longitude = np.radians(mean_longitude + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    right_ascension = np.arctan2(
+        np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude)
+    )
+    declination = np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude))
+    sidereal_time = (280.46061837 + 360.98564736629 * n) % 360  # Greenwich, degrees
+    hour_angle = np.radians(sidereal_time + longitude) - right_ascension
+    latitude = np.radians(latitude)
+    return np.degrees(
+        np.arcsin(
+            np.sin(latitude) * np.sin(declination)
+            + np.cos(latitude) * np.cos(declination) * np.cos(hour_angle)
+        )
+    )
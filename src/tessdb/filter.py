@@ -8,10 +8,14 @@
 # System wide imports
 # -------------------
 
+import os
+import time
 import asyncio
-from asyncio import Queue, PriorityQueue
+import itertools
+from asyncio import Queue
 import logging
-from typing import Any
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Iterable, Optional
 from dataclasses import dataclass, field
 
 # ---------------------------
@@ -20,15 +24,54 @@ from dataclasses import dataclass, field
 
 from pubsub import pub
 
-from tessdbapi.model import ReadingInfo
+from tessdbapi.model import ReadingInfo, ReadingInfo4c
 from tessdbapi.filter import LookAheadFilter, Sampler
 
+try:
+    from .arrayfilter import ArrayFilter
+except ImportError:
+    ArrayFilter = None
+
+try:
+    from .ephemeris import Ephemeris, SunZone
+except ImportError:
+    Ephemeris = None
+
 # --------------
 # local imports
 # -------------
 
-from . import logger
-from .constants import Topic, MessagePriority
+from . import logger, context, queues, cluster, checkpoint
+from .checkpoint import FilterSnapshot
+from .lookahead import TrackedFilter
+from .queues import LaneQueue, PartitionedQueue
+from .constants import Topic, MessagePriority, FilterEngine
+
+
+@dataclass(slots=True)
+class FlushProgress:
+    """Countdown of the filters still to be flushed, driven by the filters as they drain"""
+
+    active: int
+    pending: set[str]
+    deadline: float  # seconds, 0 = no deadline
+    start: float = field(default_factory=time.monotonic)
+    drained: dict[str, float] = field(default_factory=dict)  # seconds to drain, in drain order
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    def drain(self, names: Iterable[str], threshold: float) -> None:
+        """Filters that released their window contents"""
+        elapsed = self.elapsed
+        for name in names:
+            if name in self.pending:
+                self.pending.remove(name)
+                self.drained[name] = elapsed
+        if len(self.pending) <= threshold:
+            self.done.set()
 
 
 @dataclass(slots=True)
@@ -41,17 +84,41 @@ class State:
     disabled_for: list[str] = field(default_factory=list)
     flushing: bool = False
     threshold: float = 0.0
+    deadline: float = 0.0
+    checkpoint_path: str = ""
+    checkpoint_max_age: float = 0.0
+    ephemeris_enabled: bool = False
+    ephemeris_period: float = 300.0
+    night_altitude: float = -18.0
+    day_altitude: float = 0.0
+    num_daylight_dropped: int = 0
+    ephemeris: Optional[Ephemeris] = None  # Sun zones per photometer, None if disabled
     sync_queue: asyncio.Queue = None
+    progress: Optional[FlushProgress] = None
+    store: Optional[ArrayFilter] = None  # array engine store, None for the lookahead engine
+    engine: Optional[FilterEngine] = None
 
     def update(self, options: dict[str, Any]) -> None:
         """Updates the mutable state"""
         self.depth = options["depth"]
+        if self.engine is None:
+            # Not reloadable
+            self.engine = FilterEngine(options.get("engine", "lookahead"))
+            self.store = make_store(self.engine, self.depth)
         self.daylight_enabled = options["enable"]["daylight"]
         self.disabled_for = options["disabled_for"]
         self.sampling_dict = options["divisor"]
         self.log_level = logger.level(options["log_level"])
         self.loggers_dict = options["loggers"]
         self.threshold = options["flush_threshold"]
+        # Options added after the first release default to their former behaviour
+        self.deadline = options.get("flush_deadline", 0)
+        self.checkpoint_path = options.get("checkpoint_path", "")
+        self.checkpoint_max_age = options.get("checkpoint_max_age", 3600)
+        self.ephemeris_enabled = options.get("ephemeris", False)
+        self.ephemeris_period = options.get("ephemeris_period", 300)
+        self.night_altitude = options.get("night_altitude", -18.0)
+        self.day_altitude = options.get("day_altitude", 0.0)
         update_log_levels()
         update_selective_unbuffered()
         update_divisor()
@@ -63,15 +130,33 @@ class State:
 
 log = logging.getLogger(logger.LogSpace.FILTER.value)
 state = State(sync_queue=asyncio.Queue(maxsize=1))
+db_stats = queues.register("dbase")
 
 # -----------------
 # Auxiliar functions
 # ------------------
 
 
+def make_store(engine: FilterEngine, depth: int) -> Optional[ArrayFilter]:
+    if engine == FilterEngine.LOOKAHEAD:
+        return None
+    if ArrayFilter is None:
+        log.warning(
+            "numpy not installed, using the %s filter engine instead", FilterEngine.LOOKAHEAD
+        )
+        return None
+    return ArrayFilter(depth)
+
+
 def update_log_levels() -> None:
     global state
     log.setLevel(state.log_level)
+    if state.store is not None:
+        for name, level in state.loggers_dict.items():
+            level = logger.level(level)
+            logging.getLogger(name).setLevel(level)
+            state.store.set_traced(_slot(name), level <= logging.DEBUG)
+        return
     for name, level in state.loggers_dict.items():
         fifo = LookAheadFilter.instance(name)
         if not fifo.configured:
@@ -89,6 +174,10 @@ def update_log_levels() -> None:
 
 def update_selective_unbuffered() -> None:
     global state
+    if state.store is not None:
+        for name in state.disabled_for:
+            state.store.set_buffered(_slot(name), False)
+        return
     for name in state.disabled_for:
         filt = LookAheadFilter.instance(name)
         if not filt.configured:
@@ -98,6 +187,10 @@ def update_selective_unbuffered() -> None:
 
 def update_divisor() -> None:
     global state
+    if state.store is not None:
+        for name, N in state.sampling_dict.items():
+            state.store.set_divisor(_slot(name), N)
+        return
     for name, N in state.sampling_dict.items():
         sampler = Sampler.instance(name)
         if not sampler.configured:
@@ -105,20 +198,40 @@ def update_divisor() -> None:
         sampler.divisor = N
 
 
-def on_server_flush() -> None:
+def on_server_flush(deadline: Optional[float] = None) -> None:
     global state
-    state.flushing = True
-    for _, obj in LookAheadFilter.instances.items():
-        obj.flush()
-    try:
-        state.sync_queue.put_nowait(True)
-    except asyncio.QueueFull:
+    if state.progress is not None:
         log.warning("Ignoring further flush requests")
+        return
+    state.flushing = True
+    if state.store is not None:
+        state.store.flush()
+        active = set(state.store.names)
+        pending = state.store.pending()
+    else:
+        for _, obj in LookAheadFilter.instances.items():
+            obj.flush()
+        active = set(LookAheadFilter.instances.keys())
+        pending = active - LookAheadFilter.flushing_names
+    state.progress = FlushProgress(
+        active=len(active),
+        pending=pending,
+        deadline=state.deadline if deadline is None else deadline,
+    )
+    state.progress.drain((), state.threshold)
+    state.sync_queue.put_nowait(True)
 
 
 pub.subscribe(on_server_flush, Topic.SERVER_FLUSH)
 
 
+def on_filter_checkpoint() -> None:
+    save_checkpoint()
+
+
+pub.subscribe(on_filter_checkpoint, Topic.FILTER_CHECKPOINT)
+
+
 def on_server_reload(options: dict[str, Any]) -> None:
     global state
     state.update(options)
@@ -131,53 +244,179 @@ def on_server_reload(options: dict[str, Any]) -> None:
 async def filter_flush_monitor():
     global state
     await state.sync_queue.get()
-    log.info("Starting filter flush monitor task")
+    progress = state.progress
+    log.info(
+        "Starting filter flush monitor task. Pending filters to flush: %d/%d filters",
+        len(progress.pending),
+        progress.active,
+    )
     try:
-        while True:
-            active = set(LookAheadFilter.instances.keys())
-            pending = active - LookAheadFilter.flushing_names
-            N = len(pending)
-            M = len(active)
-            if N > state.threshold:
-                if N < state.threshold:
-                    log.info("Pending filters to flush: %d/%d filters: %s", N, M, pending)
-                else:
-                    log.info("Pending filters to flush: %d/%d filters", N, M)
-                await asyncio.sleep(5)
-            else:
-                log.info("Finally stopping at (%d/%d). Notifying database to flush buffers", N, M)
-                pub.sendMessage(Topic.DATABASE_FLUSH)
-                break
+        try:
+            await asyncio.wait_for(progress.done.wait(), timeout=progress.deadline or None)
+        except TimeoutError:
+            log.warning(
+                "Flush deadline of %.1f s reached with %d/%d filters pending: %s",
+                progress.deadline,
+                len(progress.pending),
+                progress.active,
+                sorted(progress.pending),
+            )
+        log.info(
+            "Finally stopping at (%d/%d) after %.1f s. Notifying database to flush buffers",
+            len(progress.pending),
+            progress.active,
+            progress.elapsed,
+        )
+        pub.sendMessage(Topic.DATABASE_FLUSH)
     except Exception as e:
         log.error("Flush sub-task died without acomplishinh its goal")
         log.exception(e)
 
 
-def do_filter(sample: ReadingInfo, db_queue: PriorityQueue) -> None:
-    sampling_factor = state.sampling_dict[sample.name] if sample.name in state.sampling_dict else 1
-    decimator = Sampler.instance(sample.name)
+def _sampler(name: str) -> Sampler:
+    sampling_factor = state.sampling_dict[name] if name in state.sampling_dict else 1
+    decimator = Sampler.instance(name)
     if not decimator.configured:
         decimator.configure(sampling_factor)
-    fifo = LookAheadFilter.instance(sample.name)
+    return decimator
+
+
+def _lookahead(name: str) -> LookAheadFilter:
+    fifo = LookAheadFilter.instance(name)
     if not fifo.configured:
         fifo.configure(state.depth, state.flushing, state.daylight_enabled)
-    sample = decimator.push_pop(sample)
+    return fifo
+
+
+def _slot(name: str) -> int:
+    slot = state.store.slots.get(name)
+    if slot is None:
+        sampling_factor = state.sampling_dict[name] if name in state.sampling_dict else 1
+        slot = state.store.add(name, sampling_factor, state.flushing, state.daylight_enabled)
+    return slot
+
+
+def _tracked(name: str) -> TrackedFilter:
+    return TrackedFilter.instance(_sampler(name), _lookahead(name))
+
+
+def snapshot() -> list[FilterSnapshot]:
+    if state.store is not None:
+        return [
+            FilterSnapshot(name, *state.store.dump(slot))
+            for name, slot in state.store.slots.items()
+        ]
+    return [FilterSnapshot(name, *obj.dump()) for name, obj in TrackedFilter.instances.items()]
+
+
+def restore(entries: list[FilterSnapshot]) -> None:
+    """Restores the sampler phase and filter window. The rest comes from the configuration"""
+    for entry in entries:
+        if state.store is not None:
+            state.store.load(_slot(entry.name), entry.divisor, entry.phase, entry.window)
+        else:
+            _tracked(entry.name).load(entry.divisor, entry.phase, entry.window)
+
+
+def _checkpoint_path() -> str:
+    # One snapshot per cluster worker, as each one owns a different set of photometers
+    if cluster.state.enabled:
+        return f"{state.checkpoint_path}.{cluster.state.index}"
+    return state.checkpoint_path
+
+
+def save_checkpoint() -> None:
+    if not state.checkpoint_path:
+        return
+    path = _checkpoint_path()
+    try:
+        count = checkpoint.save(path, snapshot())
+    except OSError as e:
+        log.error("Could not save filters snapshot %s: %s", path, e)
+    else:
+        log.info("Saved %d filters to snapshot %s", count, path)
+
+
+def restore_checkpoint() -> None:
+    """Restores the filters snapshot, if any. A snapshot is restored only once"""
+    if not state.checkpoint_path:
+        return
+    path = _checkpoint_path()
+    if not os.path.exists(path):
+        return
+    try:
+        entries = checkpoint.load(path, state.checkpoint_max_age)
+        restore(entries)
+    except Exception as e:
+        log.error("Could not restore filters snapshot %s: %s", path, e)
+    else:
+        log.info("Restored %d filters from snapshot %s", len(entries), path)
+    os.unlink(path)
+
+
+def daylight(samples: list[ReadingInfo]) -> tuple[list[bool], list[bool]]:
+    """
+    Flags the readings taken in clear night or daylight, which need not go through
+    the look ahead window, and the saturated readings taken in broad daylight, to be
+    dropped. Both still go through the sampler, so as not to shift its phase.
+    """
+    zone = state.ephemeris.zone
+    bypass = list()
+    discard = list()
+    for sample in samples:
+        sun = zone(sample)
+        bypass.append(sun != SunZone.TWILIGHT)
+        mag = sample.mag4 if isinstance(sample, ReadingInfo4c) else sample.mag1
+        discard.append(sun == SunZone.DAY and mag == 0)
+    return bypass, discard
+
+
+def daylight_dropped() -> int:
+    if state.store is not None:
+        return state.store.num_discarded
+    return state.num_daylight_dropped
+
+
+def do_filter(
+    sample: ReadingInfo,
+    readings: list[ReadingInfo],
+    extra: list[ReadingInfo],
+    bypass: bool = False,
+    discard: bool = False,
+) -> None:
+    ctx = context.get(sample.name)
+    tracked = ctx.tracked
+    if tracked is None:
+        tracked = ctx.tracked = _tracked(sample.name)
+    sample = tracked.sample(sample)
     if sample is None:
         return
-    sample, extra_samples = fifo.push_pop(sample)
+    if discard:
+        state.num_daylight_dropped += 1
+        return
+    fifo = tracked.lookahead
+    if bypass and fifo.buffered and not fifo.flushing:
+        # Releases the window, if any, as if flushing, but the filter is not flushed
+        sample, extra_samples = tracked.release(sample)
+    else:
+        sample, extra_samples = tracked.push_pop(sample)
     if sample is None:
         return
-    # Write extra samples in flushing state
-    for extra_sample in extra_samples:
-        if not db_queue.full():
-            db_queue.put_nowait((MessagePriority.FILTER_READINGS, extra_sample))
-        else:
-            log.warning("Reading DB Queue full: %s", dict(sample))
-    # Write normal samples
+    # Extra samples in flushing state
+    extra.extend(extra_samples)
+    # Normal samples
+    readings.append(sample)
+
+
+def enqueue(db_queue: LaneQueue, priority: MessagePriority, batch: list[ReadingInfo]) -> None:
+    if not batch:
+        return
+    db_stats.num_enqueued += len(batch)
     if not db_queue.full():
-        db_queue.put_nowait((MessagePriority.MQTT_READINGS, sample))
+        db_queue.put_nowait((priority, batch))
     else:
-        log.warning("Reading DB Queue full: %s", dict(sample))
+        db_stats.num_dropped_newest += len(batch)
+        log.warning("Reading DB Queue full, %d readings lost: %s", len(batch), dict(batch[0]))
 
 
 # --------------
@@ -187,26 +426,96 @@ def do_filter(sample: ReadingInfo, db_queue: PriorityQueue) -> None:
 background_tasks = set()
 
 
-async def filtering(options: dict[str, Any], filter_queue: Queue, db_queue: PriorityQueue) -> None:
-    global state
-
-    state.update(options)
-    task = asyncio.create_task(filter_flush_monitor())
-    background_tasks.add(task)
-    task.add_done_callback(background_tasks.discard)
-    log.info("Starting filtering task")
+async def partition(index: int, filter_queue: Queue, db_queue: LaneQueue) -> None:
+    """Filters the readings of the photometers assigned to this partition"""
+    log.info("Starting filter partition #%d", index)
     while True:
         try:
-            sample = await filter_queue.get()
+            samples = await filter_queue.get()
             # filter samples if filtering enabled
             if state.daylight_enabled:
-                do_filter(sample, db_queue)
-            elif not db_queue.full():
-                db_queue.put_nowait((MessagePriority.MQTT_READINGS, sample))
+                bypass = discard = None
+                if state.ephemeris is not None:
+                    bypass, discard = daylight(samples)
+                if state.store is not None:
+                    slots = [_slot(sample.name) for sample in samples]
+                    readings, extra = state.store.push(samples, slots, bypass, discard)
+                else:
+                    readings = list()
+                    extra = list()
+                    no = itertools.repeat(False)
+                    for sample, skip, drop in zip(samples, bypass or no, discard or no):
+                        do_filter(sample, readings, extra, skip, drop)
+                # While flushing, filters are drained once they release their window
+                # or let a reading through with an empty window
+                if state.progress is not None:
+                    state.progress.drain(
+                        {sample.name for sample in itertools.chain(extra, readings)},
+                        state.threshold,
+                    )
+                enqueue(db_queue, MessagePriority.FILTER_READINGS, extra)
+                enqueue(db_queue, MessagePriority.MQTT_READINGS, readings)
             else:
-                log.warning("NF Reading DB Queue full: %s", dict(sample))
+                enqueue(db_queue, MessagePriority.MQTT_READINGS, samples)
         except asyncio.QueueFull:
-            log.error("NF Reading DB Queue full: %s", dict(sample))
+            log.error("NF Reading DB Queue full: %d readings lost", len(samples))
         except Exception as e:
             log.error("Unexpected exception. Stack trace follows:")
             log.exception(e)
+
+
+async def ephemeris_refresher(
+    locations: Callable[[], Awaitable[dict[str, tuple[float, float]]]],
+) -> None:
+    """Periodically recomputes the Sun zone of every photometer with a known location"""
+    global state
+    warned = False
+    while True:
+        if not state.ephemeris_enabled:
+            state.ephemeris = None
+        elif Ephemeris is None:
+            if not warned:
+                log.warning("numpy not installed, daylight fast path disabled")
+                warned = True
+        else:
+            try:
+                located = await locations()
+                ephemeris = state.ephemeris or Ephemeris()
+                ephemeris.update(
+                    located,
+                    datetime.now(timezone.utc),
+                    state.ephemeris_period,
+                    state.night_altitude,
+                    state.day_altitude,
+                )
+                state.ephemeris = ephemeris
+                log.info(
+                    "Sun zones for %d located photometers: %s. Daylight readings dropped: %d",
+                    len(located),
+                    ephemeris.counts(),
+                    daylight_dropped(),
+                )
+            except Exception as e:
+                # Stale zones are no longer used once their validity interval expires
+                log.error("Could not refresh the Sun zones: %s", e)
+        await asyncio.sleep(state.ephemeris_period)
+
+
+async def filtering(
+    options: dict[str, Any],
+    filter_queue: PartitionedQueue,
+    db_queue: LaneQueue,
+    locations: Callable[[], Awaitable[dict[str, tuple[float, float]]]],
+) -> None:
+    global state
+
+    state.update(options)
+    restore_checkpoint()
+    for coro in (filter_flush_monitor(), ephemeris_refresher(locations)):
+        task = asyncio.create_task(coro)
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    log.info("Starting filtering task")
+    async with asyncio.TaskGroup() as tg:
+        for index, queue in enumerate(filter_queue.partitions):
+            tg.create_task(partition(index, queue, db_queue))
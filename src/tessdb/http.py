@@ -9,7 +9,7 @@
 # -------------------
 
 import logging
-from typing import Any
+from typing import Any, Optional
 from dataclasses import dataclass, asdict
 
 # ---------------------------
@@ -41,6 +41,11 @@ from .logger import (
 )
 from .constants import Topic
 from .mqtt import stats as mqtt_stats
+from . import cluster
+from .queues import stats as queue_stats, lane_stats
+from .references import stats as references_stats
+from .dbase import batch_stats, retry_stats, pause_stats, controller as buffer_controller
+from .filter import state as filter_state
 
 
 # -------
@@ -82,6 +87,15 @@ class FilterState(BaseModel):
     lookahead: LookAheadState
 
 
+class FlushReport(BaseModel):
+    done: bool
+    elapsed: float  # seconds since the flush started
+    deadline: float  # seconds, 0 = no deadline
+    active: int
+    pending: list[str]
+    drained: dict[str, float]  # seconds to drain per photometer, in drain order
+
+
 # ----------------
 # Global variables
 # ----------------
@@ -113,7 +127,7 @@ async def admin(options: dict[str, Any]) -> None:
     config = uvicorn.Config(
         f"{__name__}:app",
         host=state.host,
-        port=state.port,
+        port=state.port + cluster.state.index,  # one admin port per cluster worker
         log_level="error",
         use_colors=False,
     )
@@ -154,16 +168,60 @@ def server_resume():
 
 
 @app.post("/v1/server/flush")
-def server_flush():
+def server_flush(deadline: Optional[float] = None):
     log.info("server starting to flush")
-    pub.sendMessage(Topic.SERVER_FLUSH)
+    pub.sendMessage(Topic.SERVER_FLUSH, deadline=deadline)
     return {"message": "Server flush started"}
 
 
+@app.post("/v1/server/checkpoint")
+async def server_checkpoint():
+    # Runs in the event loop thread, so filters do not change while being saved
+    log.info("filters checkpoint request")
+    pub.sendMessage(Topic.FILTER_CHECKPOINT)
+    return {"message": "Filters checkpoint saved"}
+
+
+@app.post("/v1/dbase/references/invalidate")
+async def references_invalidate(name: Optional[Stars4AllName] = None):
+    # Runs in the event loop thread, as the cache is used by the database writer
+    log.info("references cache invalidation request for %s", name or "all photometers")
+    pub.sendMessage(Topic.DATABASE_INVALIDATE, name=name)
+    return {"message": "References cache invalidated"}
+
+
+@app.get("/v1/server/flush")
+def server_flush_report():
+    progress = filter_state.progress
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Server not flushing")
+    response = FlushReport(
+        done=progress.done.is_set(),
+        elapsed=progress.elapsed,
+        deadline=progress.deadline,
+        active=progress.active,
+        pending=sorted(progress.pending),
+        drained=progress.drained,
+    )
+    log.info("flush report request: %d/%d filters pending", len(response.pending), response.active)
+    return response
+
+
 @app.get("/v1/stats")
 async def server_stats():
-    stats = {"mqtt": mqtt_stats, "dbase_register": reg_stats, "dbase_readings": read_stats}
+    stats = {
+        "mqtt": mqtt_stats,
+        "dbase_register": reg_stats,
+        "dbase_readings": read_stats,
+        "dbase_references": references_stats,
+        "dbase_batches": batch_stats,
+        "dbase_buffer": buffer_controller,
+        "dbase_retries": retry_stats,
+        "dbase_pause": pause_stats,
+    }
     result = {k: asdict(v) for k, v in stats.items()}
+    result["queues"] = {k: asdict(v) for k, v in queue_stats.items()}
+    result["lanes"] = {k: dict(asdict(v), age=v.age()) for k, v in lane_stats.items()}
     return result
 
 
@@ -0,0 +1,117 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import logging
+import itertools
+from collections import deque
+from typing import Optional
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbapi.model import ReadingInfo
+from tessdbapi.filter import LookAheadFilter, Sampler
+
+# -------
+# Classes
+# -------
+
+
+class TrackedFilter:
+    """
+    tessdbapi Sampler + LookAheadFilter of a photometer.
+    The sampler phase and the filter window are private to tessdbapi, so they are
+    tracked here from the public results of both objects, as needed to save and
+    restore them and to release the window in the daylight fast path.
+    """
+
+    instances = dict()
+
+    @classmethod
+    def instance(cls, sampler: Sampler, lookahead: LookAheadFilter):
+        obj = cls.instances.get(lookahead.name)
+        if obj is None:
+            obj = cls(sampler, lookahead)
+            cls.instances[lookahead.name] = obj
+        return obj
+
+    @classmethod
+    def reset(cls) -> None:
+        """For testing purposes"""
+        cls.instances = dict()
+
+    def __init__(self, sampler: Sampler, lookahead: LookAheadFilter) -> None:
+        self.sampler = sampler
+        self.lookahead = lookahead
+        self.log = logging.getLogger(lookahead.name)
+        self.phase = 0  # next sampler cycle value, 0 = the next reading is allowed
+        self.window = deque(maxlen=lookahead.window)  # youngest reading first
+        self._skipped = 0  # readings dropped here before handing over to a restored sampler
+
+    def sample(self, sample: ReadingInfo) -> Optional[ReadingInfo]:
+        """Sampler stage"""
+        if self._skipped:
+            # The restored sampler starts a new cycle when the restored one ends
+            self._skipped -= 1
+            self.phase = (self.phase + 1) % self.sampler.divisor
+            self.log.debug("%s: dropping %s", self.__class__.__name__, dict(sample))
+            return None
+        result = self.sampler.push_pop(sample)
+        # An allowed reading also starts the new cycle of a changed divisor, skipping 0
+        self.phase = (self.phase + 1 if result is None else 1) % self.sampler.divisor
+        return result
+
+    def push_pop(self, sample: ReadingInfo) -> tuple[Optional[ReadingInfo], list[ReadingInfo]]:
+        """Look ahead filter stage"""
+        fifo = self.lookahead
+        if fifo.buffered and not fifo.flushing:
+            self.window.appendleft(sample)
+        else:
+            self.window.clear()
+        return fifo.push_pop(sample)
+
+    def release(self, sample: ReadingInfo) -> tuple[ReadingInfo, list[ReadingInfo]]:
+        """
+        Lets the sample through, releasing the window as a flushing filter does,
+        but without flushing the filter
+        """
+        fifo = self.lookahead
+        extra_samples = list(itertools.islice(self.window, fifo.window // 2))
+        if self.window:
+            self.window.clear()
+            # Reconfiguring is the only public way of emptying the window
+            fifo.configure(fifo.window, False, fifo.buffered)
+            self.log.debug(
+                "%s: releasing %d extra readings", self.__class__.__name__, len(extra_samples)
+            )
+        return sample, extra_samples
+
+    def dump(self) -> tuple[int, int, list[ReadingInfo]]:
+        """Sampler divisor & phase and filter window, youngest reading first"""
+        return self.sampler.divisor, self.phase, list(self.window)
+
+    def load(self, divisor: int, phase: int, window: list[ReadingInfo]) -> None:
+        """Restores what dump() returned. Only the youngest readings fitting the window are kept"""
+        self.sampler.configure(divisor)
+        self.phase = phase % divisor
+        self._skipped = (divisor - self.phase) % divisor
+        fifo = self.lookahead
+        flushing, buffered = fifo.flushing, fifo.buffered
+        window = window[: fifo.window]
+        # Refill an empty, buffered window oldest reading first and discard what comes out
+        fifo.configure(fifo.window, False, True)
+        for item in reversed(window):
+            fifo.push_pop(item)
+        fifo.buffered = buffered
+        if flushing:
+            fifo.flush()
+        self.window.clear()
+        self.window.extend(window)
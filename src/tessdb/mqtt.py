@@ -8,13 +8,15 @@
 # System wide imports
 # -------------------
 
-import json
+import time
 import asyncio
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from datetime import datetime
 from dataclasses import dataclass, field
-from typing import Any, Optional, Union
+from typing import Any, Iterable, Optional, Union
 
 # ---------------------------
 # Third-party library imports
@@ -27,22 +29,18 @@ import aiomqtt
 from aiomqtt.client import ProtocolVersion
 from pubsub import pub
 
-from tessdbdao import PhotometerModel, TimestampSource, RegisterState
 from tessdbapi.model import PhotometerInfo, ReadingInfo1c, ReadingInfo4c
 
 # --------------
 # local imports
 # -------------
 
-from . import logger
+from . import logger, context, cluster, queues
+from .context import SequenceWindow
+from .router import Route, TopicRouter
+from .capture import CaptureWriter
 from .constants import MessagePriority, Topic
-
-
-# ---------
-# CONSTANTS
-# ---------
-
-TESS4C_FILTER_KEYS = ("F1", "F2", "F3", "F4")
+from .decoder import Decoder, DECODE_ERRORS, make_decoder, init_worker, decode_readings
 
 # ------------------
 # Additional Classes
@@ -55,6 +53,8 @@ class Stats:
     num_readings: int = 0
     num_register: int = 0
     num_filtered: int = 0
+    num_duplicated: int = 0
+    num_handoff: int = 0
 
     def reset(self) -> None:
         """Resets stat counters"""
@@ -62,11 +62,20 @@ class Stats:
         self.num_readings = 0
         self.num_register = 0
         self.num_filtered = 0
+        self.num_duplicated = 0
+        self.num_handoff = 0
 
     def show(self) -> None:
         log.info(
-            "MQTT Stats [Total, Reads, Register, Discarded] = %s",
-            [stats.num_published, stats.num_readings, stats.num_register, stats.num_filtered],
+            "MQTT Stats [Total, Reads, Register, Discarded, Duplicated, Handoff] = %s",
+            [
+                stats.num_published,
+                stats.num_readings,
+                stats.num_register,
+                stats.num_filtered,
+                stats.num_duplicated,
+                stats.num_handoff,
+            ],
         )
 
 
@@ -81,24 +90,100 @@ class State:
     keepalive: int = 60
     topic_register: str = ""
     topics: list[str] = field(default_factory=list)
-    white_list: list[str] = field(default_factory=list)
-    black_list: list[str] = field(default_factory=list)
     log_level: int = 0
     protocol_log_level: int = 0
+    decoder: Decoder = None
+    batch_size: int = 1
+    batch_latency: float = 0.0
+    decode_workers: int = 0
+    dedup_window: int = 0
+    router: TopicRouter = None
+    capture: Optional[CaptureWriter] = None
 
     def update(self, options: dict[str, Any]) -> None:
         """Updates the mutable state"""
         self.topics = options["tess_topics"]
         self.topic_register = options["tess_topic_register"]
         self.keepalive = options["keepalive"]
-        self.white_list = options["tess_whitelist"]
-        self.black_list = options["tess_blacklist"]
+        filters = [(self.topic_register, Route.REGISTER)]
+        filters.extend((topic, Route.READING) for topic in self.topics)
+        if cluster.state.enabled:
+            filters.append((cluster.handoff_topic(cluster.state.index), Route.HANDOFF))
+        self.router = TopicRouter(filters, default=Route.READING)
+        context.configure(options["tess_whitelist"], options["tess_blacklist"])
+        # Options added after the first release default to their former behaviour
+        self.decoder = make_decoder(options.get("decoder", "pydantic"))
+        self.batch_size = options.get("batch_size", 1)
+        self.batch_latency = options.get("batch_latency", 0.0)
+        self.decode_workers = options.get("decode_workers", 0)
+        self.dedup_window = options.get("dedup_window", 0)
+        if self.capture is not None:
+            self.capture.close()
+        self.capture = (
+            CaptureWriter(
+                options["capture_dir"],
+                options.get("capture_size", 64) * 1024 * 1024,
+                options.get("capture_files", 10),
+            )
+            if options.get("capture_dir")
+            else None
+        )
         self.log_level = logger.level(options["log_level"])
         log.setLevel(self.log_level)
         self.protocol_log_level = logger.level(options["protocol_log_level"])
         log.setLevel(self.protocol_log_level)
 
 
+@dataclass(slots=True)
+class DecodePool:
+    """Readings decoding process pool, resized when decode_workers changes"""
+
+    filt_queue: queues.PartitionedQueue
+    db_queue: queues.LaneQueue
+    workers: int = 0  # 0 = no pool, readings are decoded in the event loop
+    executor: Optional[ProcessPoolExecutor] = None
+    pending: Optional[asyncio.Queue] = None  # (readings, future) in sending order
+    collector: Optional[asyncio.Task] = None
+
+    async def resize(self, workers: int) -> None:
+        if workers == self.workers:
+            return
+        if self.executor is not None:
+            # Readings already sent to the pool are dispatched before the next ones
+            await self.pending.join()
+            self.close()
+        self.workers = workers
+        if workers > 0:
+            log.info("Decoding readings in a pool of %d processes", workers)
+            self.executor = _make_pool(workers)
+            self.pending = asyncio.Queue(maxsize=2 * workers)
+            self.collector = asyncio.create_task(
+                _collector(self.pending, self.filt_queue, self.db_queue)
+            )
+        else:
+            log.info("Decoding readings in the server process")
+
+    async def submit(self, readings: list[Union[bytes, dict]]) -> None:
+        """Sends the readings to the pool. Waits here when the pool lags behind"""
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self.executor, decode_readings, readings)
+        except BrokenProcessPool:
+            log.error("Decoding process pool is broken, restarting it")
+            self.executor = _make_pool(self.workers)
+            future = loop.run_in_executor(self.executor, decode_readings, readings)
+        await self.pending.put((readings, future))
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.collector.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+            self.pending = None
+            self.collector = None
+        self.workers = 0
+
+
 # ----------------
 # Global variables
 # ----------------
@@ -107,6 +192,8 @@ log = logging.getLogger(logger.LogSpace.MQTT.value)
 proto_log = logging.getLogger("MQTT")
 stats = Stats()
 state = State()
+db_stats = queues.register("dbase")
+client_class = aiomqtt.Client  # The replay tool replaces it with a fake client
 
 # -----------------
 # Auxiliar functions
@@ -131,187 +218,248 @@ def on_server_reload(options: dict[str, Any]) -> None:
 # pub.subscribe(on_server_reload, Topic.SERVER_RELOAD)
 
 
-def is_tess4c_payload(row: dict[str, Any]) -> bool:
-    return "F4" in row
-
-
-def _remap_tess4c_reading(row: dict[str, Any]) -> None:
-    """Flatten the JSON structure for further processing"""
-    for i, filt in enumerate(TESS4C_FILTER_KEYS, 1):
-        for key, value in row[filt].items():
-            row[f"{key}{i}"] = value
-    for filt in TESS4C_FILTER_KEYS:
-        del row[filt]
-
-
-def _remap_tess4c_register(row: dict[str, Any]) -> None:
-    """Flatten the JSON structure for further processing"""
-    for i, filt in enumerate(TESS4C_FILTER_KEYS, 1):
-        for key, value in row[filt].items():
-            row[f"{key}{i}"] = value
-    for filt in TESS4C_FILTER_KEYS:
-        del row[filt]
-    row["model"] = PhotometerModel.TESS4C
-
-
-def _remap_tessw_reading(row: dict[str, Any]):
-    """remaps keywords for the filter/database statges"""
-    row["mag1"] = row["mag"]
-    row["freq1"] = row["freq"]
-    del row["mag"]
-    del row["freq"]
-
-
-def _remap_tessw_register(row: dict[str, Any]):
-    """remaps keywords for the filter/database statges"""
-    row["calib1"] = row["calib"]
-    del row["calib"]
-    row["offsethz1"] = row.get("offsethz", 0.0)
-    if "offsethz" in row:
-        del row["offsethz"]
-    row["model"] = PhotometerModel.TESSW
-
-
-def _handle_reading(
-    row: dict[str, Any], now: Optional[datetime], src: TimestampSource
-) -> Union[None, ReadingInfo1c, ReadingInfo4c]:
+def _handle_reading(payload: Union[bytes, dict]) -> Union[None, ReadingInfo1c, ReadingInfo4c]:
     """
     Handle actual reqadings data coming from onum_published()
     """
-    global stats
-    stats.num_readings += 1
     info = None
     try:
-        if is_tess4c_payload(row):
-            _remap_tess4c_reading(row)
-            info = ReadingInfo4c(
-                tstamp=now,
-                tstamp_src=src,
-                name=row["name"],
-                sequence_number=row["seq"],
-                box_temperature=row.get("tamb"),
-                sky_temperature=row.get("tsky"),
-                signal_strength=row["wdBm"],
-                hash=row.get("hash"),
-                freq1=row["freq1"],
-                mag1=row["mag1"],
-                freq2=row["freq2"],
-                mag2=row["mag2"],
-                freq3=row["freq3"],
-                mag3=row["mag3"],
-                freq4=row["freq4"],
-                mag4=row["mag4"],
-            )
-        else:
-            _remap_tessw_reading(row)
-            info = ReadingInfo1c(
-                tstamp=now,
-                tstamp_src=src,
-                name=row["name"],
-                sequence_number=row["seq"],
-                box_temperature=row["tamb"],
-                sky_temperature=row["tsky"],
-                signal_strength=row["wdBm"],
-                hash=row.get("hash"),
-                freq1=row["freq1"],
-                mag1=row["mag1"],
-            )
-
+        info = state.decoder.reading(payload)
+    except DECODE_ERRORS as e:
+        log.error("Invalid payload=%s", payload)
+        log.error(e)
     except ValidationError as e:
-        log.error("Validation error in readings payload: %s", row)
+        log.error("Validation error in readings payload: %s", payload)
         log.error(e)
         for v in e.errors():
             log.error(v)
     except KeyError as e:
-        log.info("Missing payload field in %s", row)
+        log.info("Missing payload field in %s", payload)
+        log.error(e)
+    except ValueError as e:
+        log.error("Invalid value in readings payload: %s", payload)
         log.error(e)
     except Exception as e:
-        log.error("Unexpected exception when dealing with readings %s. Stack trace follows:", row)
+        log.error(
+            "Unexpected exception when dealing with readings %s. Stack trace follows:", payload
+        )
         log.error(e)
     return info
 
 
-def _handle_register(
-    row: dict[str, Any], now: Optional[datetime], src: TimestampSource
-) -> Optional[PhotometerInfo]:
+def _handle_register(payload: Union[bytes, dict]) -> Optional[PhotometerInfo]:
     """
     Handle registration data coming from onum_published()
     """
-    global stats
-    plog = logging.getLogger(row["name"])
-    stats.num_register += 1
-    # 'now' is usualy None, so we don't log it
-    log.info("Register message: %s", row)
-    plog.debug("Register message: %s", row)
+    log.info("Register message: %s", payload)
     info = None
-    compilation_date = row.get("date")
-    if not compilation_date:
-        row["firmware"] = row.get("firmware")
-    else:
-        row["firmware"] = f"{row.get('firmware')} ({compilation_date})"
     try:
-        if is_tess4c_payload(row):
-            _remap_tess4c_register(row)
-            info = PhotometerInfo(
-                name=row["name"],
-                mac_address=row["mac"],
-                model=PhotometerModel.TESS4C,
-                authorised=False,
-                registered=RegisterState.AUTO,
-                firmware=row["firmware"],
-                zp1=row["calib1"],
-                filter1=row["band1"],
-                offset1=row.get("offsethz1", 0),
-                zp2=row["calib2"],
-                filter2=row["band2"],
-                offset2=row.get("offsethz2", 0),
-                zp3=row["calib3"],
-                filter3=row["band3"],
-                offset3=row.get("offsethz3", 0),
-                zp4=row["calib4"],
-                filter4=row["band4"],
-                offset4=row.get("offsethz4", 0),
-                tstamp=now,
-                tstamp_src=src,
-            )
-        else:
-            _remap_tessw_register(row)
-            info = PhotometerInfo(
-                name=row["name"],
-                mac_address=row["mac"],
-                model=PhotometerModel.TESSW,
-                # firmware="0.1.0",
-                authorised=False,
-                registered=RegisterState.AUTO,
-                firmware=row.get("firmware"),
-                zp1=row["calib1"],
-                filter1=row.get("filter1", "UV/IR-740"),
-                offset1=row["offsethz1"],
-                tstamp=now,
-                tstamp_src=src,
-            )
+        info = state.decoder.register(payload)
+    except DECODE_ERRORS as e:
+        log.error("Invalid payload=%s", payload)
+        log.error(e)
     except ValidationError as e:
-        log.error("Validation error in registration payload: %s", row)
+        log.error("Validation error in registration payload: %s", payload)
         for v in e.errors():
             log.error(v)
     except KeyError as e:
-        log.error("Missing payload field in %s", row)
+        log.error("Missing payload field in %s", payload)
         log.error(e)
     except Exception as e:
         log.error(
-            "Unexpected exception when dealing with registration %s. Stack trace follows:", row
+            "Unexpected exception when dealing with registration %s. Stack trace follows:", payload
         )
         log.exception(e)
+    else:
+        context.get(info.name).log.debug("Register message: %s", payload)
     return info
 
 
+def _peek(
+    payload: bytes,
+) -> tuple[Optional[tuple[str, Optional[int], Optional[str]]], Union[bytes, dict]]:
+    """
+    Photometer name, sequence number and hash of a payload, without fully decoding it,
+    and the payload to decode, already parsed if the decoder had to parse it for the header
+    """
+    try:
+        return state.decoder.peek(payload)
+    except Exception:
+        # Let the regular decoding path deal with and log the malformed payload
+        return None, payload
+
+
+def _duplicated(name: str, seq: Optional[int], hsh: Optional[str]) -> bool:
+    if seq is None:
+        return False
+    ctx = context.get(name)
+    if ctx.window is None:
+        ctx.window = SequenceWindow(state.dedup_window)
+    return ctx.window.seen(seq, hsh)
+
+
+def _classify(
+    batch: list[aiomqtt.Message],
+) -> tuple[list[Union[bytes, dict]], list[Union[bytes, dict]], list[tuple[str, bytes]]]:
+    """
+    Splits a batch of messages into register payloads, readings payloads to decode
+    and, in cluster mode, (topic, payload) readings to be handed off to their owner worker.
+    """
+    global stats
+    registers = list()
+    readings = list()
+    handoff = list()
+    num_filtered = 0
+    num_duplicated = 0
+    listed = bool(context.state.white_list or context.state.black_list)
+    peek = listed or cluster.state.enabled or state.dedup_window > 0
+    for message in batch:
+        # Discard retained messages to avoid duplicates in the database
+        if message.retain:
+            log.debug("Discarded payload by retained flag")
+            num_filtered += 1
+            continue
+        route = state.router.route(message.topic.value)
+        header, payload = _peek(message.payload) if peek else (None, message.payload)
+        # Apply White & Black List filters before decoding, to the name as published
+        if listed and header is not None:
+            ctx = context.get(header[0])
+            if ctx.discarded_by is not None:
+                ctx.log.debug("Discarded payload by %s", ctx.discarded_by)
+                ctx.num_filtered += 1
+                num_filtered += 1
+                continue
+        if route == Route.REGISTER:
+            registers.append(payload)
+        else:
+            if header is not None:
+                # As validated later on, photometer names are case insensitive
+                name, seq, hsh = header[0].lower(), header[1], header[2]
+                if cluster.state.enabled and route != Route.HANDOFF:
+                    index = cluster.owner(name)
+                    if index != cluster.state.index:
+                        handoff.append((cluster.handoff_topic(index), message.payload))
+                        continue
+                if state.dedup_window > 0 and _duplicated(name, seq, hsh):
+                    log.debug("Discarded duplicated payload %s", message.payload)
+                    num_duplicated += 1
+                    continue
+            readings.append(payload)
+    stats.num_published += len(batch)
+    stats.num_register += len(registers)
+    stats.num_readings += len(readings)
+    stats.num_filtered += num_filtered
+    stats.num_duplicated += num_duplicated
+    stats.num_handoff += len(handoff)
+    return registers, readings, handoff
+
+
+def _dispatch(
+    infos: Iterable[Union[None, PhotometerInfo, ReadingInfo1c, ReadingInfo4c]],
+    filt_queue: queues.PartitionedQueue,
+    db_queue: queues.LaneQueue,
+) -> None:
+    """Enqueues registrations and all readings at once"""
+    readings = list()
+    for info in infos:
+        if info is None:
+            continue
+        if isinstance(info, PhotometerInfo):
+            db_stats.num_enqueued += 1
+            if not db_queue.full():
+                db_queue.put_nowait((MessagePriority.REGISTER, info))
+            else:
+                db_stats.num_dropped_newest += 1
+                log.warning("Register DBQueue full: %s", dict(info))
+        else:
+            context.get(info.name).num_readings += 1
+            readings.append(info)
+    if readings:
+        # Never full, see queues.SheddingQueue
+        filt_queue.put_nowait(readings)
+
+
+def _handle_batch(
+    batch: list[aiomqtt.Message], filt_queue: queues.PartitionedQueue, db_queue: queues.LaneQueue
+) -> list[tuple[str, bytes]]:
+    """
+    Decodes and validates a batch of messages in the event loop and enqueues all its readings
+    at once. In cluster mode, returns the (topic, payload) readings to be handed off.
+    """
+    registers, readings, handoff = _classify(batch)
+    infos = [_handle_register(payload) for payload in registers]
+    infos.extend(_handle_reading(payload) for payload in readings)
+    _dispatch(infos, filt_queue, db_queue)
+    return handoff
+
+
+def _make_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawn a fresh interpreter rather than forking this multithreaded process
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(state.decoder.name,),
+    )
+
+
+async def _collector(
+    pending: asyncio.Queue, filt_queue: queues.PartitionedQueue, db_queue: queues.LaneQueue
+) -> None:
+    """Dispatches the readings decoded by the process pool in the same order they were sent"""
+    while True:
+        readings, future = await pending.get()
+        try:
+            try:
+                infos = await future
+            except Exception as e:
+                log.error("Process pool failed decoding %d readings, decoding here", len(readings))
+                log.exception(e)
+                infos = [None] * len(readings)
+            # Decode again here the bad payloads to log why they failed
+            infos = [
+                info if info is not None else _handle_reading(payload)
+                for payload, info in zip(readings, infos)
+            ]
+            _dispatch(infos, filt_queue, db_queue)
+        except Exception as e:
+            # Keep collecting, otherwise the subscriber would block on a full pending queue
+            log.error("Unexpected exception dispatching %d readings, discarded", len(readings))
+            log.exception(e)
+        finally:
+            pending.task_done()
+
+
+async def _drain(
+    messages: aiomqtt.MessagesIterator,
+    batch: list[aiomqtt.Message],
+    received: Optional[list[int]] = None,
+) -> None:
+    """
+    Appends to the batch the messages already buffered by the client, up to the batch size.
+    If still not full, waits batch_latency seconds once for more messages to arrive.
+    When capturing, their receive times (ns since epoch) are appended to received.
+    """
+
+    async def take() -> None:
+        while len(batch) < state.batch_size and len(messages) > 0:
+            batch.append(await anext(messages))
+            if received is not None:
+                received.append(time.time_ns())
+
+    await take()
+    if len(batch) < state.batch_size and state.batch_latency > 0:
+        await asyncio.sleep(state.batch_latency)
+        await take()
+
+
 # --------------
 # The MQTT task
 # --------------
 
 
 async def subscriber(
-    options: dict[str, Any], filt_queue: asyncio.Queue, db_queue: asyncio.PriorityQueue
+    options: dict[str, Any], filt_queue: queues.PartitionedQueue, db_queue: queues.LaneQueue
 ) -> None:
     global stats
     global state
@@ -320,69 +468,64 @@ async def subscriber(
     log.setLevel(state.log_level)
     proto_log.setLevel(state.protocol_log_level)
     log.info("Starting MQTT subscriber")
-    client = aiomqtt.Client(
+    if cluster.state.enabled:
+        # Shared subscriptions are only available in MQTT v5
+        identifier = f"{state.client_id}-{cluster.state.index}"
+        protocol = ProtocolVersion.V5
+        subscribe = cluster.shared
+    else:
+        identifier = state.client_id
+        protocol = ProtocolVersion.V311
+        subscribe = str
+    pool = DecodePool(filt_queue, db_queue)
+    await pool.resize(state.decode_workers)
+    client = client_class(
         state.host,
         state.port,
         username=state.username,
         password=state.password,
-        identifier=state.client_id,
+        identifier=identifier,
         logger=proto_log,
         transport=state.transport,
         keepalive=state.keepalive,
-        protocol=ProtocolVersion.V311,
+        protocol=protocol,
     )
-    while True:
-        try:
-            async with client:
-                log.info("subscribing to %s", state.topic_register)
-                await client.subscribe(state.topic_register, qos=2)
-                for topic in state.topics:
-                    log.info("subscribing to %s", topic)
-                    await client.subscribe(topic, qos=2)
-                async for message in client.messages:
-                    try:
-                        stats.num_published += 1
-                        payload = message.payload.decode("utf-8")
-                        row = json.loads(payload)
-                        if "tstamp" not in row:
-                            tstamp, tsmap_src = None, TimestampSource.SUBSCRIBER
-                        else:
-                            tstamp, tsmap_src = row["tstamp"], TimestampSource.PUBLISHER
-                        plog = logging.getLogger(row["name"])
-                        # Discard retained messages to avoid duplicates in the database
-                        if message.retain:
-                            plog.debug("Discarded payload by retained flag")
-                            stats.num_filtered += 1
-                            continue
-                        # Apply White List filter
-                        if state.white_list and row["name"] not in state.white_list:
-                            plog.debug("Discarded payload by whitelist")
-                            stats.num_filtered += 1
-                            continue
-                        # Apply Black List filter
-                        if state.black_list and row["name"] in state.black_list:
-                            plog.debug("Discarded payload by blacklist")
-                            stats.num_filtered += 1
-                            continue
-                        # Handle registering
-                        if message.topic.matches(state.topic_register):
-                            info = _handle_register(row, tstamp, tsmap_src)
-                            if info:
-                                if not db_queue.full():
-                                    db_queue.put_nowait((MessagePriority.REGISTER, info))
-                                else:
-                                    log.warning("Register DBQueue full: %s", dict(info))
+    try:
+        while True:
+            try:
+                async with client:
+                    log.info("subscribing to %s", subscribe(state.topic_register))
+                    await client.subscribe(subscribe(state.topic_register), qos=2)
+                    for topic in state.topics:
+                        log.info("subscribing to %s", subscribe(topic))
+                        await client.subscribe(subscribe(topic), qos=2)
+                    if cluster.state.enabled:
+                        topic = cluster.handoff_topic(cluster.state.index)
+                        log.info("subscribing to %s", topic)
+                        await client.subscribe(topic, qos=1)
+                    async for message in client.messages:
+                        batch = [message]
+                        received = None if state.capture is None else [time.time_ns()]
+                        if state.batch_size > 1:
+                            await _drain(client.messages, batch, received)
+                        if state.capture is not None:
+                            state.capture.write(batch, received)
+                        if state.decode_workers != pool.workers:
+                            await pool.resize(state.decode_workers)
+                        if pool.workers == 0:
+                            handoff = _handle_batch(batch, filt_queue, db_queue)
                         else:
-                            info = _handle_reading(row, tstamp, tsmap_src)
-                            if info:
-                                filt_queue.put_nowait(info)
-                    except json.JSONDecodeError:
-                        log.error("Invalid JSON in payload=%s", payload)
-                    except asyncio.QueueFull:
-                        log.error("Queue full for %s", row)
-        except aiomqtt.MqttError:
-            log.warning(f"Connection lost; Reconnecting in {interval} seconds ...")
-            await asyncio.sleep(interval)
-        except Exception as e:
-            log.critical("Unexpected & unhandled exception, see details below")
-            log.exception(e)
+                            registers, readings, handoff = _classify(batch)
+                            _dispatch(map(_handle_register, registers), filt_queue, db_queue)
+                            if readings:
+                                await pool.submit(readings)
+                        for topic, payload in handoff:
+                            await client.publish(topic, payload, qos=1)
+            except aiomqtt.MqttError:
+                log.warning(f"Connection lost; Reconnecting in {interval} seconds ...")
+                await asyncio.sleep(interval)
+            except Exception as e:
+                log.critical("Unexpected & unhandled exception, see details below")
+                log.exception(e)
+    finally:
+        pool.close()
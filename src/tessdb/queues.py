@@ -0,0 +1,461 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import sys
+import time
+import pickle
+import asyncio
+import logging
+import tempfile
+from typing import Any, Optional
+from collections import Counter, deque
+from dataclasses import dataclass
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from pubsub import pub
+
+from tessdbapi.model import ReadingInfo
+
+# --------------
+# local imports
+# -------------
+
+from . import logger, cluster
+from .constants import MessagePriority, OverflowPolicy, Topic
+
+# ---------
+# Constants
+# ---------
+
+UNBOUNDED = sys.maxsize  # readings, default watermarks
+
+# -------
+# Classes
+# -------
+
+
+@dataclass(slots=True)
+class QueueStats:
+    num_enqueued: int = 0
+    num_dequeued: int = 0
+    num_dropped_oldest: int = 0
+    num_dropped_newest: int = 0
+    num_dropped_fair: int = 0
+    num_spilled: int = 0
+    num_unspilled: int = 0
+    num_high_watermark: int = 0
+    size: int = 0  # readings currently queued in memory, not a counter
+    spill_size: int = 0  # readings currently spilled to disk, not a counter
+    rate: float = 0.0  # dequeued readings/s in the last stats period, not a counter
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_enqueued = 0
+        self.num_dequeued = 0
+        self.num_dropped_oldest = 0
+        self.num_dropped_newest = 0
+        self.num_dropped_fair = 0
+        self.num_spilled = 0
+        self.num_unspilled = 0
+        self.num_high_watermark = 0
+
+    def show(self, name: str) -> None:
+        log.info(
+            "%s Queue Stats [Enq, Deq, Drop Oldest, Newest, Fair, Spill, HWM, Size] = %s, %.1f/s",
+            name,
+            [
+                self.num_enqueued,
+                self.num_dequeued,
+                self.num_dropped_oldest,
+                self.num_dropped_newest,
+                self.num_dropped_fair,
+                self.num_spilled,
+                self.num_high_watermark,
+                self.size + self.spill_size,
+            ],
+            self.rate,
+        )
+
+
+@dataclass(slots=True)
+class LaneStats:
+    num_enqueued: int = 0
+    num_dequeued: int = 0
+    size: int = 0  # items currently queued, not a counter
+    max_size: int = 0
+    total_wait: float = 0.0  # seconds queued of the dequeued items
+    max_wait: float = 0.0
+    oldest: float = 0.0  # time.monotonic() the oldest queued item was queued, not a counter
+
+    def age(self) -> float:
+        """Seconds the oldest queued item has been waiting"""
+        return time.monotonic() - self.oldest if self.size else 0.0
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_enqueued = 0
+        self.num_dequeued = 0
+        self.max_size = self.size
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def show(self, name: str) -> None:
+        log.info(
+            "%s Lane Stats [Enq, Deq, Size, Max Size, Age, Avg Wait, Max Wait] = %s",
+            name,
+            [
+                self.num_enqueued,
+                self.num_dequeued,
+                self.size,
+                self.max_size,
+                round(self.age(), 3),
+                round(self.total_wait / self.num_dequeued, 3) if self.num_dequeued else 0.0,
+                round(self.max_wait, 3),
+            ],
+        )
+
+
+class Spill:
+    """Append only file of pickled readings batches, read back in FIFO order"""
+
+    def __init__(self, directory: str, name: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix=f"{name}-", suffix=".spill", dir=directory)
+        os.close(fd)
+        self._writer = open(self.path, "wb")
+        self._reader = open(self.path, "rb")
+        self.batches = 0
+
+    def write(self, batch: list[ReadingInfo]) -> None:
+        pickle.dump(batch, self._writer, protocol=pickle.HIGHEST_PROTOCOL)
+        self.batches += 1
+
+    def read(self) -> list[ReadingInfo]:
+        self._writer.flush()
+        batch = pickle.load(self._reader)
+        self.batches -= 1
+        if self.batches == 0:
+            # Fully drained, reclaim the disk space
+            self._writer.seek(0)
+            self._writer.truncate()
+            self._reader.seek(0)
+        return batch
+
+    def close(self) -> None:
+        self._writer.close()
+        self._reader.close()
+        os.unlink(self.path)
+
+
+class SheddingQueue(asyncio.Queue):
+    """
+    Queue of readings batches bounded by the number of readings, not batches.
+    Producers never block nor get QueueFull. Above the high watermark, the overflow policy
+    decides which readings are dropped (or spilled to disk) until the queue drains below
+    the low watermark again.
+    """
+
+    def __init__(self, name: str, options: dict[str, Any]) -> None:
+        super().__init__()
+        self.name = name
+        self.stats = register(name)
+        self.shedding = False
+        self.spill_dir = options.get("spill_dir") or tempfile.gettempdir()
+        self.configure(options)
+
+    def configure(self, options: dict[str, Any]) -> None:
+        """Reloadable watermarks and policy"""
+        # Unbounded unless configured, as it was before
+        self.high = options.get("high_watermark", UNBOUNDED)
+        self.low = min(options.get("low_watermark", UNBOUNDED), self.high)
+        self.policy = OverflowPolicy(options.get("policy", OverflowPolicy.DROP_OLDEST))
+
+    def _init(self, maxsize: int) -> None:
+        super()._init(maxsize)
+        self._per_name = Counter()
+        self._spill: Optional[Spill] = None
+
+    def _put(self, batch: list[ReadingInfo]) -> None:
+        super()._put(batch)
+        self.stats.size += len(batch)
+        self._per_name.update(reading.name for reading in batch)
+
+    def _get(self) -> list[ReadingInfo]:
+        batch = super()._get()
+        self._forget(batch)
+        self.stats.num_dequeued += len(batch)
+        if self.stats.size <= self.low:
+            self._unspill()
+            if self.shedding:
+                self.shedding = False
+                log.info("%s queue below low watermark (%d)", self.name, self.low)
+        return batch
+
+    def _forget(self, batch: list[ReadingInfo]) -> None:
+        self.stats.size -= len(batch)
+        self._per_name.subtract(reading.name for reading in batch)
+
+    def _unspill(self) -> None:
+        while self._spill is not None and self._spill.batches and self.stats.size < self.high:
+            batch = self._spill.read()
+            self.stats.spill_size -= len(batch)
+            self.stats.num_unspilled += len(batch)
+            super()._put(batch)
+            self.stats.size += len(batch)
+            self._per_name.update(reading.name for reading in batch)
+
+    def _shed(self, batch: list[ReadingInfo]) -> Optional[list[ReadingInfo]]:
+        """Applies the overflow policy. Returns what is left to queue in memory, if any"""
+        if self.policy == OverflowPolicy.DROP_NEWEST:
+            self.stats.num_dropped_newest += len(batch)
+            return None
+        if self.policy == OverflowPolicy.DROP_OLDEST:
+            while self._queue and self.stats.size + len(batch) > self.low:
+                oldest = self._queue.popleft()
+                self._forget(oldest)
+                self.stats.num_dropped_oldest += len(oldest)
+                # Never to be processed by the consumer
+                self.task_done()
+            return batch
+        if self.policy == OverflowPolicy.FAIR:
+            incoming = Counter(reading.name for reading in batch)
+            share = max(1, self.low // len(set(+self._per_name) | set(incoming)))
+            incoming.clear()
+            kept = list()
+            for reading in batch:
+                # The readings kept from this batch count towards the share as well
+                if self._per_name[reading.name] + incoming[reading.name] < share:
+                    incoming[reading.name] += 1
+                    kept.append(reading)
+            self.stats.num_dropped_fair += len(batch) - len(kept)
+            return kept or None
+        self._spill_batch(batch)  # OverflowPolicy.SPILL
+        return None
+
+    def _spill_batch(self, batch: list[ReadingInfo]) -> None:
+        if self._spill is None:
+            self._spill = Spill(self.spill_dir, self.name)
+            log.info("%s queue spilling to %s", self.name, self._spill.path)
+        self._spill.write(batch)
+        self.stats.spill_size += len(batch)
+        self.stats.num_spilled += len(batch)
+        # Spilled batches are queued as well, as far as task_done() and join() are concerned
+        self._unfinished_tasks += 1
+        self._finished.clear()
+
+    def put_nowait(self, batch: list[ReadingInfo]) -> None:
+        self.stats.num_enqueued += len(batch)
+        if self._spill is not None and self._spill.batches:
+            # Keep FIFO order while there are readings spilled to disk
+            self._spill_batch(batch)
+            return
+        if not self.shedding and self.stats.size + len(batch) > self.high:
+            self.shedding = True
+            self.stats.num_high_watermark += 1
+            log.warning(
+                "%s queue above high watermark (%d), applying %s policy",
+                self.name,
+                self.high,
+                self.policy,
+            )
+        if self.shedding:
+            batch = self._shed(batch)
+            if batch is None:
+                return
+        super().put_nowait(batch)
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+class LaneQueue(asyncio.Queue):
+    """
+    Database writer queue of (MessagePriority, item) tuples with a FIFO lane per priority,
+    so that put and get take constant time and items of the same priority keep their order.
+    Lanes are served in priority order unless lane weights are given. Then the non empty
+    lanes are served by smooth weighted round robin, so that no lane starves.
+    """
+
+    def __init__(self, name: str, options: dict[str, Any]) -> None:
+        self.name = name
+        super().__init__(maxsize=options["queue_size"])
+        self.configure(options)
+
+    def configure(self, options: dict[str, Any]) -> None:
+        """Reloadable lane weights"""
+        weights = options.get("queue_weights", [])
+        if weights and (len(weights) != len(MessagePriority) or min(weights) <= 0):
+            log.error(
+                "%s queue: %d positive weights expected, not %s. Using priority order",
+                self.name,
+                len(MessagePriority),
+                weights,
+            )
+            weights = []
+        self._weights = dict(zip(MessagePriority, weights)) if weights else None
+        self._credits = {priority: 0 for priority in MessagePriority}
+
+    def _init(self, maxsize: int) -> None:
+        self._lanes: dict[MessagePriority, deque] = {p: deque() for p in MessagePriority}
+        self._size = 0
+        self.lane_stats = {p: register_lane(f"{self.name}.{p.name.lower()}") for p in self._lanes}
+
+    def qsize(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def _format(self) -> str:
+        # For repr() & str(). There is no asyncio.Queue _queue, but a lane per priority
+        lanes = ", ".join(f"{p.name.lower()}={len(lane)}" for p, lane in self._lanes.items())
+        result = f"maxsize={self._maxsize!r} lanes=[{lanes}]"
+        if self._getters:
+            result += f" _getters[{len(self._getters)}]"
+        if self._putters:
+            result += f" _putters[{len(self._putters)}]"
+        if self._unfinished_tasks:
+            result += f" tasks={self._unfinished_tasks}"
+        return result
+
+    def _put(self, item: tuple[MessagePriority, Any]) -> None:
+        now = time.monotonic()
+        lane = self._lanes[item[0]]
+        lane.append((now, item))
+        self._size += 1
+        stats = self.lane_stats[item[0]]
+        stats.num_enqueued += 1
+        stats.size = len(lane)
+        stats.max_size = max(stats.max_size, stats.size)
+        if stats.size == 1:
+            stats.oldest = now
+
+    def _next(self) -> MessagePriority:
+        if self._weights is None:
+            return next(priority for priority, lane in self._lanes.items() if lane)
+        chosen = None
+        total = 0
+        for priority, lane in self._lanes.items():
+            if lane:
+                self._credits[priority] += self._weights[priority]
+                total += self._weights[priority]
+                if chosen is None or self._credits[priority] > self._credits[chosen]:
+                    chosen = priority
+        self._credits[chosen] -= total
+        return chosen
+
+    def _get(self) -> tuple[MessagePriority, Any]:
+        priority = self._next()
+        lane = self._lanes[priority]
+        queued, item = lane.popleft()
+        self._size -= 1
+        wait = time.monotonic() - queued
+        stats = self.lane_stats[priority]
+        stats.num_dequeued += 1
+        stats.size = len(lane)
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+        if lane:
+            stats.oldest = lane[0][0]
+        return item
+
+
+class PartitionedQueue:
+    """
+    Splits the readings batches among K shedding queues by a stable hash of the photometer
+    name, one per filter partition, so that each photometer readings keep their order.
+    The watermarks are divided evenly among the partitions.
+    """
+
+    def __init__(self, name: str, options: dict[str, Any], partitions: int) -> None:
+        names = [name] if partitions == 1 else [f"{name}.{i}" for i in range(partitions)]
+        options = self._split(options, partitions)
+        self.partitions = [SheddingQueue(name, options) for name in names]
+        self._index: dict[str, int] = dict()
+
+    def _split(self, options: dict[str, Any], partitions: int) -> dict[str, Any]:
+        return {
+            **options,
+            "high_watermark": options.get("high_watermark", UNBOUNDED) // partitions,
+            "low_watermark": options.get("low_watermark", UNBOUNDED) // partitions,
+        }
+
+    def configure(self, options: dict[str, Any]) -> None:
+        """Reloadable watermarks and policy"""
+        options = self._split(options, len(self.partitions))
+        for queue in self.partitions:
+            queue.configure(options)
+
+    def _partition(self, name: str) -> int:
+        index = self._index.get(name)
+        if index is None:
+            index = self._index[name] = cluster.partition(name, len(self.partitions))
+        return index
+
+    def put_nowait(self, batch: list[ReadingInfo]) -> None:
+        if len(self.partitions) == 1:
+            self.partitions[0].put_nowait(batch)
+            return
+        parts = [list() for _ in self.partitions]
+        for reading in batch:
+            parts[self._partition(reading.name)].append(reading)
+        for queue, part in zip(self.partitions, parts):
+            if part:
+                queue.put_nowait(part)
+
+    def close(self) -> None:
+        for queue in self.partitions:
+            queue.close()
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.SERVER.value)
+stats: dict[str, QueueStats] = dict()
+lane_stats: dict[str, LaneStats] = dict()
+last_reset = time.monotonic()
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def register(name: str) -> QueueStats:
+    """Returns the stats of a named queue, creating them on first use"""
+    return stats.setdefault(name, QueueStats())
+
+
+def register_lane(name: str) -> LaneStats:
+    """Returns the stats of a named queue lane, creating them on first use"""
+    return lane_stats.setdefault(name, LaneStats())
+
+
+def on_server_stats() -> None:
+    global last_reset
+    now = time.monotonic()
+    for name, queue_stats in stats.items():
+        queue_stats.rate = queue_stats.num_dequeued / max(now - last_reset, 1e-3)
+        queue_stats.show(name)
+        queue_stats.reset()
+    for name, stats_lane in lane_stats.items():
+        stats_lane.show(name)
+        stats_lane.reset()
+    last_reset = now
+
+
+pub.subscribe(on_server_stats, Topic.SERVER_STATS)
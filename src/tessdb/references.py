@@ -0,0 +1,266 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import time
+import logging
+from datetime import datetime, timezone
+from collections import Counter
+from typing import Iterable, Optional, Sequence
+from dataclasses import dataclass
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from tessdbdao import ReadingSource, TimestampSource, ValidState
+from tessdbdao.asyncio import NameMapping, Tess, Units
+from tessdbapi.model import ReadingInfo, ReferencesInfo
+from tessdbapi.asyncio.photometer.reading import split_datetime, stats as read_stats
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+
+# -------
+# Classes
+# -------
+
+
+@dataclass(slots=True)
+class CachedPhotometer:
+    """The Tess columns needed to resolve a reading references"""
+
+    tess_id: int
+    mac_address: str
+    valid_since: datetime
+    valid_until: datetime
+    location_id: int
+    observer_id: int
+    authorised: bool
+
+
+@dataclass(slots=True)
+class CacheEntry:
+    photometers: list[CachedPhotometer]  # most recent first, empty = not registered
+    expires: float  # time.monotonic() value
+
+
+@dataclass(slots=True)
+class Stats:
+    num_hits: int = 0
+    num_misses: int = 0
+    num_invalidated: int = 0
+    size: int = 0
+
+    def reset(self) -> None:
+        """Resets stat counters"""
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_invalidated = 0
+
+    def show(self) -> None:
+        total = self.num_hits + self.num_misses
+        log.info(
+            "DBASE References Cache Stats [Size, Hits, Misses, Hit Rate, Invalidated] = %s",
+            [
+                self.size,
+                self.num_hits,
+                self.num_misses,
+                f"{100 * self.num_hits / total:.1f}%" if total else "-",
+                self.num_invalidated,
+            ],
+        )
+
+
+class ReferenceCache:
+    """
+    Photometer references by name, so that most readings are resolved with no
+    database access. Entries are (re)loaded from the database when missing or
+    older than the TTL. Photometers not registered are cached too.
+    With a zero TTL nothing is cached, but readings are still resolved in batches.
+    """
+
+    def __init__(self) -> None:
+        self.ttl = 0.0
+        self._entries: dict[str, CacheEntry] = dict()
+        self._units: dict[tuple[ReadingSource, TimestampSource], int] = dict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        """Forgets a photometer or all of them if no name is given"""
+        if name is None:
+            stats.num_invalidated += len(self._entries)
+            self._entries.clear()
+        elif self._entries.pop(name, None) is not None:
+            stats.num_invalidated += 1
+        stats.size = len(self._entries)
+
+    def _query(self):
+        return (
+            select(
+                NameMapping.name,
+                Tess.tess_id,
+                Tess.mac_address,
+                Tess.valid_since,
+                Tess.valid_until,
+                Tess.location_id,
+                Tess.observer_id,
+                Tess.authorised,
+            )
+            .join(NameMapping, NameMapping.mac_address == Tess.mac_address)
+            .where(NameMapping.valid_state == ValidState.CURRENT)
+            .order_by(NameMapping.name, Tess.valid_since.desc())
+        )
+
+    def _store(self, entries: dict[str, CacheEntry], names: Iterable[str], rows) -> None:
+        expires = time.monotonic() + self.ttl
+        for name in names:
+            entries[name] = CacheEntry(photometers=list(), expires=expires)
+        for name, tess_id, mac, since, until, location_id, observer_id, authorised in rows:
+            entry = entries.get(name)
+            if entry is None:
+                entry = entries[name] = CacheEntry(photometers=list(), expires=expires)
+            entry.photometers.append(
+                CachedPhotometer(
+                    tess_id=tess_id,
+                    mac_address=mac,
+                    valid_since=_utc(since),
+                    valid_until=_utc(until),
+                    location_id=location_id,
+                    observer_id=observer_id,
+                    authorised=authorised,
+                )
+            )
+        stats.size = len(self._entries)
+
+    async def warm(self, session: AsyncSession) -> None:
+        """Loads all current photometers with a single query"""
+        async with session.begin():
+            rows = (await session.execute(self._query())).all()
+        self._entries.clear()
+        self._store(self._entries, (), rows)
+        log.info("References cache warmed with %d photometers", len(self._entries))
+
+    async def resolve(
+        self,
+        session: AsyncSession,
+        readings: Sequence[ReadingInfo],
+        auth_filter: bool,
+        source: ReadingSource,
+    ) -> tuple[list[tuple[ReadingInfo, ReferencesInfo]], Counter]:
+        """
+        Same as tessdbapi resolve_references() for the latest name to MAC association,
+        including the readings statistics, but for a whole write buffer. Photometers not
+        cached (all of them if the cache is disabled) are looked up in a single query.
+        Returns the resolved (reading, references) pairs and the rejected readings by reason.
+        """
+        now = time.monotonic()
+        if self.ttl > 0:
+            entries = self._entries
+            missing = {
+                r.name for r in readings if r.name not in entries or entries[r.name].expires < now
+            }
+            misses = sum(1 for r in readings if r.name in missing)
+            stats.num_misses += misses
+            stats.num_hits += len(readings) - misses
+        else:
+            entries = dict()
+            missing = {r.name for r in readings}
+        units = {(source, r.tstamp_src) for r in readings} - self._units.keys()
+        if missing or units:
+            async with session.begin():
+                if missing:
+                    query = self._query().where(NameMapping.name.in_(missing))
+                    self._store(entries, missing, (await session.execute(query)).all())
+                for key in units:
+                    query = select(Units.units_id).where(
+                        Units.reading_source == key[0],
+                        Units.timestamp_source == key[1],
+                    )
+                    self._units[key] = (await session.scalars(query)).one()
+        resolved = list()
+        rejected = Counter()
+        for reading in readings:
+            read_stats.num_readings += 1
+            units_id = self._units[(source, reading.tstamp_src)]
+            ref, reason = self._resolve(entries[reading.name], reading, auth_filter, units_id)
+            if ref is None:
+                rejected[reason] += 1
+            else:
+                resolved.append((reading, ref))
+        return resolved, rejected
+
+    def _resolve(
+        self, entry: CacheEntry, reading: ReadingInfo, auth_filter: bool, units_id: int
+    ) -> tuple[Optional[ReferencesInfo], Optional[str]]:
+        plog = logging.getLogger(reading.name)
+        phot = next(
+            (p for p in entry.photometers if p.valid_since <= reading.tstamp <= p.valid_until),
+            None,
+        )
+        if phot is None:
+            read_stats.rej_not_registered += 1
+            log.info("No TESS %s registered ! => %s", reading.name, dict(reading))
+            plog.debug("No TESS %s registered ! => %s", reading.name, dict(reading))
+            return None, "not registered"
+        if reading.hash and reading.hash != "".join(phot.mac_address.split(":"))[-3:]:
+            read_stats.rej_hash_mismatch += 1
+            log.info(
+                "[%s] Reading rejected by hash mismatch: %s => %s",
+                reading.name,
+                str((reading.hash, phot.mac_address)),
+                dict(reading),
+            )
+            plog.debug(
+                "[%s] Reading rejected by hash mismatch: %s => %s",
+                reading.name,
+                str((reading.hash, phot.mac_address)),
+                dict(reading),
+            )
+            return None, "hash mismatch"
+        if auth_filter and not phot.authorised:
+            read_stats.rej_not_authorised += 1
+            log.info("[%s]: Not authorised: %s", reading.name, dict(reading))
+            plog.debug("[%s]: Not authorised: %s", reading.name, dict(reading))
+            return None, "not authorised"
+        date_id, time_id = split_datetime(reading.tstamp)
+        ref = ReferencesInfo(
+            date_id=date_id,
+            time_id=time_id,
+            tess_id=phot.tess_id,
+            location_id=phot.location_id,
+            observer_id=phot.observer_id,
+            units_id=units_id,
+        )
+        return ref, None
+
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.DBASE.value)
+stats = Stats()
+cache = ReferenceCache()
+
+# ------------------
+# Auxiliar functions
+# ------------------
+
+
+def _utc(tstamp: datetime) -> datetime:
+    # Database timestamps are naive UTC ones, reading timestamps are aware
+    return tstamp if tstamp.tzinfo is not None else tstamp.replace(tzinfo=timezone.utc)
@@ -0,0 +1,106 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+from enum import IntEnum
+from typing import Iterable, Optional
+from dataclasses import dataclass, field
+
+# ---------
+# Constants
+# ---------
+
+CACHE_SIZE = 16384  # resolved topics, roughly one per photometer
+
+
+class Route(IntEnum):
+    """How the MQTT subscriber handles a message received on a given topic"""
+
+    REGISTER = 1
+    READING = 2
+    HANDOFF = 3  # reading handed off by another cluster worker
+
+
+# -------
+# Classes
+# -------
+
+
+@dataclass(slots=True)
+class Node:
+    children: dict[str, "Node"] = field(default_factory=dict)
+    route: Optional[tuple[int, Route]] = None  # (order, route) of a filter ending here
+    multi: Optional[tuple[int, Route]] = None  # (order, route) of a filter ending in '#'
+
+
+class TopicRouter:
+    """
+    Maps topics to routes given a list of (topic filter, route), in priority order.
+    Filters without wildcards are resolved by a dict lookup, the others by walking a trie
+    of topic levels. Resolved topics are cached, so routing a known topic is a dict hit.
+    """
+
+    def __init__(self, filters: Iterable[tuple[str, Route]], default: Route) -> None:
+        self.default = default
+        self._exact: dict[str, tuple[int, Route]] = dict()
+        self._root = Node()
+        self._cache: dict[str, Route] = dict()
+        for order, (topic_filter, route) in enumerate(filters):
+            self._add(order, topic_filter, route)
+
+    def _add(self, order: int, topic_filter: str, route: Route) -> None:
+        levels = topic_filter.split("/")
+        if levels[0] == "$share":
+            # Shared subscriptions: $share/<group>/<topic filter>
+            levels = levels[2:]
+        if "+" not in levels and "#" not in levels:
+            self._exact.setdefault("/".join(levels), (order, route))
+            return
+        node = self._root
+        for level in levels[:-1]:
+            node = node.children.setdefault(level, Node())
+        if levels[-1] == "#":
+            node.multi = node.multi or (order, route)
+        else:
+            node = node.children.setdefault(levels[-1], Node())
+            node.route = node.route or (order, route)
+
+    def _match(self, topic: str) -> Optional[tuple[int, Route]]:
+        best = self._exact.get(topic)
+        nodes = [self._root]
+        for level in topic.split("/"):
+            following = list()
+            for node in nodes:
+                if node.multi is not None:
+                    best = min(best or node.multi, node.multi)
+                child = node.children.get(level)
+                if child is not None:
+                    following.append(child)
+                child = node.children.get("+")
+                if child is not None:
+                    following.append(child)
+            nodes = following
+            if not nodes:
+                break
+        for node in nodes:
+            # 'a/#' also matches 'a'
+            for match in (node.route, node.multi):
+                if match is not None:
+                    best = min(best or match, match)
+        return best
+
+    def route(self, topic: str) -> Route:
+        route = self._cache.get(topic)
+        if route is None:
+            match = self._match(topic)
+            route = match[1] if match is not None else self.default
+            if len(self._cache) >= CACHE_SIZE:
+                self._cache.clear()
+            self._cache[topic] = route
+        return route
@@ -14,7 +14,7 @@ import tomllib
 import signal
 
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Union
 from argparse import ArgumentParser, Namespace
 
 # ---------------------------
@@ -37,18 +37,24 @@ import tessdbapi
 from . import __version__
 
 # from .. import mqtt, http, dbase, stats, filtering
-from . import mqtt, filter as filtering, dbase, stats, http
+from . import mqtt, filter as filtering, dbase, stats, http, cluster, queues, spool
 from .constants import Topic
 from .logger import LogSpace
 
+# ---------
+# Constants
+# ---------
+
+MiB = 1024 * 1024
+
 
 # The Server state
 @dataclass(slots=True)
 class State:
     config_path: str = None
     options: dict[str, Any] = None
-    db_queue: asyncio.PriorityQueue = None
-    filter_queue: asyncio.Queue = None
+    db_queue: Union[queues.LaneQueue, spool.SpoolQueue] = None
+    filter_queue: queues.PartitionedQueue = None
     reloaded: bool = False
 
 
@@ -76,6 +82,12 @@ def signal_reload(signum: int, frame):
     pub.sendMessage(Topic.SERVER_RELOAD)
 
 
+def signal_terminate(main_task: asyncio.Task) -> None:
+    # Orderly shut down from within the event loop, so that the filters snapshot gets saved
+    log.warning("Terminating on SIGTERM")
+    main_task.cancel()
+
+
 signal.signal(signal.SIGHUP, signal_reload)
 signal.signal(signal.SIGUSR1, signal_pause)
 signal.signal(signal.SIGUSR2, signal_resume)
@@ -121,6 +133,9 @@ async def reload_monitor() -> None:
             dbase.on_server_reload(options["dbase"])
             stats.on_server_reload(options["stats"])
             filtering.on_server_reload(options["filter"])
+            state.filter_queue.configure(options["filter"].get("queue", {}))
+            if isinstance(state.db_queue, queues.LaneQueue):
+                state.db_queue.configure(options["dbase"])
         await asyncio.sleep(1)
 
 
@@ -136,8 +151,35 @@ async def cli_main(args: Namespace) -> None:
     sqa_logging(args)
     state.config_path = args.config
     state.options = load_config(state.config_path)
-    state.db_queue = asyncio.PriorityQueue(maxsize=state.options["dbase"]["queue_size"])
-    state.filter_queue = asyncio.Queue()
+    cluster.state.update(state.options.get("cluster", {}), args.worker)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, signal_terminate, asyncio.current_task())
+    if cluster.state.enabled and args.worker is None:
+        try:
+            await cluster.supervisor(cluster.state.workers)
+        except asyncio.CancelledError:
+            # Workers already terminated
+            pass
+        return
+    if cluster.state.enabled:
+        log.info("Starting cluster worker #%d/%d", cluster.state.index, cluster.state.workers)
+    if state.options["dbase"].get("spool_dir"):
+        excluded = [
+            key for key in ("queue_weights", "pause_spill_dir") if state.options["dbase"].get(key)
+        ]
+        if excluded:
+            log.warning("Ignoring %s with the readings spool", ", ".join(excluded))
+        state.db_queue = spool.SpoolQueue(
+            state.options["dbase"]["spool_dir"],
+            state.options["dbase"].get("segment_size", 64) * MiB,
+        )
+    else:
+        state.db_queue = queues.LaneQueue("dbase", state.options["dbase"])
+    state.filter_queue = queues.PartitionedQueue(
+        "filter",
+        state.options["filter"].get("queue", {}),
+        state.options["filter"].get("partitions", 1),
+    )
     try:
         async with asyncio.TaskGroup() as tg:
             tg.create_task(http.admin(state.options["http"]))
@@ -145,7 +187,12 @@ async def cli_main(args: Namespace) -> None:
                 mqtt.subscriber(state.options["mqtt"], state.filter_queue, state.db_queue)
             )
             tg.create_task(
-                filtering.filtering(state.options["filter"], state.filter_queue, state.db_queue)
+                filtering.filtering(
+                    state.options["filter"],
+                    state.filter_queue,
+                    state.db_queue,
+                    dbase.photometer_locations,
+                )
             )
             tg.create_task(dbase.writer(state.options["dbase"], state.db_queue))
             tg.create_task(stats.summary(state.options["stats"]))
@@ -154,6 +201,11 @@ async def cli_main(args: Namespace) -> None:
         log.exception("%s -> %s", e, e.__class__.__name__)
     except* asyncio.CancelledError:
         pass
+    finally:
+        filtering.save_checkpoint()
+        state.filter_queue.close()
+        if isinstance(state.db_queue, spool.SpoolQueue):
+            state.db_queue.close()
 
 
 def add_args(parser: ArgumentParser) -> None:
@@ -165,6 +217,13 @@ def add_args(parser: ArgumentParser) -> None:
         metavar="<config file>",
         help="detailed .toml configuration file",
     )
+    parser.add_argument(
+        "--worker",
+        type=int,
+        default=None,
+        metavar="<N>",
+        help="cluster worker index (set by the cluster supervisor)",
+    )
 
 
 def main():
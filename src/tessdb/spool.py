@@ -0,0 +1,380 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2024 Rafael Gonzalez.
+#
+# See the LICENSE file for details
+# ----------------------------------------------------------------------
+
+# --------------------
+# System wide imports
+# -------------------
+
+import os
+import glob
+import mmap
+import zlib
+import struct
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Union
+
+# ---------------------------
+# Third-party library imports
+# ----------------------------
+
+from tessdbdao import TimestampSource
+from tessdbapi.model import PhotometerInfo, ReadingInfo1c, ReadingInfo4c
+
+# --------------
+# local imports
+# -------------
+
+from . import logger
+from .constants import MessagePriority
+
+# ---------
+# Constants
+# ---------
+
+# Record header: payload length, payload crc32, priority
+RECORD = struct.Struct("<IIB")
+# Reading header: channels, flags, timestamp (us since epoch), sequence number,
+# optional fields presence mask, name length, hash length
+READING = struct.Struct("<BBqqHBB")
+ACK = struct.Struct("<QQ")
+
+# Optional float fields in presence mask bit order
+FLOATS_1C = (
+    "freq1",
+    "mag1",
+    "box_temperature",
+    "sky_temperature",
+    "azimuth",
+    "altitude",
+    "longitude",
+    "latitude",
+    "elevation",
+)
+FLOATS_4C = (
+    "freq1",
+    "mag1",
+    "freq2",
+    "mag2",
+    "freq3",
+    "mag3",
+    "freq4",
+    "mag4",
+    "box_temperature",
+    "sky_temperature",
+    "azimuth",
+    "altitude",
+    "longitude",
+    "latitude",
+    "elevation",
+)
+SIGNAL_BIT = 1 << 15
+PUBLISHER_FLAG = 0x01
+SIGNAL = struct.Struct("<i")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_US = timedelta(microseconds=1)
+
+SEGMENT_GLOB = "segment-*.spool"
+ACK_FILE = "ack"
+
+Position = tuple[int, int]  # (segment index, offset)
+
+# ----------------
+# Global variables
+# ----------------
+
+log = logging.getLogger(logger.LogSpace.DBASE.value)
+
+# ==========================
+# Compact readings encoding
+# ==========================
+
+
+def encode(items: list[Union[ReadingInfo1c, ReadingInfo4c]]) -> bytes:
+    """Packs a batch of validated readings into a compact binary form"""
+    chunks = [struct.pack("<I", len(items))]
+    for item in items:
+        four = isinstance(item, ReadingInfo4c)
+        fields = FLOATS_4C if four else FLOATS_1C
+        values = [getattr(item, field) for field in fields]
+        mask = 0
+        floats = list()
+        for bit, value in enumerate(values):
+            if value is not None:
+                mask |= 1 << bit
+                floats.append(value)
+        if item.signal_strength is not None:
+            mask |= SIGNAL_BIT
+        tstamp = item.tstamp if item.tstamp.tzinfo else item.tstamp.replace(tzinfo=timezone.utc)
+        name = item.name.encode("utf-8")
+        hsh = item.hash.encode("utf-8") if item.hash is not None else b""
+        flags = PUBLISHER_FLAG if item.tstamp_src == TimestampSource.PUBLISHER else 0
+        chunks.append(
+            READING.pack(
+                4 if four else 1,
+                flags,
+                (tstamp - EPOCH) // ONE_US,
+                item.sequence_number,
+                mask,
+                len(name),
+                len(hsh) if item.hash is not None else 0xFF,
+            )
+        )
+        chunks.append(struct.pack(f"<{len(floats)}d", *floats))
+        if item.signal_strength is not None:
+            chunks.append(SIGNAL.pack(item.signal_strength))
+        chunks.append(name)
+        chunks.append(hsh)
+    return b"".join(chunks)
+
+
+def decode(payload: Union[bytes, memoryview]) -> list[Union[ReadingInfo1c, ReadingInfo4c]]:
+    """Unpacks a batch of readings packed by encode()"""
+    (count,) = struct.unpack_from("<I", payload, 0)
+    offset = 4
+    result = list()
+    for _ in range(count):
+        channels, flags, us, seq, mask, name_len, hash_len = READING.unpack_from(payload, offset)
+        offset += READING.size
+        fields = FLOATS_4C if channels == 4 else FLOATS_1C
+        present = [field for bit, field in enumerate(fields) if mask & (1 << bit)]
+        values = struct.unpack_from(f"<{len(present)}d", payload, offset)
+        offset += 8 * len(present)
+        # Missing fields are None rather than the model defaults, as when encoded
+        kwargs = dict.fromkeys(fields)
+        kwargs.update(zip(present, values))
+        if mask & SIGNAL_BIT:
+            (kwargs["signal_strength"],) = SIGNAL.unpack_from(payload, offset)
+            offset += SIGNAL.size
+        else:
+            kwargs["signal_strength"] = None
+        kwargs["name"] = bytes(payload[offset : offset + name_len]).decode("utf-8")
+        offset += name_len
+        if hash_len != 0xFF:
+            kwargs["hash"] = bytes(payload[offset : offset + hash_len]).decode("utf-8")
+            offset += hash_len
+        kwargs["tstamp"] = EPOCH + us * ONE_US
+        kwargs["tstamp_src"] = (
+            TimestampSource.PUBLISHER if flags & PUBLISHER_FLAG else TimestampSource.SUBSCRIBER
+        )
+        kwargs["sequence_number"] = seq
+        cls = ReadingInfo4c if channels == 4 else ReadingInfo1c
+        result.append(cls(**kwargs))
+    return result
+
+
+# =========
+# Segments
+# =========
+
+
+class Segment:
+    """Preallocated, memory mapped, append only spool file"""
+
+    def __init__(self, directory: str, index: int, size: int) -> None:
+        self.index = index
+        self.path = os.path.join(directory, f"segment-{index:012d}.spool")
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Sparse file: disk space is only used as records get written
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.end = 0
+        self.synced = 0  # records up to this offset are flushed to disk
+
+    def read(self, offset: int) -> Optional[tuple[int, memoryview, int]]:
+        """Returns (priority, payload, next offset) or None past the last valid record"""
+        if offset + RECORD.size > self.size:
+            return None
+        length, crc, priority = RECORD.unpack_from(self.mm, offset)
+        start = offset + RECORD.size
+        if length == 0 or start + length > self.size:
+            return None
+        payload = memoryview(self.mm)[start : start + length]
+        if zlib.crc32(payload) != crc:
+            payload.release()
+            return None
+        return priority, payload, start + length
+
+    def scan(self, offset: int) -> int:
+        """Finds the end of the valid records from offset. Returns the number of records"""
+        count = 0
+        while (record := self.read(offset)) is not None:
+            record[1].release()
+            offset = record[2]
+            count += 1
+        self.end = offset
+        self.synced = offset
+        return count
+
+    def append(self, priority: int, payload: bytes) -> bool:
+        start = self.end + RECORD.size
+        if start + len(payload) > self.size:
+            return False
+        self.mm[start : start + len(payload)] = payload
+        # The header goes last, so that a torn record is seen as the end of the segment
+        RECORD.pack_into(self.mm, self.end, len(payload), zlib.crc32(payload), priority)
+        self.end = start + len(payload)
+        return True
+
+    def sync(self) -> None:
+        """Flushes the records appended since the last sync to disk"""
+        if self.end > self.synced:
+            start = self.synced - self.synced % mmap.PAGESIZE
+            self.mm.flush(start, self.end - start)
+            self.synced = self.end
+
+    def close(self) -> None:
+        self.sync()
+        self.mm.close()
+
+    def remove(self) -> None:
+        self.close()
+        os.unlink(self.path)
+
+
+# ===========
+# The spool
+# ===========
+
+
+class SpoolQueue:
+    """
+    Durable replacement for the database writer priority queue.
+    Readings batches are appended in compact binary form to memory mapped segment files,
+    so a long pause or a database outage costs disk rather than RAM. The single consumer
+    acknowledges positions once the readings are committed. Unacknowledged readings are
+    replayed on startup or when the writer restarts, so delivery is at-least-once and
+    duplicates are rejected by the database readings primary key.
+    Records are flushed to disk on every acknowledgement and segment change, so a power
+    loss or kernel crash may only lose the readings spooled since the last commit.
+    Registrations are not spooled and are served first.
+    """
+
+    maxsize = 0
+
+    def __init__(self, directory: str, segment_size: int) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self._registers: deque[PhotometerInfo] = deque()
+        self._event = asyncio.Event()
+        self._inflight: deque[Position] = deque()  # end positions of read, unacked records
+        self._ack_fd = os.open(os.path.join(directory, ACK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        data = os.pread(self._ack_fd, ACK.size, 0)
+        self._ack: Position = ACK.unpack(data) if len(data) == ACK.size else (0, 0)
+        self._segments: dict[int, Segment] = dict()
+        self._unread = 0
+        for path in sorted(glob.glob(os.path.join(directory, SEGMENT_GLOB))):
+            index = int(os.path.basename(path)[8:20])
+            if index < self._ack[0]:
+                os.unlink(path)
+                continue
+            segment = Segment(directory, index, segment_size)
+            self._segments[index] = segment
+            self._unread += segment.scan(self._ack[1] if index == self._ack[0] else 0)
+        if not self._segments:
+            self._segments[self._ack[0]] = Segment(directory, self._ack[0], segment_size)
+            self._segments[self._ack[0]].end = self._ack[1]
+        self._read: Position = self._ack
+        self.record: tuple[Position, Position] = (self._ack, self._ack)  # last read record
+        self._writing = self._segments[max(self._segments)]
+        if self._unread:
+            log.warning("Spool replaying %d pending readings batches", self._unread)
+
+    def qsize(self) -> int:
+        return self._unread + len(self._registers)
+
+    def full(self) -> bool:
+        return False
+
+    @property
+    def nbytes(self) -> int:
+        """Disk space used by the spooled records"""
+        return sum(segment.end for segment in self._segments.values())
+
+    def put_nowait(self, item: tuple[MessagePriority, Union[PhotometerInfo, list]]) -> None:
+        priority, items = item
+        if priority == MessagePriority.REGISTER:
+            self._registers.append(items)
+        else:
+            try:
+                self._append(priority, encode(items))
+            except OSError as e:
+                raise asyncio.QueueFull(f"Spool write error: {e}") from e
+            self._unread += 1
+        self._event.set()
+
+    def _append(self, priority: int, payload: bytes) -> None:
+        if not self._writing.append(priority, payload):
+            self._writing.sync()
+            index = self._writing.index + 1
+            size = max(self.segment_size, RECORD.size + len(payload))
+            self._writing = Segment(self.directory, index, size)
+            self._segments[index] = self._writing
+            self._writing.append(priority, payload)
+
+    def _next(self) -> Optional[tuple[MessagePriority, list]]:
+        while True:
+            index, offset = self._read
+            segment = self._segments[index]
+            if offset < segment.end:
+                break
+            if segment is self._writing:
+                return None
+            self._read = (index + 1, 0)
+        priority, payload, end = segment.read(offset)
+        try:
+            items = decode(payload)
+        finally:
+            payload.release()
+        self.record = (self._read, (index, end))
+        self._read = (index, end)
+        self._inflight.append(self._read)
+        self._unread -= 1
+        return MessagePriority(priority), items
+
+    async def get(self) -> tuple[MessagePriority, Union[PhotometerInfo, list]]:
+        """Returns registrations first, then readings batches in spool order"""
+        while True:
+            if self._registers:
+                return MessagePriority.REGISTER, self._registers.popleft()
+            item = self._next()
+            if item is not None:
+                return item
+            self._event.clear()
+            await self._event.wait()
+
+    def ack(self, position: Position) -> None:
+        """All readings up to this position are committed to the database"""
+        if position <= self._ack:
+            return
+        self._ack = position
+        self._writing.sync()
+        os.pwrite(self._ack_fd, ACK.pack(*position), 0)
+        os.fsync(self._ack_fd)
+        while self._inflight and self._inflight[0] <= position:
+            self._inflight.popleft()
+        for index in [i for i in self._segments if i < position[0]]:
+            self._segments.pop(index).remove()
+
+    def rewind(self) -> None:
+        """Reads again all the unacknowledged readings"""
+        self._unread += len(self._inflight)
+        self._inflight.clear()
+        self._read = self._ack
+
+    def close(self) -> None:
+        for segment in self._segments.values():
+            segment.close()
+        os.close(self._ack_fd)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from tessdbdao import TimestampSource
+from tessdbapi.model import ReadingInfo1c, ReadingInfo4c
+
+T0 = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def make_readings(name: str, n: int, start: int = 0, tess4c: bool = False) -> list:
+    """n readings one minute apart, with sequence numbers from start on"""
+    common = dict(
+        tstamp_src=TimestampSource.PUBLISHER,
+        box_temperature=10.0,
+        sky_temperature=-5.0,
+        signal_strength=-60,
+    )
+    if tess4c:
+        return [
+            ReadingInfo4c(
+                name=name,
+                tstamp=T0 + timedelta(minutes=k),
+                sequence_number=k,
+                **{f"freq{i}": 10.0 * i for i in range(1, 5)},
+                **{f"mag{i}": 18.0 + i for i in range(1, 5)},
+                **common,
+            )
+            for k in range(start, start + n)
+        ]
+    return [
+        ReadingInfo1c(
+            name=name,
+            tstamp=T0 + timedelta(minutes=k),
+            sequence_number=k,
+            freq1=10.0,
+            mag1=19.5,
+            **common,
+        )
+        for k in range(start, start + n)
+    ]
+
+
+@pytest.fixture
+def readings():
+    return make_readings
+
+
+@pytest.fixture
+def mixed_readings():
+    """TESS-W and TESS4C readings, some with missing optional fields"""
+    result = make_readings("stars1", 5) + make_readings("stars1000", 5, tess4c=True)
+    result[1] = result[1].model_copy(update={"hash": "A1B", "longitude": -3.7})
+    result[2] = result[2].model_copy(update={"signal_strength": None})
+    result[7] = result[7].model_copy(update={"box_temperature": None, "sky_temperature": None})
+    return result
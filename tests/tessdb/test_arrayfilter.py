@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from tessdbapi.filter import LookAheadFilter, Sampler
+
+np = pytest.importorskip("numpy")
+
+from tessdb.arrayfilter import ArrayFilter  # noqa: E402
+from tessdb.lookahead import TrackedFilter  # noqa: E402
+
+CASES = 300
+
+
+def random_stream(rng: random.Random, names: list[str], tess4c: set[str], n: int, make) -> list:
+    """Readings of several photometers interleaved, with saturated runs and sequence jumps"""
+    seqs = {name: rng.randrange(100) for name in names}
+    stream = list()
+    for _ in range(n):
+        name = rng.choice(names)
+        seqs[name] += 1 if rng.random() < 0.9 else rng.randrange(2, 5)
+        reading = make(name, 1, start=seqs[name], tess4c=name in tess4c)[0]
+        mag = 0.0 if rng.random() < 0.5 else rng.choice((15.5, 19.25, 21.0))
+        field = "mag4" if name in tess4c else "mag1"
+        stream.append(reading.model_copy(update={field: mag}))
+    return stream
+
+
+class Reference:
+    """Sampler + LookAheadFilter per photometer, one reading at a time"""
+
+    def __init__(self) -> None:
+        LookAheadFilter.reset()
+        self.samplers: dict[str, Sampler] = dict()
+        self.filters: dict[str, LookAheadFilter] = dict()
+        self.tracked: dict[str, TrackedFilter] = dict()
+
+    def add(self, name: str, depth: int, divisor: int, flushing: bool, buffered: bool) -> None:
+        self.samplers[name] = Sampler(name)
+        self.samplers[name].configure(divisor)
+        self.filters[name] = LookAheadFilter(name)
+        self.filters[name].configure(depth, flushing, buffered)
+        self.tracked[name] = TrackedFilter(self.samplers[name], self.filters[name])
+
+    def push(self, samples: list, bypass: list, discard: list) -> tuple[list, list]:
+        chosen, extra = list(), list()
+        for sample, skip, drop in zip(samples, bypass, discard):
+            tracked = self.tracked[sample.name]
+            sample = tracked.sample(sample)
+            if sample is None or drop:
+                continue
+            fifo = tracked.lookahead
+            if skip and fifo.buffered and not fifo.flushing:
+                result, extras = tracked.release(sample)
+            else:
+                result, extras = tracked.push_pop(sample)
+            if result is not None:
+                chosen.append(result)
+            extra.extend(extras)
+        return chosen, extra
+
+    def pending(self) -> set[str]:
+        return set(self.filters) - LookAheadFilter.flushing_names
+
+
+@pytest.mark.parametrize("daylight", [False, True])
+@pytest.mark.parametrize("seed", range(CASES))
+def test_same_as_lookahead(seed, daylight, readings):
+    """Also with the daylight fast path flags, against the tracked tessdbapi filters"""
+    rng = random.Random(seed)
+    depth = rng.choice((3, 5, 7, 9))
+    names = [f"stars{i}" for i in range(rng.randint(1, 6))]
+    tess4c = {name for name in names if rng.random() < 0.3}
+    reference = Reference()
+    array = ArrayFilter(depth, capacity=2)
+    slots = dict()
+    for name in names:
+        divisor = rng.choice((1, 1, 2, 3))
+        flushing = rng.random() < 0.1
+        buffered = rng.random() < 0.9
+        reference.add(name, depth, divisor, flushing, buffered)
+        slots[name] = array.add(name, divisor, flushing, buffered)
+    stream = random_stream(rng, names, tess4c, rng.randint(10, 200), readings)
+    position = 0
+    while position < len(stream):
+        size = rng.randint(1, 30)
+        batch = stream[position : position + size]
+        position += size
+        bypass = [daylight and rng.random() < 0.3 for _ in batch]
+        discard = [daylight and rng.random() < 0.2 for _ in batch]
+        expected = reference.push(batch, bypass, discard)
+        result = array.push(batch, [slots[r.name] for r in batch], bypass, discard)
+        assert result == expected
+        assert array.pending() == reference.pending()
+        event = rng.random()
+        if event < 0.05:
+            for filt in reference.filters.values():
+                filt.flush()
+            array.flush()
+        elif event < 0.15:
+            name = rng.choice(names)
+            divisor = rng.choice((1, 2, 3))
+            reference.samplers[name].divisor = divisor
+            array.set_divisor(slots[name], divisor)
+        elif event < 0.2:
+            name = rng.choice(names)
+            buffered = rng.random() < 0.5
+            reference.filters[name].buffered = buffered
+            array.set_buffered(slots[name], buffered)
@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from sqlalchemy import select
+from sqlalchemy.dialects import mysql
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from tessdbapi.model import ReferencesInfo
+from tessdbapi.asyncio.photometer.reading import split_datetime
+
+from tessdb import bulk
+from tessdb.cli.bench import standin_tables
+
+
+def references(readings: list) -> list:
+    items = list()
+    for reading in readings:
+        date_id, time_id = split_datetime(reading.tstamp)
+        ref = ReferencesInfo(
+            date_id=date_id,
+            time_id=time_id,
+            tess_id=int(reading.name[5:]),
+            location_id=-1,
+            observer_id=-1,
+            units_id=1,
+        )
+        items.append((reading, ref))
+    return items
+
+
+def sqlite(path) -> str:
+    return f"sqlite+aiosqlite:///{path}"
+
+
+@pytest.fixture
+def postgres() -> str:
+    """Scratch PostgreSQL database, as a postgresql+asyncpg:// URL in TEST_POSTGRES_URL"""
+    pytest.importorskip("asyncpg")
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL not set")
+    return url
+
+
+async def write(url: str, name: str, idempotent: bool, *batches) -> tuple[list[int], dict]:
+    """Writes the batches to fresh stand-in tables. Returns the inserted counts and table rows"""
+    metadata = standin_tables()
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(metadata.drop_all)
+        await conn.run_sync(metadata.create_all)
+    backend = bulk.backend(name, url, idempotent)
+    try:
+        async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+            inserted = [await backend.write(session, batch) for batch in batches]
+    finally:
+        backend.close()
+    async with engine.begin() as conn:
+        rows = {
+            name: sorted((await conn.execute(select(table))).all())
+            for name, table in metadata.tables.items()
+        }
+    await engine.dispose()
+    return inserted, rows
+
+
+@pytest.mark.asyncio
+async def test_same_rows(tmp_path, mixed_readings):
+    """Every backend writes the same column values"""
+    items = references(mixed_readings)
+    _, orm = await write(sqlite(tmp_path / "orm.db"), "orm", False, items)
+    _, native = await write(sqlite(tmp_path / "native.db"), "native", False, items)
+    assert orm == native
+    mag1 = [row.mag1 for row in native["tess_readings4c_t"]]
+    assert mag1 == [r.mag1 for r in mixed_readings if r.name == "stars1000"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", ["orm", "native"])
+async def test_idempotent(tmp_path, readings, name):
+    """Writing the same readings again adds no rows"""
+    items = references(readings("stars1", 5) + readings("stars1000", 5, tess4c=True))
+    inserted, rows = await write(sqlite(tmp_path / "idempotent.db"), name, True, items, items[3:7])
+    assert inserted == [len(items), 0]
+    assert sum(len(table) for table in rows.values()) == len(items)
+    _, once = await write(sqlite(tmp_path / "once.db"), name, True, items)
+    assert rows == once
+
+
+def test_mysql_duplicates():
+    """MySQL & MariaDB skip the primary key conflicts only, not every error as INSERT IGNORE"""
+    table = standin_tables().tables["tess_readings_t"]
+    sql = str(bulk.insert_ignore(table, "mysql").compile(dialect=mysql.dialect()))
+    assert "IGNORE" not in sql
+    assert sql.endswith("ON DUPLICATE KEY UPDATE date_id = tess_readings_t.date_id")
+
+
+@pytest.mark.asyncio
+async def test_existing(tmp_path, readings):
+    """Primary keys already written, counted to tell apart the inserted rows"""
+    url = sqlite(tmp_path / "existing.db")
+    items = references(readings("stars1", 5))
+    await write(url, "orm", False, items[:3])
+    rows, _ = bulk.sorted_rows(items)
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        table = standin_tables().tables["tess_readings_t"]
+        assert await bulk.existing(conn, table, {row[:3] for row in rows}) == 3
+    await engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_copy(tmp_path, postgres, mixed_readings):
+    """The PostgreSQL COPY backend writes the same rows, skipping those already written"""
+    assert bulk.backend("native", postgres).name == "copy"
+    items = references(mixed_readings)
+    inserted, rows = await write(postgres, "native", False, items[:6], items, items[4:] * 2)
+    assert inserted == [6, len(items) - 6, 0]
+    _, native = await write(sqlite(tmp_path / "native.db"), "native", False, items)
+    assert rows == native
@@ -0,0 +1,58 @@
+import glob
+
+import aiomqtt
+import pytest
+
+from tessdb.capture import Captured, CaptureWriter, read_capture
+from tessdb.cli import replay
+
+
+def test_capture_round_trip(tmp_path):
+    messages = [
+        aiomqtt.Message("STARS4ALL/register", b'{"name": "stars1"}', 2, True, 1, None),
+        aiomqtt.Message("STARS4ALL/stars1/reading", b'{"seq": 1}', 2, False, 2, None),
+        aiomqtt.Message("STARS4ALL/stars1/reading", b'{"seq": 2}', 2, False, 3, None),
+    ]
+    # Each message keeps its own receive time
+    received = [1_700_000_000_000_000_000 + k * 250_000_000 for k in range(len(messages))]
+    writer = CaptureWriter(str(tmp_path), 1024 * 1024, 2)
+    writer.write(messages[:1], received[:1])
+    writer.write(messages[1:], received[1:])
+    writer.close()
+    captured = list(read_capture(sorted(glob.glob(str(tmp_path / "capture-*.bin")))))
+    assert [c.topic for c in captured] == [m.topic.value for m in messages]
+    assert [c.payload for c in captured] == [m.payload for m in messages]
+    assert [c.retain for c in captured] == [True, False, False]
+    assert [c.tstamp for c in captured] == [ns / 1e9 for ns in received]
+
+
+@pytest.mark.parametrize("max_files, kept", [(2, 2), (0, 5)])
+def test_rotation(tmp_path, max_files, kept):
+    """Only the newest max_files capture files are kept, all of them with 0"""
+    message = aiomqtt.Message("STARS4ALL/stars1/reading", b"x" * 100, 2, False, 1, None)
+    writer = CaptureWriter(str(tmp_path), 100, max_files)
+    for k in range(4):
+        writer.write([message], [k])
+    writer.close()
+    paths = sorted(glob.glob(str(tmp_path / "capture-*.bin")))
+    assert len(paths) == kept
+    # The newest files hold the last messages
+    assert [c.tstamp for c in read_capture(paths[-2:-1])] == [3e-9]
+
+
+@pytest.mark.asyncio
+async def test_replay_buffered(monkeypatch):
+    """Messages already due are reported as buffered"""
+    records = [Captured(k * (0.0 if k < 5 else 3600.0), "t", b"{}", False) for k in range(10)]
+    monkeypatch.setattr(replay.state, "records", records)
+    monkeypatch.setattr(replay.state, "speed", 1.0)
+    client = replay.ReplayClient()
+    assert len(client) == 0
+    await anext(client)
+    assert len(client) == 4
+    for k in range(4):
+        await anext(client)
+        assert len(client) == 3 - k
+    assert len(client) == 0
+    monkeypatch.setattr(replay.state, "speed", 0)
+    assert len(client) == 5
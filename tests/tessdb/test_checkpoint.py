@@ -0,0 +1,52 @@
+import logging
+from datetime import datetime, timezone
+
+import pytest
+
+from tessdb import checkpoint
+from tessdb.checkpoint import FilterSnapshot
+
+
+class Messages(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages = list()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+@pytest.fixture
+def logged():
+    """Messages logged while loading, formatted"""
+    handler = Messages()
+    level = checkpoint.log.level
+    checkpoint.log.setLevel(logging.INFO)
+    checkpoint.log.addHandler(handler)
+    yield handler.messages
+    checkpoint.log.removeHandler(handler)
+    checkpoint.log.setLevel(level)
+
+
+def test_round_trip(tmp_path, mixed_readings, logged):
+    path = str(tmp_path / "filter.snapshot")
+    entries = [
+        FilterSnapshot("stars1", 1, 0, mixed_readings[:5][::-1]),
+        FilterSnapshot("stars1000", 3, 2, mixed_readings[5:][::-1]),
+        FilterSnapshot("stars2", 2, 1, list()),
+    ]
+    assert checkpoint.save(path, entries) == len(entries)
+    assert checkpoint.load(path, float("inf")) == entries
+    assert logged[-1].endswith("3/3 entries not older than inf s")
+
+
+def test_max_age(tmp_path, readings):
+    """Entries whose youngest reading is too old are discarded"""
+    path = str(tmp_path / "filter.snapshot")
+    old = readings("stars1", 3)[::-1]
+    age = (datetime.now(timezone.utc) - old[0].tstamp).total_seconds()
+    entries = [FilterSnapshot("stars1", 1, 0, old), FilterSnapshot("stars2", 1, 0, list())]
+    checkpoint.save(path, entries)
+    assert checkpoint.load(path, age + 3600) == entries
+    # Empty windows are as old as the snapshot
+    assert checkpoint.load(path, age - 3600) == entries[1:]
@@ -0,0 +1,72 @@
+import json
+from collections import Counter
+
+import aiomqtt
+import pytest
+
+from tessdb import cluster, context, mqtt
+from tessdb.decoder import PydanticDecoder
+from tessdb.router import Route, TopicRouter
+
+NAMES = [f"stars{k}" for k in range(1, 1001)]
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    def set_workers(workers: int, index: int) -> None:
+        monkeypatch.setattr(cluster.state, "workers", workers)
+        monkeypatch.setattr(cluster.state, "index", index)
+        topics = [
+            ("STARS4ALL/register", Route.REGISTER),
+            ("STARS4ALL/+/reading", Route.READING),
+            (cluster.handoff_topic(index), Route.HANDOFF),
+        ]
+        monkeypatch.setattr(mqtt.state, "router", TopicRouter(topics, Route.READING))
+
+    monkeypatch.setattr(mqtt.state, "decoder", PydanticDecoder())
+    monkeypatch.setattr(mqtt.state, "dedup_window", 0)
+    context.configure([], [])
+    return set_workers
+
+
+def message(topic: str, name: str) -> aiomqtt.Message:
+    payload = json.dumps({"name": name, "seq": 1}).encode("utf-8")
+    return aiomqtt.Message(topic, payload, 1, False, 1, None)
+
+
+def test_balanced(workers):
+    """Photometers are spread evenly among workers and their filter partitions"""
+    workers(4, 0)
+    owners = Counter(cluster.owner(name) for name in NAMES)
+    assert sorted(owners) == [0, 1, 2, 3]
+    assert min(owners.values()) > 200
+    owned = [name for name in NAMES if cluster.is_owned(name)]
+    partitions = Counter(cluster.partition(name, 2) for name in owned)
+    assert min(partitions.values()) > 0.4 * len(owned)
+
+
+def test_handoff(workers):
+    """Readings are handed off to their owner worker, once"""
+    workers(3, 1)
+    batch = [message(f"STARS4ALL/{name}/reading", name) for name in NAMES[:30]]
+    _, readings, handoff = mqtt._classify(batch)
+    assert [row["name"] for row in readings] == [n for n in NAMES[:30] if cluster.is_owned(n)]
+    for topic, payload in handoff:
+        name = json.loads(payload)["name"]
+        assert topic == cluster.handoff_topic(cluster.owner(name))
+        assert not cluster.is_owned(name)
+    assert len(readings) + len(handoff) == 30
+    # Readings handed off by other workers are kept even if owned by another one
+    batch = [message(cluster.handoff_topic(1), name) for name in NAMES[:30]]
+    _, readings, handoff = mqtt._classify(batch)
+    assert len(readings) == 30
+    assert not handoff
+
+
+def test_owner_case(workers):
+    """Photometer names are case insensitive, so is their owner"""
+    workers(3, 0)
+    batch = [message(f"STARS4ALL/{name}/reading", name.upper()) for name in NAMES[:30]]
+    _, _, handoff = mqtt._classify(batch)
+    for topic, payload in handoff:
+        assert topic == cluster.handoff_topic(cluster.owner(json.loads(payload)["name"].lower()))
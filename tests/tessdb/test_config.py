@@ -0,0 +1,120 @@
+from pathlib import Path
+
+import pytest
+
+from tessdbapi.filter import LookAheadFilter, Sampler
+
+from tessdb import cluster, dbase, mqtt, queues, server, filter as filtering
+
+SAMPLE = Path(__file__).parents[2] / "files" / "config.toml"
+
+# Options added after the first release
+ADDED = {
+    "mqtt": (
+        "decoder",
+        "batch_size",
+        "batch_latency",
+        "decode_workers",
+        "dedup_window",
+        "capture_dir",
+        "capture_size",
+        "capture_files",
+    ),
+    "filter": (
+        "engine",
+        "partitions",
+        "flush_deadline",
+        "checkpoint_path",
+        "checkpoint_max_age",
+        "ephemeris",
+        "ephemeris_period",
+        "night_altitude",
+        "day_altitude",
+        "queue",
+    ),
+    "dbase": (
+        "max_batch_latency",
+        "adaptive_batch",
+        "min_buffer_size",
+        "max_buffer_size",
+        "commit_latency_target",
+        "buffer_increase",
+        "buffer_decrease",
+        "references_ttl",
+        "lanes",
+        "bulk_insert",
+        "idempotent_writes",
+        "write_retries",
+        "retry_backoff",
+        "max_backoff",
+        "dead_letter_path",
+        "pause_spill_dir",
+        "catchup_batch_size",
+        "queue_weights",
+        "spool_dir",
+        "segment_size",
+    ),
+}
+
+
+def sample() -> dict:
+    options = server.load_config(SAMPLE)
+    # The sample puts disabled_for in the [filter.enable] table, but it is read from [filter]
+    options["filter"]["disabled_for"] = options["filter"]["enable"].pop("disabled_for")
+    return options
+
+
+def former(options: dict) -> dict:
+    """The sample options without those added after the first release"""
+    options = {section: dict(values) for section, values in options.items()}
+    for section, keys in ADDED.items():
+        for key in keys:
+            del options[section][key]
+    del options["cluster"]
+    return options
+
+
+def settings(options: dict) -> dict:
+    """The plain settings of every module state, once configured with the options"""
+    states = {
+        "mqtt": mqtt.State(),
+        "filter": filtering.State(),
+        "dbase": dbase.State(),
+        "cluster": cluster.State(),
+    }
+    for section, obj in states.items():
+        if section == "cluster":
+            obj.update(options.get("cluster", {}), None)
+        else:
+            obj.update(options[section])
+    result = {
+        f"{section}.{name}": getattr(obj, name)
+        for section, obj in states.items()
+        for name in obj.__slots__
+        if isinstance(getattr(obj, name), (bool, int, float, str, list, dict))
+    }
+    result["mqtt.decoder"] = states["mqtt"].decoder.name
+    result["mqtt.capture"] = states["mqtt"].capture
+    queue = queues.PartitionedQueue("config", options["filter"].get("queue", {}), 1)
+    result["filter.queue"] = (queue.partitions[0].high, queue.partitions[0].policy)
+    queue.close()
+    return result
+
+
+@pytest.fixture
+def isolated(monkeypatch):
+    """Module states and filter instances configured here are not left behind"""
+    for module in (mqtt, filtering, dbase, cluster):
+        monkeypatch.setattr(module, "state", module.State())
+    monkeypatch.setattr(Sampler, "instances", dict())
+    monkeypatch.setattr(LookAheadFilter, "instances", dict())
+    monkeypatch.setattr(LookAheadFilter, "flushing_names", set())
+    monkeypatch.setattr(dbase.controller, "size", 0)
+    monkeypatch.setattr(dbase.references.cache, "ttl", dbase.references.cache.ttl)
+
+
+def test_former_config(isolated):
+    """A config without the options added since works as before, as the sample one does"""
+    options = sample()
+    assert settings(former(options)) == settings(options)
+    assert settings(options)["filter.queue"] == (queues.UNBOUNDED, "drop-oldest")
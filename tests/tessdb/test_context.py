@@ -0,0 +1,46 @@
+from tessdb.context import SequenceWindow
+
+
+def test_duplicates():
+    window = SequenceWindow(size=8)
+    assert [window.seen(seq, None) for seq in (1, 2, 3, 2, 3, 4)] == [
+        False,
+        False,
+        False,
+        True,
+        True,
+        False,
+    ]
+
+
+def test_out_of_order():
+    window = SequenceWindow(size=8)
+    assert [window.seen(seq, None) for seq in (10, 7, 9, 7, 8, 10)] == [
+        False,
+        False,
+        False,
+        True,
+        False,
+        True,
+    ]
+
+
+def test_restart():
+    """Sequence numbers outside the window restart it"""
+    window = SequenceWindow(size=8)
+    for seq in range(100, 110):
+        window.seen(seq, None)
+    assert not window.seen(1, None)
+    assert not window.seen(2, None)
+    assert window.seen(1, None)
+    assert not window.seen(200, None)
+
+
+def test_hashes():
+    """A sequence number reused with a different hash is not a duplicate"""
+    window = SequenceWindow(size=8)
+    assert not window.seen(5, "AAA")
+    assert not window.seen(6, "AAB")
+    assert window.seen(5, "AAA")
+    assert not window.seen(5, "BBB")
+    assert window.seen(5, "BBB")
@@ -0,0 +1,228 @@
+import asyncio
+import time
+from collections import deque
+
+import pytest
+
+from tessdb import cluster, columnar, dbase
+from tessdb.constants import MessagePriority
+from tessdb.queues import LaneQueue
+
+
+@pytest.fixture
+def written(monkeypatch, tmp_path):
+    """Readings written by the database writer, instead of writing them"""
+    result = list()
+
+    async def flush_readings(session, batch, auth_filter, timed):
+        result.extend(batch.readings)
+        batch.clear()
+
+    monkeypatch.setattr(dbase, "flush_readings", flush_readings)
+    monkeypatch.setattr(dbase, "spill", dbase.Spill())
+    monkeypatch.setattr(dbase.state, "pause_spill_dir", str(tmp_path))
+    monkeypatch.setattr(dbase.state, "catchup_batch_size", 7)
+    return result
+
+
+@pytest.mark.asyncio
+async def test_catch_up_order(tmp_path, written, readings):
+    """Spilled readings are written before the live ones, which are spilled meanwhile"""
+    spilled = readings("stars1", 20)
+    writer = columnar.ColumnarWriter(str(tmp_path / "paused-0-1.col"), 7)
+    writer.write(spilled)
+    writer.close()
+    dbase.spill_files()
+    queue = LaneQueue(tmp_path.name, {"queue_size": 100, "queue_weights": []})
+    live = readings("stars1", 30, start=20)
+    for k in range(0, 15, 5):
+        queue.put_nowait((MessagePriority.MQTT_READINGS, live[k : k + 5]))
+    await dbase.catch_up(None, queue)
+    assert queue.empty()
+    for k in range(15, 30, 5):
+        queue.put_nowait((MessagePriority.MQTT_READINGS, live[k : k + 5]))
+    while dbase.spill:
+        await dbase.catch_up(None, queue)
+    assert written == spilled + live
+    assert not list(tmp_path.glob("*.col"))
+
+
+@pytest.fixture
+def lanes(monkeypatch):
+    """Two writer lanes buffering up to 100 readings, with no time limit"""
+    monkeypatch.setattr(dbase.state, "lanes", 2)
+    monkeypatch.setattr(dbase.state, "buffer_size", 100)
+    monkeypatch.setattr(dbase.state, "max_batch_latency", 0)
+    monkeypatch.setattr(dbase.state, "adaptive_batch", False)
+    monkeypatch.setattr(dbase.state, "paused", False)
+    monkeypatch.setattr(dbase.state, "resumed", False)
+    return dbase.new_lanes()
+
+
+def split(lanes: list, batch: list) -> list:
+    parts = [list() for _ in lanes]
+    for reading in batch:
+        parts[cluster.partition(reading.name, len(lanes))].append(reading)
+    assert all(parts)
+    return parts
+
+
+def key(reading) -> tuple:
+    return reading.name, reading.sequence_number
+
+
+@pytest.mark.asyncio
+async def test_lanes_catch_up_order(tmp_path, written, lanes, readings):
+    """Readings buffered by the lanes before pausing are written before the spilled ones"""
+    names = [f"stars{k}" for k in range(1, 5)]
+    buffered = [r for name in names for r in readings(name, 3)]
+    spilled = [r for name in names for r in readings(name, 3, start=3)]
+    queue = LaneQueue(tmp_path.name, {"queue_size": 100, "queue_weights": []})
+    tasks = [asyncio.create_task(dbase.lane_writer(lane, None, queue, deque())) for lane in lanes]
+    try:
+        for lane, part in zip(lanes, split(lanes, buffered)):
+            lane.queue.put_nowait((MessagePriority.MQTT_READINGS, part, None))
+            await asyncio.wait_for(lane.queue.join(), timeout=1)
+        # Paused meanwhile
+        writer = columnar.ColumnarWriter(str(tmp_path / "paused-0-1.col"), 7)
+        writer.write(spilled)
+        writer.close()
+        dbase.spill_files()
+        tasks.append(asyncio.create_task(dbase.dispatcher(queue, lanes, None, deque(), None)))
+        async with asyncio.timeout(1):
+            while dbase.spill:
+                await asyncio.sleep(0.01)
+    finally:
+        for task in tasks:
+            task.cancel()
+    assert sorted(map(key, written[: len(buffered)])) == sorted(map(key, buffered))
+    assert written[len(buffered) :] == spilled
+
+
+@pytest.mark.asyncio
+async def test_lanes_backpressure(tmp_path, written, lanes, readings):
+    """The dispatcher waits while a lane has LANE_QUEUE_SIZE batches queued"""
+    queue = LaneQueue(tmp_path.name, {"queue_size": 100, "queue_weights": []})
+    for k in range(20):
+        queue.put_nowait((MessagePriority.MQTT_READINGS, readings("stars1", 1, start=k)))
+    lane = lanes[cluster.partition("stars1", len(lanes))]
+    task = asyncio.create_task(dbase.dispatcher(queue, lanes, None, deque(), None))
+    try:
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert lane.queue.qsize() == dbase.LANE_QUEUE_SIZE
+        # Another batch is waiting to be put in the lane
+        assert queue.qsize() == 20 - dbase.LANE_QUEUE_SIZE - 1
+        writer = asyncio.create_task(dbase.lane_writer(lane, None, queue, deque()))
+        try:
+            async with asyncio.timeout(1):
+                while not queue.empty():
+                    await asyncio.sleep(0.01)
+                await dbase.drain_lanes([lane])
+        finally:
+            writer.cancel()
+    finally:
+        task.cancel()
+    assert [r.sequence_number for r in written] == list(range(20))
+
+
+@pytest.fixture
+def flushes(monkeypatch):
+    """(readings, timed) written by every write buffer flush, instead of writing them"""
+    result = list()
+
+    async def flush_readings(session, batch, auth_filter, timed):
+        result.append(([r.sequence_number for r in batch.readings], timed))
+        batch.clear()
+
+    monkeypatch.setattr(dbase, "flush_readings", flush_readings)
+    monkeypatch.setattr(dbase.state, "adaptive_batch", False)
+    monkeypatch.setattr(dbase.state, "paused", False)
+    return result
+
+
+def test_batch_timeout(monkeypatch, readings):
+    """Time left for the oldest buffered reading to reach max_batch_latency"""
+    batch = dbase.WriteBuffer()
+    monkeypatch.setattr(dbase.state, "max_batch_latency", 10)
+    assert dbase.batch_timeout(batch) is None
+    batch.append(readings("stars1", 1)[0])
+    assert 9 < dbase.batch_timeout(batch) <= 10
+    batch.since -= 20
+    assert dbase.batch_timeout(batch) == 0
+    monkeypatch.setattr(dbase.state, "max_batch_latency", 0)
+    assert dbase.batch_timeout(batch) is None
+
+
+@pytest.mark.asyncio
+async def test_latency_flush(monkeypatch, flushes, readings):
+    """A write buffer not full is flushed once its oldest reading is max_batch_latency old"""
+    monkeypatch.setattr(dbase.state, "buffer_size", 5)
+    monkeypatch.setattr(dbase.state, "max_batch_latency", 0.1)
+    lane = dbase.Lane(index=0, queue=asyncio.Queue())
+    task = asyncio.create_task(dbase.lane_writer(lane, None, None, None))
+    try:
+        start = time.monotonic()
+        lane.queue.put_nowait((MessagePriority.MQTT_READINGS, readings("stars1", 7), None))
+        await asyncio.sleep(0.05)
+        assert flushes == [(list(range(5)), False)]
+        lane.queue.put_nowait((MessagePriority.MQTT_READINGS, readings("stars1", 1, 7), None))
+        while len(flushes) < 2:
+            await asyncio.sleep(0.01)
+        assert flushes[1] == ([5, 6, 7], True)
+        assert time.monotonic() - start >= 0.1
+    finally:
+        task.cancel()
+
+
+def test_aimd():
+    """The buffer grows additively under the target latency and shrinks multiplicatively"""
+    controller = dbase.BatchController()
+    options = {
+        "buffer_size": 5,
+        "min_buffer_size": 10,
+        "max_buffer_size": 200,
+        "commit_latency_target": 1.0,
+        "buffer_increase": 50,
+        "buffer_decrease": 0.5,
+    }
+    controller.configure(options)
+    assert controller.size == 10
+    sizes = list()
+    for latency, ok, full in [
+        (0.5, True, True),
+        (0.5, True, True),
+        (0.5, True, False),  # partial buffer
+        (0.5, True, True),
+        (0.5, True, True),
+        (1.5, True, True),  # too slow
+        (0.5, False, True),  # failed
+        (0.5, False, True),
+    ]:
+        controller.update(latency, ok, full)
+        sizes.append(controller.size)
+    assert sizes == [60, 110, 110, 160, 200, 100, 50, 25]
+    assert (controller.num_increased, controller.num_decreased) == (4, 3)
+    assert controller.num_failed == 2
+    for _ in range(5):
+        controller.update(0.5, False, True)
+    assert controller.size == 10
+    # A reload keeps the current size within the new bounds
+    controller.configure(dict(options, min_buffer_size=20))
+    assert controller.size == 20
+
+
+def test_columnar_round_trip(mixed_readings):
+    payload = columnar.encode(mixed_readings)
+    assert columnar.decode(payload, len(mixed_readings)) == mixed_readings
+
+
+def test_columnar_file(tmp_path, mixed_readings):
+    path = str(tmp_path / "readings.col")
+    writer = columnar.ColumnarWriter(path, 3)
+    writer.write(mixed_readings)
+    writer.close()
+    assert columnar.count(path) == len(mixed_readings)
+    chunks = list(columnar.read_chunks(path))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    assert sum(chunks, []) == mixed_readings
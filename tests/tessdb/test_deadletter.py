@@ -0,0 +1,82 @@
+from contextlib import asynccontextmanager
+
+import pytest
+
+from tessdb import dbase, deadletter
+from tessdb.cli import deadletter as cli
+
+
+def test_round_trip(tmp_path, mixed_readings):
+    path = str(tmp_path / "dbase.dead")
+    deadletter.append(path, mixed_readings[:4], "database is locked")
+    deadletter.append(path, mixed_readings[4:], "FOREIGN KEY constraint failed")
+    records = list(deadletter.read(path))
+    assert [record.reason for record in records] == [
+        "database is locked",
+        "FOREIGN KEY constraint failed",
+    ]
+    assert [record.readings for record in records] == [mixed_readings[:4], mixed_readings[4:]]
+
+
+def test_torn_record(tmp_path, readings):
+    """A record partially written by a crash ends the file"""
+    path = tmp_path / "dbase.dead"
+    for k in range(3):
+        deadletter.append(str(path), readings("stars1", 5, start=5 * k), "error")
+    path.write_bytes(path.read_bytes()[:-1])
+    assert len(list(deadletter.read(str(path)))) == 2
+
+
+class Engine:
+    async def dispose(self) -> None:
+        pass
+
+
+@asynccontextmanager
+async def session():
+    yield None
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Readings written by the replay, instead of writing them"""
+    result = list()
+
+    async def flush_readings(session, batch, auth_filter, timed):
+        result.extend(batch.readings)
+        batch.clear()
+
+    monkeypatch.setattr(dbase, "state", dbase.State())
+    monkeypatch.setattr(dbase, "controller", dbase.BatchController())
+    monkeypatch.setattr(dbase.references.cache, "ttl", dbase.references.cache.ttl)
+    monkeypatch.setattr(dbase, "flush_readings", flush_readings)
+    monkeypatch.setattr(dbase, "Session", session)
+    monkeypatch.setattr(dbase, "engine", Engine())
+    return result
+
+
+OPTIONS = {"log_level": "info", "buffer_size": 1, "auth_filter": False}
+
+
+@pytest.mark.asyncio
+async def test_replay(tmp_path, written, readings):
+    path = tmp_path / "dbase.dead"
+    batches = [readings("stars1", 5, start=5 * k) for k in range(3)]
+    for batch in batches:
+        deadletter.append(str(path), batch, "database is locked")
+    assert await cli.replay(str(path), OPTIONS) == 15
+    assert written == sum(batches, [])
+    assert not list(tmp_path.iterdir())
+
+
+@pytest.mark.asyncio
+async def test_interrupted_replay(tmp_path, written, readings):
+    """Readings left by an interrupted replay are written first, not overwritten"""
+    path = tmp_path / "dbase.dead"
+    older = readings("stars1", 5)
+    deadletter.append(f"{path}.replaying", older, "database is locked")
+    newer = readings("stars1", 5, start=5)
+    deadletter.append(str(path), newer, "database is locked")
+    assert await cli.replay(str(path), OPTIONS) == 10
+    assert written == older + newer
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,111 @@
+import json
+
+import pytest
+
+from tessdb.decoder import PydanticDecoder, CompiledDecoder, msgspec
+
+pytestmark = pytest.mark.skipif(msgspec is None, reason="msgspec not installed")
+
+TESSW = {"name": "stars2", "seq": 1, "freq": 10, "mag": 20, "tamb": 1, "tsky": -5, "wdBm": -60}
+CHANNELS = {f"F{i}": {"freq": 10.5 * i, "mag": 18.25 + i} for i in range(1, 5)}
+TESS4C = {"name": "stars1000", "seq": 7, "wdBm": -72, "tamb": 12.5, "tsky": -3.0, **CHANNELS}
+
+READINGS = [
+    TESSW,
+    dict(TESSW, wdBm=None),
+    dict(TESSW, hash="A1B"),
+    dict(TESSW, tstamp="2025-01-01T00:10:00"),
+    dict(TESSW, tstamp="2025-01-01T00:10:00Z"),
+    dict(TESSW, tstamp="2025-01-01T00:10:00+01:00"),
+    dict(TESSW, freq=1.5e-3, mag=0.0, tamb=-10.25, tsky=-30),
+    dict(TESSW, unknown="ignored"),
+    TESS4C,
+    dict(TESS4C, wdBm=None),
+    {k: v for k, v in TESS4C.items() if k not in ("tamb", "tsky")},
+    dict(TESS4C, tstamp="2025-06-30T23:59:59Z", hash="FFF"),
+]
+
+BAD_READINGS = [
+    {k: v for k, v in TESSW.items() if k != "seq"},
+    {k: v for k, v in TESSW.items() if k != "wdBm"},
+    dict(TESSW, mag="twenty"),
+    {k: v for k, v in TESS4C.items() if k != "F3"},
+]
+
+TESSW_REGISTER = {"name": "stars2", "mac": "AA:BB:CC:DD:EE:FF", "calib": 20.5, "firmware": "1.0"}
+TESS4C_REGISTER = {
+    "name": "stars1000",
+    "mac": "AA:BB:CC:DD:EE:00",
+    **{f"F{i}": {"calib": 20.0 + i, "band": f"B{i}", "offsethz": 0.1 * i} for i in range(1, 5)},
+}
+
+REGISTERS = [
+    TESSW_REGISTER,
+    dict(TESSW_REGISTER, offsethz=0.25, date="Jan 1 2025"),
+    dict(TESSW_REGISTER, firmware=None),
+    TESS4C_REGISTER,
+    dict(TESS4C_REGISTER, firmware="Dec 2 2024", tstamp="2025-01-01T00:00:00Z"),
+]
+
+
+def encode(row: dict) -> bytes:
+    return json.dumps(row).encode("utf-8")
+
+
+@pytest.fixture
+def decoders():
+    return PydanticDecoder(), CompiledDecoder()
+
+
+def same(a, b) -> bool:
+    a, b = a.model_dump(), b.model_dump()
+    # Subscriber timestamps are taken at decoding time
+    if a["tstamp_src"] == b["tstamp_src"] and a["tstamp_src"].value == "Subscriber":
+        del a["tstamp"], b["tstamp"]
+    return type(a) is type(b) and a == b
+
+
+@pytest.mark.parametrize("row", READINGS)
+def test_reading(decoders, row):
+    reference, compiled = decoders
+    payload = encode(row)
+    assert same(reference.reading(payload), compiled.reading(payload))
+
+
+@pytest.mark.parametrize("row", READINGS)
+def test_header(decoders, row):
+    reference, compiled = decoders
+    payload = encode(row)
+    assert reference.header(payload) == compiled.header(payload)
+
+
+@pytest.mark.parametrize("row", BAD_READINGS)
+def test_bad_reading(decoders, row):
+    for decoder in decoders:
+        with pytest.raises(Exception):
+            decoder.reading(encode(row))
+
+
+@pytest.mark.parametrize("row", REGISTERS)
+def test_register(decoders, row):
+    reference, compiled = decoders
+    payload = encode(row)
+    assert same(reference.register(payload), compiled.register(payload))
+
+
+@pytest.mark.parametrize("row", READINGS)
+def test_peek_reading(decoders, row):
+    """Readings decode the same from the payload returned by peek()"""
+    payload = encode(row)
+    for decoder in decoders:
+        header, data = decoder.peek(payload)
+        assert header == decoder.header(payload)
+        assert same(decoder.reading(data), decoder.reading(payload))
+
+
+@pytest.mark.parametrize("row", REGISTERS)
+def test_peek_register(decoders, row):
+    payload = encode(row)
+    for decoder in decoders:
+        _, data = decoder.peek(payload)
+        assert same(decoder.register(data), decoder.register(payload))
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from pubsub import pub
+
+from tessdbapi.filter import LookAheadFilter, Sampler
+
+from tessdb import context, dbase, filter as filtering
+from tessdb.constants import Topic
+from tessdb.lookahead import TrackedFilter
+
+NAMES = ["stars1", "stars2", "stars3"]
+
+
+@pytest.fixture
+def filters(monkeypatch):
+    def configure(engine: str, threshold: float = 0, deadline: float = 0) -> None:
+        state = filtering.State(sync_queue=asyncio.Queue(maxsize=1))
+        state.update(
+            {
+                "depth": 3,
+                "engine": engine,
+                "enable": {"daylight": True},
+                "disabled_for": [],
+                "divisor": {},
+                "log_level": "info",
+                "loggers": {},
+                "flush_threshold": threshold,
+                "flush_deadline": deadline,
+            }
+        )
+        monkeypatch.setattr(filtering, "state", state)
+
+    monkeypatch.setattr(dbase, "state", dbase.State())
+    monkeypatch.setattr(Sampler, "instances", dict())
+    monkeypatch.setattr(LookAheadFilter, "instances", dict())
+    monkeypatch.setattr(LookAheadFilter, "flushing_names", set())
+    monkeypatch.setattr(TrackedFilter, "instances", dict())
+    context.invalidate()
+    yield configure
+    context.invalidate()
+
+
+@pytest.fixture
+def flushed():
+    """Number of database flush requests"""
+    count = [0]
+
+    def listener() -> None:
+        count[0] += 1
+
+    pub.subscribe(listener, Topic.DATABASE_FLUSH)
+    yield count
+    pub.unsubscribe(listener, Topic.DATABASE_FLUSH)
+
+
+async def settle(queue: asyncio.Queue) -> None:
+    while not queue.empty():
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["lookahead", "array"])
+async def test_flush_progress(filters, flushed, readings, engine):
+    """Filters count as flushed as they drain, and the database is flushed once all did"""
+    filters(engine)
+    filt_queue, db_queue = asyncio.Queue(), asyncio.Queue()
+    tasks = [
+        asyncio.create_task(filtering.partition(0, filt_queue, db_queue)),
+        asyncio.create_task(filtering.filter_flush_monitor()),
+    ]
+    try:
+        for name in NAMES:
+            filt_queue.put_nowait(readings(name, 4))
+        await settle(filt_queue)
+        filtering.on_server_flush()
+        progress = filtering.state.progress
+        assert progress.active == 3
+        assert progress.pending == set(NAMES)
+        for k, name in enumerate(NAMES, start=1):
+            filt_queue.put_nowait(readings(name, 1, start=4))
+            await settle(filt_queue)
+            assert list(progress.drained) == NAMES[:k]
+            assert progress.pending == set(NAMES[k:])
+            assert progress.done.is_set() == (k == 3)
+        await asyncio.sleep(0)
+        assert flushed[0] == 1
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_flush_threshold(filters, flushed, readings):
+    """The database is flushed once no more than flush_threshold filters are pending"""
+    filters("lookahead", threshold=1)
+    for name in NAMES:
+        for reading in readings(name, 4):
+            filtering.do_filter(reading, [], [])
+    filtering.on_server_flush()
+    progress = filtering.state.progress
+    progress.drain(["stars1"], filtering.state.threshold)
+    assert not progress.done.is_set()
+    progress.drain(["stars2"], filtering.state.threshold)
+    assert progress.done.is_set()
+    await filtering.filter_flush_monitor()
+    assert flushed[0] == 1
+    assert progress.pending == {"stars3"}
+
+
+@pytest.mark.asyncio
+async def test_flush_deadline(filters, flushed, readings):
+    """The database is flushed at the deadline, even with filters still pending"""
+    filters("lookahead", deadline=0.05)
+    for name in NAMES:
+        for reading in readings(name, 4):
+            filtering.do_filter(reading, [], [])
+    filtering.on_server_flush()
+    await asyncio.wait_for(filtering.filter_flush_monitor(), timeout=1)
+    assert flushed[0] == 1
+    assert filtering.state.progress.pending == set(NAMES)
+    assert filtering.state.progress.elapsed >= 0.05
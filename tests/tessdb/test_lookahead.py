@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+from tessdbapi.filter import LookAheadFilter, Sampler
+
+from tessdb.lookahead import TrackedFilter
+
+CASES = 100
+
+
+def tracked(name: str, depth: int, divisor: int, buffered: bool) -> TrackedFilter:
+    sampler = Sampler(name)
+    sampler.configure(divisor)
+    fifo = LookAheadFilter(name)
+    fifo.configure(depth, False, buffered)
+    return TrackedFilter(sampler, fifo)
+
+
+def push(obj: TrackedFilter, sample) -> tuple:
+    sample = obj.sample(sample)
+    if sample is None:
+        return None, []
+    return obj.push_pop(sample)
+
+
+@pytest.mark.parametrize("seed", range(CASES))
+def test_dump_load(seed, readings):
+    """A filter restored from its dump behaves as the original one"""
+    rng = random.Random(seed)
+    LookAheadFilter.reset()
+    depth = rng.choice((3, 5, 7))
+    divisor = rng.choice((1, 2, 3))
+    buffered = rng.random() < 0.8
+    stream = readings("stars1", rng.randint(20, 80))
+    stream = [r.model_copy(update={"mag1": rng.choice((0.0, 0.0, 19.5))}) for r in stream]
+    cut = rng.randrange(len(stream))
+    original = tracked("stars1", depth, divisor, buffered)
+    for sample in stream[:cut]:
+        push(original, sample)
+        # Tracked from the outside, the same as the private window
+        assert list(original.window) == list(original.lookahead._fifo)
+        if rng.random() < 0.05:
+            divisor = rng.choice((1, 2, 3))
+            original.sampler.divisor = divisor
+    restored = tracked("stars1", depth, 1, buffered)
+    restored.load(*original.dump())
+    # A pending divisor comes from the configuration
+    restored.sampler.divisor = divisor
+    assert restored.dump() == original.dump()
+    for sample in stream[cut:]:
+        assert push(restored, sample) == push(original, sample)
@@ -0,0 +1,146 @@
+import json
+import asyncio
+
+import aiomqtt
+import pytest
+
+from tessdb import context, mqtt
+from tessdb.decoder import PydanticDecoder
+from tessdb.router import Route, TopicRouter
+
+
+class Messages:
+    """Stand-in for the client messages iterator, with the messages already buffered"""
+
+    def __init__(self) -> None:
+        self.buffered = list()
+
+    def add(self, n: int) -> None:
+        for _ in range(n):
+            k = len(self.buffered)
+            self.buffered.append(
+                aiomqtt.Message("STARS4ALL/stars1/reading", b"%d" % k, 2, False, k, None)
+            )
+
+    def __len__(self) -> int:
+        return len(self.buffered)
+
+    async def __anext__(self) -> aiomqtt.Message:
+        return self.buffered.pop(0)
+
+
+@pytest.fixture
+def batching(monkeypatch):
+    def set_batching(size: int, latency: float) -> None:
+        monkeypatch.setattr(mqtt.state, "batch_size", size)
+        monkeypatch.setattr(mqtt.state, "batch_latency", latency)
+
+    return set_batching
+
+
+@pytest.mark.asyncio
+async def test_drain_buffered(batching):
+    """Only the buffered messages are taken, up to the batch size"""
+    batching(4, 0.0)
+    messages = Messages()
+    messages.add(6)
+    batch = [None]
+    await mqtt._drain(messages, batch)
+    assert len(batch) == 4
+    assert len(messages) == 3
+    batch = [None]
+    await mqtt._drain(messages, batch)
+    assert len(batch) == 4
+    assert len(messages) == 0
+
+
+@pytest.mark.asyncio
+async def test_drain_latency(batching):
+    """A batch not full waits batch_latency once for more messages"""
+    batching(10, 0.05)
+    messages = Messages()
+    messages.add(2)
+    loop = asyncio.get_running_loop()
+    loop.call_later(0.01, messages.add, 3)
+    loop.call_later(0.2, messages.add, 1)
+    batch = [None]
+    received = [0]
+    await mqtt._drain(messages, batch, received)
+    assert len(batch) == 6
+    assert len(received) == 6
+    await asyncio.sleep(0.25)
+    assert len(messages) == 1
+
+
+@pytest.fixture
+def classify(monkeypatch):
+    monkeypatch.setattr(mqtt.state, "decoder", PydanticDecoder())
+    monkeypatch.setattr(mqtt.state, "dedup_window", 0)
+    filters = [("STARS4ALL/register", Route.REGISTER), ("STARS4ALL/+/reading", Route.READING)]
+    monkeypatch.setattr(mqtt.state, "router", TopicRouter(filters, Route.READING))
+    context.configure([], [])
+    yield mqtt._classify
+    context.configure([], [])
+
+
+def message(name: str, seq: int) -> aiomqtt.Message:
+    payload = json.dumps({"name": name, "seq": seq}).encode("utf-8")
+    return aiomqtt.Message(f"STARS4ALL/{name}/reading", payload, 2, False, seq, None)
+
+
+def test_listed_names(classify):
+    """White & black lists compare the names as published"""
+    batch = [message("Stars1", 1), message("stars1", 2), message("stars2", 3)]
+    context.configure(["Stars1", "stars2"], ["stars2"])
+    _, readings, _ = classify(batch)
+    assert [row["seq"] for row in readings] == [1]
+
+
+def test_parsed_once(classify):
+    """Payloads parsed to apply the lists are not parsed again"""
+    context.configure([], ["stars2"])
+    _, readings, _ = classify([message("stars1", 1)])
+    assert readings == [{"name": "stars1", "seq": 1}]
+
+
+@pytest.mark.asyncio
+async def test_pool_resize(monkeypatch, readings):
+    """Resizing the decoding pool keeps the readings order"""
+    monkeypatch.setattr(mqtt.state, "decoder", PydanticDecoder())
+    rows = [
+        {"name": r.name, "seq": r.sequence_number, "freq": 10, "mag": 20, "tamb": 1, "tsky": -5}
+        for r in readings("stars1", 40)
+    ]
+    payloads = [json.dumps(dict(row, wdBm=-60)).encode("utf-8") for row in rows]
+    filt_queue = asyncio.Queue()
+    pool = mqtt.DecodePool(filt_queue, None)
+    try:
+        for workers, chunk in zip((1, 2, 0, 2), range(0, 40, 10)):
+            await pool.resize(workers)
+            assert pool.workers == workers
+            part = payloads[chunk : chunk + 10]
+            if workers:
+                await pool.submit(part[:5])
+                await pool.submit(part[5:])
+            else:
+                mqtt._dispatch(map(mqtt._handle_reading, part), filt_queue, None)
+        await pool.pending.join()
+    finally:
+        pool.close()
+    result = list()
+    while not filt_queue.empty():
+        result.extend(filt_queue.get_nowait())
+    assert [info.sequence_number for info in result] == list(range(40))
+
+
+def test_duplicated(classify, monkeypatch):
+    """Redelivered readings are discarded before being decoded"""
+    monkeypatch.setattr(mqtt.state, "dedup_window", 8)
+    batch = [message(name, seq) for name, seq in [("stars1", 1), ("stars1", 2), ("Stars1", 1)]]
+    batch.append(message("stars2", 1))
+    _, readings, _ = classify(batch)
+    assert [(row["name"], row["seq"]) for row in readings] == [
+        ("stars1", 1),
+        ("stars1", 2),
+        ("stars2", 1),
+    ]
@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+
+from tessdb.constants import MessagePriority, OverflowPolicy
+from tessdb.queues import LaneQueue, PartitionedQueue, SheddingQueue
+
+
+def shedding_queue(policy: OverflowPolicy, tmp_path) -> SheddingQueue:
+    options = {
+        "high_watermark": 10,
+        "low_watermark": 5,
+        "policy": policy.value,
+        "spill_dir": str(tmp_path),
+    }
+    # Queue stats are kept by name
+    return SheddingQueue(f"{tmp_path.name}-{policy}", options)
+
+
+async def drain(queue: SheddingQueue) -> list:
+    result = list()
+    while not queue.empty():
+        result.extend(queue.get_nowait())
+        queue.task_done()
+    # Nothing left to process
+    await asyncio.wait_for(queue.join(), timeout=1)
+    return result
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy", list(OverflowPolicy))
+async def test_shedding_join(policy, tmp_path, readings):
+    queue = shedding_queue(policy, tmp_path)
+    try:
+        for k in range(8):
+            queue.put_nowait(readings(f"stars{k % 3}", 3, start=3 * k))
+        result = await drain(queue)
+    finally:
+        queue.close()
+    if policy == OverflowPolicy.SPILL:
+        assert [r.sequence_number for r in result] == list(range(24))
+    else:
+        assert len(result) < 24
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_keeps_newest(tmp_path, readings):
+    queue = shedding_queue(OverflowPolicy.DROP_OLDEST, tmp_path)
+    for k in range(8):
+        queue.put_nowait(readings("stars1", 3, start=3 * k))
+    result = await drain(queue)
+    assert result[-1].sequence_number == 23
+    assert queue.stats.num_dropped_oldest + len(result) == 24
+
+
+@pytest.mark.asyncio
+async def test_fair_share(tmp_path, readings):
+    """No photometer gets more than its share, even from a single large batch"""
+    queue = shedding_queue(OverflowPolicy.FAIR, tmp_path)
+    queue.put_nowait(readings("stars1", 2))
+    queue.put_nowait(readings("stars2", 20))
+    result = await drain(queue)
+    # low_watermark 5 shared between 2 photometers
+    assert [r.name for r in result] == ["stars1"] * 2 + ["stars2"] * 2
+    assert queue.stats.num_dropped_fair == 18
+
+
+@pytest.mark.asyncio
+async def test_watermarks(tmp_path, readings):
+    """Readings are shed from the high watermark until the queue drains below the low one"""
+    queue = shedding_queue(OverflowPolicy.DROP_NEWEST, tmp_path)
+    for k in range(4):
+        queue.put_nowait(readings("stars1", 3, start=3 * k))
+    assert queue.shedding
+    assert queue.stats.size == 9
+    queue.get_nowait()
+    queue.task_done()
+    # 6 queued, still above the low watermark
+    queue.put_nowait(readings("stars1", 1, start=12))
+    assert queue.stats.size == 6
+    queue.get_nowait()
+    queue.task_done()
+    assert not queue.shedding
+    queue.put_nowait(readings("stars1", 1, start=13))
+    result = await drain(queue)
+    assert [r.sequence_number for r in result] == [6, 7, 8, 13]
+    assert queue.stats.num_high_watermark == 1
+    assert queue.stats.num_dropped_newest == 4
+
+
+@pytest.mark.asyncio
+async def test_partitioned(tmp_path, readings):
+    """Each photometer goes to a single partition, its readings in order"""
+    options = {"high_watermark": 1000, "low_watermark": 500, "spill_dir": str(tmp_path)}
+    queue = PartitionedQueue(tmp_path.name, options, 3)
+    try:
+        assert [q.name for q in queue.partitions] == [f"{tmp_path.name}.{i}" for i in range(3)]
+        assert {(q.high, q.low) for q in queue.partitions} == {(333, 166)}
+        names = [f"stars{k}" for k in range(12)]
+        for k in range(5):
+            queue.put_nowait([r for name in names for r in readings(name, 2, start=2 * k)])
+        parts = [await drain(q) for q in queue.partitions]
+    finally:
+        queue.close()
+    assert all(parts)
+    owners = dict()
+    for index, part in enumerate(parts):
+        for name in {r.name for r in part}:
+            assert owners.setdefault(name, index) == index
+            seqs = [r.sequence_number for r in part if r.name == name]
+            assert seqs == list(range(10))
+    assert sorted(owners) == sorted(names)
+
+
+def lane_queue(tmp_path, weights: list[int]) -> LaneQueue:
+    return LaneQueue(tmp_path.name, {"queue_size": 100, "queue_weights": weights})
+
+
+def test_lane_repr(tmp_path):
+    queue = lane_queue(tmp_path, [])
+    queue.put_nowait((MessagePriority.MQTT_READINGS, "r1"))
+    assert "mqtt_readings=1" in repr(queue)
+    assert "register=0" in str(queue)
+
+
+def test_lane_priority_order(tmp_path):
+    queue = lane_queue(tmp_path, [])
+    items = [
+        (MessagePriority.MQTT_READINGS, "r1"),
+        (MessagePriority.REGISTER, "p1"),
+        (MessagePriority.MQTT_READINGS, "r2"),
+        (MessagePriority.FILTER_READINGS, "f1"),
+        (MessagePriority.REGISTER, "p2"),
+    ]
+    for item in items:
+        queue.put_nowait(item)
+    assert queue.qsize() == len(items)
+    result = [queue.get_nowait()[1] for _ in items]
+    assert result == ["p1", "p2", "f1", "r1", "r2"]
+    assert queue.empty()
+
+
+def test_lane_weights(tmp_path):
+    """Weighted lanes are served in proportion, keeping the order within each lane"""
+    queue = lane_queue(tmp_path, [1, 1, 2])
+    for k in range(8):
+        queue.put_nowait((MessagePriority.REGISTER, f"p{k}"))
+        queue.put_nowait((MessagePriority.MQTT_READINGS, f"r{k}"))
+    result = [queue.get_nowait()[1] for _ in range(12)]
+    assert [item for item in result if item[0] == "p"] == [f"p{k}" for k in range(4)]
+    assert [item for item in result if item[0] == "r"] == [f"r{k}" for k in range(8)]
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+from datetime import datetime
+
+import httpx
+import pytest
+import pytest_asyncio
+from pubsub import pub
+from sqlalchemy import event, update
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from tessdbdao import PhotometerModel, ReadingSource, RegisterState, TimestampSource, ValidState
+from tessdbdao.asyncio import Model, NameMapping, Tess, Units
+
+from tessdb import references
+from tessdb.constants import Topic
+from tessdb.http import app
+
+SINCE = datetime(2000, 1, 1)
+UNTIL = datetime(2999, 12, 31)
+
+
+def photometer(tess_id: int, authorised: bool) -> list:
+    mac = f"AA:BB:CC:DD:EE:{tess_id:02X}"
+    validity = dict(valid_since=SINCE, valid_until=UNTIL, valid_state=ValidState.CURRENT)
+    tess = Tess(
+        tess_id=tess_id,
+        mac_address=mac,
+        model=PhotometerModel.TESSW,
+        firmware="1.0",
+        authorised=authorised,
+        registered=RegisterState.AUTO,
+        nchannels=1,
+        zp1=20.5,
+        filter1="UV/IR-740",
+        location_id=-1,
+        observer_id=-1,
+        **validity,
+    )
+    return [tess, NameMapping(name=f"stars{tess_id}", mac_address=mac, **validity)]
+
+
+@pytest_asyncio.fixture
+async def session(tmp_path, monkeypatch):
+    """Session on a database with stars1 (authorised) and stars2 (not authorised)"""
+    monkeypatch.setattr(references, "cache", references.ReferenceCache())
+    monkeypatch.setattr(references, "stats", references.Stats())
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'references.db'}")
+    tables = [Units.__table__, Tess.__table__, NameMapping.__table__]
+    async with engine.begin() as conn:
+        await conn.run_sync(Model.metadata.create_all, tables=tables)
+    async with async_sessionmaker(engine, expire_on_commit=False)() as session:
+        async with session.begin():
+            session.add(
+                Units(
+                    units_id=1,
+                    reading_source=ReadingSource.DIRECT,
+                    timestamp_source=TimestampSource.PUBLISHER,
+                )
+            )
+            session.add_all(photometer(1, True) + photometer(2, False))
+        yield session
+    await engine.dispose()
+
+
+async def resolve(session, readings: list) -> tuple[list, dict]:
+    resolved, rejected = await references.cache.resolve(
+        session, readings, True, ReadingSource.DIRECT
+    )
+    return [ref.tess_id for _, ref in resolved], dict(rejected)
+
+
+async def authorise(session, tess_id: int, authorised: bool) -> None:
+    async with session.begin():
+        query = update(Tess).where(Tess.tess_id == tess_id).values(authorised=authorised)
+        await session.execute(query)
+
+
+@pytest.mark.asyncio
+async def test_resolve(session, readings):
+    """A whole buffer is resolved with one query, rejecting the readings as tessdbapi does"""
+    selects = list()
+
+    def count(conn, cursor, statement, *args) -> None:
+        if statement.lstrip().upper().startswith("SELECT"):
+            selects.append(statement)
+
+    event.listen(session.bind.sync_engine, "before_cursor_execute", count)
+    buffer = readings("stars1", 3) + readings("stars2", 2) + readings("stars9", 1)
+    assert await resolve(session, buffer) == (
+        [1, 1, 1],
+        {"not authorised": 2, "not registered": 1},
+    )
+    # The units are looked up once
+    assert len(selects) == 2
+    # Nothing is cached without a TTL
+    assert len(references.cache) == 0
+    await authorise(session, 2, True)
+    selects.clear()
+    assert await resolve(session, buffer) == ([1, 1, 1, 2, 2], {"not registered": 1})
+    assert len(selects) == 1
+
+
+@pytest.mark.asyncio
+async def test_cached(session, readings):
+    """Cached references are used until they expire or are invalidated"""
+    references.cache.ttl = 3600
+    buffer = readings("stars1", 2) + readings("stars2", 2)
+    await resolve(session, buffer)
+    await authorise(session, 2, True)
+    assert await resolve(session, buffer) == ([1, 1], {"not authorised": 2})
+    assert (references.stats.num_misses, references.stats.num_hits) == (4, 4)
+    references.cache.invalidate("stars2")
+    assert await resolve(session, buffer) == ([1, 1, 2, 2], {})
+    assert (references.stats.num_misses, references.stats.num_hits) == (6, 6)
+    assert references.stats.num_invalidated == 1
+    # Expired entries are looked up again
+    references.cache.ttl = 0.01
+    references.cache.invalidate()
+    await resolve(session, buffer)
+    await authorise(session, 1, False)
+    await asyncio.sleep(0.02)
+    assert await resolve(session, buffer) == ([2, 2], {"not authorised": 2})
+
+
+@pytest.mark.asyncio
+async def test_warm(session, readings):
+    """Warming loads every current photometer at once"""
+    references.cache.ttl = 3600
+    await references.cache.warm(session)
+    assert len(references.cache) == 2
+    await resolve(session, readings("stars1", 2) + readings("stars2", 2))
+    assert (references.stats.num_misses, references.stats.num_hits) == (0, 4)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("name", ["stars2", None])
+async def test_invalidate_request(session, readings, name):
+    """The HTTP request invalidates the cache from the event loop thread"""
+    references.cache.ttl = 3600
+    await references.cache.warm(session)
+    threads = list()
+
+    def listener(name=None) -> None:
+        threads.append(threading.current_thread())
+
+    pub.subscribe(listener, Topic.DATABASE_INVALIDATE)
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://tessdb") as client:
+            params = {"name": name} if name else {}
+            response = await client.post("/v1/dbase/references/invalidate", params=params)
+    finally:
+        pub.unsubscribe(listener, Topic.DATABASE_INVALIDATE)
+    assert response.status_code == 200
+    assert threads == [threading.current_thread()]
+    assert len(references.cache) == (1 if name else 0)
@@ -0,0 +1,50 @@
+import pytest
+
+from tessdb.router import Route, TopicRouter
+
+FILTERS = [
+    ("STARS4ALL/register", Route.REGISTER),
+    ("$share/tessdb/STARS4ALL/+/reading", Route.READING),
+    ("tessdb/handoff/#", Route.HANDOFF),
+    ("STARS4ALL/#", Route.REGISTER),
+]
+
+
+@pytest.fixture
+def router():
+    return TopicRouter(FILTERS, Route.READING)
+
+
+@pytest.mark.parametrize(
+    "topic, route",
+    [
+        ("STARS4ALL/register", Route.REGISTER),
+        ("STARS4ALL/stars1/reading", Route.READING),
+        ("tessdb/handoff/2", Route.HANDOFF),
+        ("tessdb/handoff", Route.HANDOFF),
+        ("tessdb/handoff/2/stars1", Route.HANDOFF),
+        ("STARS4ALL/stars1/other", Route.REGISTER),
+        ("STARS4ALL", Route.REGISTER),
+        ("other/topic", Route.READING),
+    ],
+)
+def test_route(router, topic, route):
+    assert router.route(topic) == route
+    # Cached
+    assert router.route(topic) == route
+
+
+def test_priority():
+    """The first matching filter wins, whatever its kind"""
+    router = TopicRouter(
+        [("a/#", Route.HANDOFF), ("a/+/c", Route.READING), ("a/b/c", Route.REGISTER)],
+        Route.READING,
+    )
+    assert router.route("a/b/c") == Route.HANDOFF
+    router = TopicRouter(
+        [("a/b/c", Route.REGISTER), ("a/+/c", Route.READING), ("a/#", Route.HANDOFF)],
+        Route.READING,
+    )
+    assert router.route("a/b/c") == Route.REGISTER
+    assert router.route("a/x/c") == Route.READING
+    assert router.route("a/x/d") == Route.HANDOFF
@@ -0,0 +1,77 @@
+import pytest
+
+from tessdb import spool
+from tessdb.constants import MessagePriority
+from tessdb.spool import SpoolQueue
+
+SEGMENT_SIZE = 4096
+
+
+def test_encode_decode(mixed_readings):
+    assert spool.decode(spool.encode(mixed_readings)) == mixed_readings
+
+
+@pytest.mark.asyncio
+async def test_spool_order(tmp_path, readings):
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    # Enough batches to span several segments
+    batches = [readings("stars1", 5, start=5 * k) for k in range(40)]
+    for batch in batches:
+        queue.put_nowait((MessagePriority.MQTT_READINGS, batch))
+    assert queue.qsize() == len(batches)
+    for batch in batches:
+        priority, items = await queue.get()
+        assert priority == MessagePriority.MQTT_READINGS
+        assert items == batch
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_replay(tmp_path, readings):
+    """Readings not acknowledged are read again after a restart"""
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    batches = [readings("stars1", 5, start=5 * k) for k in range(40)]
+    for batch in batches:
+        queue.put_nowait((MessagePriority.MQTT_READINGS, batch))
+    for _ in range(25):
+        await queue.get()
+    queue.ack(queue.record[1])
+    for _ in range(5):
+        await queue.get()
+    queue.close()
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    assert queue.qsize() == 15
+    for batch in batches[25:]:
+        _, items = await queue.get()
+        assert items == batch
+    queue.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_rewind(tmp_path, readings):
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    batches = [readings("stars1", 5, start=5 * k) for k in range(4)]
+    for batch in batches:
+        queue.put_nowait((MessagePriority.MQTT_READINGS, batch))
+    await queue.get()
+    queue.ack(queue.record[1])
+    await queue.get()
+    queue.rewind()
+    for batch in batches[1:]:
+        _, items = await queue.get()
+        assert items == batch
+    queue.close()
+
+
+def test_torn_record(tmp_path, readings):
+    """A record partially written by a crash ends the segment"""
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    for k in range(3):
+        queue.put_nowait((MessagePriority.MQTT_READINGS, readings("stars1", 5, start=5 * k)))
+    segment = queue._writing
+    # Corrupt the last record payload
+    segment.mm[segment.end - 1] ^= 0xFF
+    queue.close()
+    queue = SpoolQueue(str(tmp_path), SEGMENT_SIZE)
+    assert queue.qsize() == 2
+    queue.close()